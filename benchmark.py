@@ -7,15 +7,29 @@ Usage:
     python3 benchmark.py --base-url http://<NODE_IP>:30081/v1 --label half-a
     python3 benchmark.py --base-url http://<NODE_IP>:30080/v1 --label full --save
     python3 benchmark.py --compare results-full-*.csv results-half-*.csv
+    python3 benchmark.py --base-url http://<NODE_IP>:30081/v1 --model Qwen/Qwen2.5-0.5B-Instruct \
+        --routing-batch-windows 0,2,5,10 --concurrency 1,8,32
+    python3 benchmark.py --base-url http://<NODE_IP>:30090/v1 --session-affinity --num-requests 5
+    python3 benchmark.py --base-url http://<NODE_IP>:30081/v1 --arrival-rate 1,2,4,8 \
+        --prompt-sizes short --num-requests 100 --slo-ttft-ms 500 --slo-tpot-ms 50
+    python3 benchmark.py --base-url http://<NODE_IP>:30081/v1 --label half-a --stall-ms 100 \
+        --timeline timeline-half-a.csv
+    python3 benchmark.py --base-url http://<NODE_IP>:30090/v1 --trace prod-trace.jsonl --time-scale 2
+    python3 benchmark.py --duration-s 60 \
+        --target label=half-a,url=http://<NODE_IP>:30081/v1,model=Qwen/Qwen2.5-0.5B-Instruct,load=constant:4 \
+        --target label=half-b,url=http://<NODE_IP>:30082/v1,model=Qwen/Qwen2.5-1.5B-Instruct,load=ramp:0:8
 """
 
 import argparse
 import asyncio
 import csv
 import json
+import os
+import random
 import statistics
 import time
-from dataclasses import dataclass, field
+from array import array
+from dataclasses import dataclass, field, replace
 from typing import Optional
 
 from openai import AsyncOpenAI
@@ -144,6 +158,18 @@ MULTI_TURN_CONVERSATION = [
     "Based on everything we discussed, what would you recommend for a video streaming application and why?",
 ]
 
+# User messages to route, for --routing-batch-windows
+ROUTING_MESSAGES = [
+    "What is the capital of France?",
+    "Explain the differences between TCP and UDP in detail.",
+    "Write a haiku about GPUs.",
+    "What are the latest developments in quantum computing?",
+    "Compare microservices and monoliths for a 10-person startup.",
+    "What is 17 * 23?",
+    "Summarize the causes of the 2008 financial crisis.",
+    "Hi there!",
+]
+
 
 # ── Data Structures ────────────────────────────────────────────────────────
 
@@ -154,6 +180,8 @@ class RequestResult:
     prompt_tokens: int = 0
     completion_tokens: int = 0
     error: Optional[str] = None
+    # Arrival of each content chunk, seconds from the start (vLLM streams about one token per chunk)
+    chunk_times: array = field(default_factory=lambda: array("d"))
 
     @property
     def tpot_ms(self) -> Optional[float]:
@@ -161,6 +189,41 @@ class RequestResult:
             return None
         return ((self.e2e_s * 1000) - self.ttft_ms) / (self.completion_tokens - 1)
 
+    def itls_ms(self) -> array:
+        """Inter-token latencies: gaps between consecutive chunks, in ms"""
+        t = self.chunk_times
+        return array("d", ((t[i] - t[i - 1]) * 1000 for i in range(1, len(t))))
+
+
+@dataclass
+class SLO:
+    """Per-request latency targets for goodput; None leaves a metric unconstrained"""
+    ttft_ms: Optional[float] = None
+    tpot_ms: Optional[float] = None
+    e2e_s: Optional[float] = None
+
+    def met_by(self, r: RequestResult) -> bool:
+        if r.error is not None:
+            return False
+        if self.ttft_ms is not None and (r.ttft_ms is None or r.ttft_ms > self.ttft_ms):
+            return False
+        # Single-token responses have no TPOT and cannot miss it
+        if self.tpot_ms is not None and r.tpot_ms is not None and r.tpot_ms > self.tpot_ms:
+            return False
+        if self.e2e_s is not None and r.e2e_s > self.e2e_s:
+            return False
+        return True
+
+    def describe(self) -> str:
+        parts = []
+        if self.ttft_ms is not None:
+            parts.append(f"TTFT <= {self.ttft_ms:g}ms")
+        if self.tpot_ms is not None:
+            parts.append(f"TPOT <= {self.tpot_ms:g}ms")
+        if self.e2e_s is not None:
+            parts.append(f"E2E <= {self.e2e_s:g}s")
+        return " and ".join(parts) or "none (every successful request counts)"
+
 
 @dataclass
 class ConfigResult:
@@ -168,6 +231,11 @@ class ConfigResult:
     prompt_size: str = ""
     max_tokens: int = 0
     results: list = field(default_factory=list)
+    # Set when one run spans several models (trace replay)
+    model: str = ""
+    # Wall-clock span of the timed requests (epoch seconds), from the first send to the last response
+    wall_start: float = 0.0
+    wall_end: float = 0.0
 
     @property
     def successful(self) -> list:
@@ -200,13 +268,49 @@ class ConfigResult:
         vals = [r.e2e_s for r in self.successful]
         return {f"p{p}": self.percentile(vals, p) for p in (50, 90, 99)}
 
+    def itl_percentiles(self) -> dict:
+        """Inter-token latency over every gap of every successful request, so stalls aren't averaged away"""
+        vals = array("d")
+        for r in self.successful:
+            vals.extend(r.itls_ms())
+        pcts = {f"p{p}": self.percentile(vals, p) for p in (50, 90, 99)}
+        pcts["max"] = max(vals) if vals else None
+        return pcts
+
+    def stalls(self, threshold_ms: float) -> tuple:
+        """(gaps longer than threshold_ms, requests with at least one such gap)"""
+        gaps = requests = 0
+        for r in self.successful:
+            n = sum(1 for gap in r.itls_ms() if gap > threshold_ms)
+            gaps += n
+            requests += n > 0
+        return gaps, requests
+
+    @property
+    def wall_s(self) -> float:
+        return max(self.wall_end - self.wall_start, 0.0)
+
+    def rate(self, total: float) -> float:
+        return total / self.wall_s if self.wall_s > 0 else 0.0
+
     def throughput_tok_s(self) -> float:
-        total_tokens = sum(r.completion_tokens for r in self.successful)
-        total_time = sum(r.e2e_s for r in self.successful)
-        if total_time == 0 or not self.successful:
-            return 0.0
-        avg_e2e = total_time / len(self.successful)
-        return total_tokens / avg_e2e if avg_e2e > 0 else 0.0
+        """Aggregate output tokens per second of wall-clock time across all concurrent requests"""
+        return self.rate(sum(r.completion_tokens for r in self.successful))
+
+    def input_tok_s(self) -> float:
+        return self.rate(sum(r.prompt_tokens for r in self.successful))
+
+    def requests_s(self) -> float:
+        return self.rate(len(self.successful))
+
+    def slo_attainment(self, slo: SLO) -> Optional[float]:
+        """Fraction of all requests (failures included) that met the SLO"""
+        if not self.results:
+            return None
+        return sum(1 for r in self.results if slo.met_by(r)) / len(self.results)
+
+    def goodput_req_s(self, slo: SLO) -> float:
+        return self.rate(sum(1 for r in self.results if slo.met_by(r)))
 
 
 # ── Core Benchmark Logic ──────────────────────────────────────────────────
@@ -217,7 +321,13 @@ async def send_request(
     prompt: str,
     max_tokens: int,
     messages: Optional[list] = None,
+    t_scheduled: Optional[float] = None,
+    extra_headers: Optional[dict] = None,
 ) -> RequestResult:
+    """
+    t_scheduled is the perf_counter time the request was due to be sent (open-loop mode):
+    latencies run from it rather than from the actual send, so a late send counts against them.
+    """
     if messages is None:
         messages = [
             {"role": "system", "content": SYSTEM_PROMPT},
@@ -225,7 +335,7 @@ async def send_request(
         ]
 
     result = RequestResult()
-    t_start = time.perf_counter()
+    t_start = t_scheduled if t_scheduled is not None else time.perf_counter()
 
     try:
         stream = await client.chat.completions.create(
@@ -235,6 +345,7 @@ async def send_request(
             max_tokens=max_tokens,
             stream=True,
             stream_options={"include_usage": True},
+            extra_headers=extra_headers,
         )
 
         async for chunk in stream:
@@ -244,8 +355,14 @@ async def send_request(
                 continue
             if not chunk.choices:
                 continue
+            # Role-only and finish chunks, and the router's leading routing_metadata chunk (sent
+            # before the backend's first token), carry no text: neither a TTFT nor an ITL sample
+            if not chunk.choices[0].delta.content:
+                continue
+            elapsed = time.perf_counter() - t_start
             if result.ttft_ms is None:
-                result.ttft_ms = (time.perf_counter() - t_start) * 1000
+                result.ttft_ms = elapsed * 1000
+            result.chunk_times.append(elapsed)
 
         result.e2e_s = time.perf_counter() - t_start
 
@@ -276,6 +393,7 @@ async def run_config(
         warmup_tasks = [limited_request() for _ in range(warmup)]
         await asyncio.gather(*warmup_tasks)
 
+    wall_start = time.time()
     timed_tasks = [limited_request() for _ in range(num_requests)]
     results = await asyncio.gather(*timed_tasks)
 
@@ -284,6 +402,8 @@ async def run_config(
         prompt_size=prompt_size,
         max_tokens=max_tokens,
         results=list(results),
+        wall_start=wall_start,
+        wall_end=time.time(),
     )
 
 
@@ -291,8 +411,17 @@ async def run_multi_turn(
     client: AsyncOpenAI,
     model: str,
     max_tokens: int = 256,
+    session_id: Optional[str] = None,
+    affinity: Optional[bool] = None,
 ) -> list:
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    """
+    Through the router, session_id makes the conversation unique (so earlier runs leave no
+    cached prefix) and is sent as X-Session-ID; affinity sets the request's session_affinity.
+    """
+    system_prompt = SYSTEM_PROMPT if session_id is None else f"{SYSTEM_PROMPT} (conversation {session_id})"
+    messages = [{"role": "system", "content": system_prompt}]
+    extra_headers = {"X-Session-ID": session_id} if session_id is not None else None
+    extra_body = {"session_affinity": affinity} if affinity is not None else None
     turn_results = []
 
     for turn_idx, user_msg in enumerate(MULTI_TURN_CONVERSATION, 1):
@@ -303,6 +432,7 @@ async def run_multi_turn(
         response_text = ""
         prompt_tokens = 0
         completion_tokens = 0
+        backend = None
 
         try:
             stream = await client.chat.completions.create(
@@ -312,9 +442,16 @@ async def run_multi_turn(
                 max_tokens=max_tokens,
                 stream=True,
                 stream_options={"include_usage": True},
+                extra_headers=extra_headers,
+                extra_body=extra_body,
             )
 
             async for chunk in stream:
+                # The router's first chunk is sent before the backend's first token: not a TTFT
+                routing = (chunk.model_extra or {}).get("routing_metadata")
+                if routing:
+                    backend = routing.get("source")
+                    continue
                 if hasattr(chunk, "usage") and chunk.usage is not None:
                     prompt_tokens = chunk.usage.prompt_tokens
                     completion_tokens = chunk.usage.completion_tokens
@@ -343,6 +480,7 @@ async def run_multi_turn(
                 "tpot_ms": tpot_ms,
                 "e2e_s": e2e_s,
                 "tok_s": tok_s,
+                "backend": backend,
                 "error": None,
             })
 
@@ -355,6 +493,7 @@ async def run_multi_turn(
                 "tpot_ms": None,
                 "e2e_s": time.perf_counter() - t_start,
                 "tok_s": 0,
+                "backend": backend,
                 "error": str(e),
             })
             messages.append({"role": "assistant", "content": "(error)"})
@@ -362,6 +501,577 @@ async def run_multi_turn(
     return turn_results
 
 
+# ── Conversation Affinity ─────────────────────────────────────────────────
+
+async def run_affinity_comparison(client: AsyncOpenAI, model: str, max_tokens: int,
+                                  conversations: int) -> dict:
+    """
+    Run the multi-turn conversation through the router with session affinity off and on,
+    each conversation with a fresh session id. Returns {mode: [turn results per conversation]}.
+    """
+    runs = {"off": [], "on": []}
+    for i in range(conversations):
+        for mode in runs:
+            session_id = f"bench-{mode}-{i}-{time.time_ns()}"
+            runs[mode].append(await run_multi_turn(client, model, max_tokens, session_id,
+                                                   affinity=(mode == "on")))
+    return runs
+
+
+def print_affinity_results(runs: dict):
+    print()
+    print("=" * 90)
+    print(f"  CONVERSATION AFFINITY  ({len(runs['on'])} conversations per mode, median TTFT per turn)")
+    print("=" * 90)
+    header = f"{'Turn':>4} │{'TTFT off':>10} {'TTFT on':>10} {'Speedup':>8} │{'Backends off':>16} {'Backends on':>16}"
+    print(header)
+    print("─" * 70)
+
+    def turn_column(mode: str, idx: int) -> list:
+        return [conv[idx] for conv in runs[mode] if idx < len(conv) and conv[idx]["error"] is None]
+
+    def backend_spread(turns: list) -> str:
+        # How many distinct backends served this turn across conversations
+        return f"{len({t['backend'] for t in turns})} distinct"
+
+    later = {"off": [], "on": []}
+    for idx in range(len(MULTI_TURN_CONVERSATION)):
+        ttft = {}
+        cells = {}
+        for mode in runs:
+            turns = turn_column(mode, idx)
+            values = [t["ttft_ms"] for t in turns if t["ttft_ms"] is not None]
+            ttft[mode] = statistics.median(values) if values else None
+            cells[mode] = backend_spread(turns) if turns else "—"
+            if idx > 0:
+                later[mode].extend(values)
+        speedup = ttft["off"] / ttft["on"] if ttft["off"] and ttft["on"] else None
+        print(
+            f"{idx + 1:>4} │{fmt(ttft['off'], 'ms', 0, 10)} {fmt(ttft['on'], 'ms', 0, 10)}"
+            f" {fmt(speedup, 'x', 2, 8)} │{cells['off']:>16} {cells['on']:>16}"
+        )
+    print("─" * 70)
+
+    switches = {
+        mode: sum(
+            sum(a["backend"] != b["backend"] for a, b in zip(conv, conv[1:]))
+            for conv in runs[mode]
+        )
+        for mode in runs
+    }
+    if later["off"] and later["on"]:
+        off, on = statistics.median(later["off"]), statistics.median(later["on"])
+        print(f"\n  Turns 2-{len(MULTI_TURN_CONVERSATION)} median TTFT: off {off:.0f}ms │ on {on:.0f}ms"
+              f" │ {off / on:.2f}x")
+    print(f"  Backend switches within a conversation: off {switches['off']} │ on {switches['on']}")
+
+
+# ── Open-Loop Load ────────────────────────────────────────────────────────
+
+def arrival_offsets(rate: float, count: int, process: str, rng: random.Random):
+    """Send times in seconds from the start: exponential gaps (poisson) or evenly spaced (constant)"""
+    offset = 0.0
+    for _ in range(count):
+        yield offset
+        offset += rng.expovariate(rate) if process == "poisson" else 1 / rate
+
+
+async def run_open_loop(
+    client: AsyncOpenAI,
+    model: str,
+    rate: float,
+    prompt_size: str,
+    max_tokens: int,
+    num_requests: int,
+    process: str,
+    rng: random.Random,
+) -> ConfigResult:
+    """
+    Send num_requests at `rate` req/s on a fixed schedule, whether or not earlier requests have
+    finished, so a saturated server builds a queue instead of slowing the client down.
+    Latency runs from each request's scheduled send time.
+    """
+    epoch_start = time.time()
+    wall_start = time.perf_counter()
+    timed = await dispatch_open_loop(client, model, PROMPTS[prompt_size], max_tokens,
+                                     arrival_offsets(rate, num_requests, process, rng), wall_start)
+
+    # concurrency holds the offered rate for the table; it is not a worker count here
+    return ConfigResult(concurrency=rate, prompt_size=prompt_size, max_tokens=max_tokens,
+                        results=[r for _, r in timed], wall_start=epoch_start,
+                        wall_end=epoch_start + time.perf_counter() - wall_start)
+
+
+async def dispatch_open_loop(client: AsyncOpenAI, model: str, prompt: str, max_tokens: int,
+                             offsets, wall_start: float) -> list:
+    """Send one request at each offset (s) from wall_start (perf_counter). Returns [(offset, result)]."""
+    tasks = []
+    for offset in offsets:
+        scheduled = wall_start + offset
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append((offset, asyncio.create_task(
+            send_request(client, model, prompt, max_tokens, t_scheduled=scheduled))))
+    return [(offset, await task) for offset, task in tasks]
+
+
+def saturation_knee(configs: list, slo: SLO, min_attainment: float):
+    """Highest offered rate, below the first one that misses the SLO attainment target"""
+    knee = None
+    for config in configs:
+        attainment = config.slo_attainment(slo)
+        if attainment is None or attainment < min_attainment:
+            break
+        knee = config
+    return knee
+
+
+def print_open_loop_results(configs: list, process: str, slo: SLO, min_attainment: float):
+    print()
+    print("=" * 100)
+    print(f"  OPEN-LOOP LOAD  ({process} arrivals, latency from scheduled send)")
+    print("=" * 100)
+    print()
+    print(f"  SLO: {slo.describe()}  │  Goodput: requests/s meeting the SLO")
+    print()
+
+    header = (
+        f"{'Prompt':<8} {'Rate':>6} {'Done/s':>7} │"
+        f"{'TTFT p50':>9} {'p99':>8} │"
+        f"{'TPOT p50':>9} {'p99':>8} │"
+        f"{'E2E p99':>8} │"
+        f"{'SLO':>6} {'Goodput':>8} {'Err':>4}"
+    )
+    print(header)
+    print("─" * 100)
+
+    by_prompt = {}
+    for config in configs:
+        by_prompt.setdefault(config.prompt_size, []).append(config)
+
+    for i, (prompt_size, prompt_configs) in enumerate(by_prompt.items()):
+        if i > 0:
+            print("─" * 100)
+        knee = saturation_knee(prompt_configs, slo, min_attainment)
+        best = None
+        for config in prompt_configs:
+            ttft = config.ttft_percentiles()
+            tpot = config.tpot_percentiles()
+            e2e = config.e2e_percentiles()
+            attainment = config.slo_attainment(slo) or 0.0
+            done_s = config.requests_s()
+            goodput = config.goodput_req_s(slo)
+            if best is None or goodput > best[1]:
+                best = (config.concurrency, goodput)
+            line = (
+                f"{prompt_size:<8} {config.concurrency:>6g} {done_s:>7.2f} │"
+                f"{fmt(ttft['p50'], 'ms', 0, 9)} {fmt(ttft['p99'], 'ms', 0, 8)} │"
+                f"{fmt(tpot['p50'], 'ms', 1, 9)} {fmt(tpot['p99'], 'ms', 1, 8)} │"
+                f"{fmt(e2e['p99'], 's', 2, 8)} │"
+                f"{attainment * 100:>5.0f}% {goodput:>8.2f} {config.failures:>4}"
+            )
+            if config is knee:
+                line += "  ← knee"
+            print(line)
+        knee_str = f"{knee.concurrency:g} req/s" if knee is not None else "below the lowest rate"
+        print(f"  {prompt_size}: knee {knee_str} (last rate with >= {min_attainment * 100:.0f}% within SLO)"
+              f"  │  peak goodput {best[1]:.2f} req/s at {best[0]:g} req/s")
+
+    print("─" * 100)
+
+
+# ── Trace Replay ──────────────────────────────────────────────────────────
+
+def read_trace(filepath: str):
+    """
+    Yield one request per JSONL line, reading lazily so large traces never sit in memory:
+    {"messages": [...], "max_tokens": 256, "timestamp": 12.5, "session_id": "...", "model": "..."}
+    timestamp is the arrival time in seconds (any origin); only messages is required.
+    """
+    with open(filepath) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{filepath}:{lineno}: {e}") from None
+            if not entry.get("messages"):
+                raise ValueError(f"{filepath}:{lineno}: no messages")
+            yield entry
+
+
+async def run_trace(
+    client: AsyncOpenAI,
+    model: str,
+    filepath: str,
+    max_tokens: int,
+    time_scale: float,
+) -> tuple:
+    """
+    Replay a trace open-loop: each request is sent at its timestamp offset from the first one,
+    divided by time_scale (2 = twice as fast), and measured from that scheduled time.
+    Lines without a timestamp go out with the previous one; session_id is sent as X-Session-ID.
+    Returns ({model: ConfigResult}, peak requests in flight, worst dispatch lag in s).
+    """
+    configs = {}
+    pending = set()
+    peak = 0
+    max_lag = 0.0
+    first_ts = ts = None
+    epoch_start = time.time()
+    wall_start = time.perf_counter()
+
+    def collect(task: asyncio.Task, config: ConfigResult):
+        pending.discard(task)
+        if not task.cancelled():
+            config.results.append(task.result())
+
+    try:
+        for entry in read_trace(filepath):
+            ts = float(entry.get("timestamp", ts if ts is not None else 0.0))
+            if first_ts is None:
+                first_ts = ts
+            scheduled = wall_start + (ts - first_ts) / time_scale
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                max_lag = max(max_lag, -delay)
+
+            target = entry.get("model") or model
+            config = configs.get(target)
+            if config is None:
+                config = configs[target] = ConfigResult(prompt_size="trace", model=target,
+                                                        max_tokens=max_tokens, wall_start=epoch_start)
+            session_id = entry.get("session_id")
+            task = asyncio.create_task(send_request(
+                client, target, "", entry.get("max_tokens", max_tokens), messages=entry["messages"],
+                t_scheduled=scheduled, extra_headers={"X-Session-ID": session_id} if session_id else None,
+            ))
+            task.add_done_callback(lambda t, c=config: collect(t, c))
+            pending.add(task)
+            peak = max(peak, len(pending))
+    except BaseException:
+        # e.g. a malformed line midway: don't leave the requests already sent running unawaited
+        for task in list(pending):
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        raise
+
+    if pending:
+        await asyncio.wait(pending)
+    wall_end = epoch_start + time.perf_counter() - wall_start
+    for config in configs.values():
+        config.concurrency = peak
+        config.wall_end = wall_end
+    return configs, peak, max_lag
+
+
+def print_trace_results(configs: list, filepath: str, time_scale: float, peak: int, max_lag: float,
+                        slo: SLO):
+    print()
+    print("=" * 100)
+    print(f"  TRACE REPLAY  ({filepath}, {time_scale:g}x speed, latency from scheduled send)")
+    print("=" * 100)
+    print()
+    print(f"  Peak in flight: {peak}  │  Worst dispatch lag: {max_lag * 1000:.0f}ms"
+          f"  │  SLO: {slo.describe()}")
+    print()
+
+    header = (
+        f"{'Model':<28} {'Reqs':>6} │"
+        f"{'TTFT p50':>9} {'p99':>8} │"
+        f"{'TPOT p50':>9} {'p99':>8} │"
+        f"{'E2E p99':>8} │"
+        f"{'Tok/s':>7} {'Req/s':>6} {'Good/s':>6} {'Err':>4}"
+    )
+    print(header)
+    print("─" * 100)
+    for c in configs:
+        ttft = c.ttft_percentiles()
+        tpot = c.tpot_percentiles()
+        e2e = c.e2e_percentiles()
+        print(
+            f"{c.model[-28:]:<28} {len(c.results):>6} │"
+            f"{fmt(ttft['p50'], 'ms', 0, 9)} {fmt(ttft['p99'], 'ms', 0, 8)} │"
+            f"{fmt(tpot['p50'], 'ms', 1, 9)} {fmt(tpot['p99'], 'ms', 1, 8)} │"
+            f"{fmt(e2e['p99'], 's', 2, 8)} │"
+            f"{c.throughput_tok_s():>7.1f} {c.requests_s():>6.2f} {c.goodput_req_s(slo):>6.2f}"
+            f" {c.failures:>4}"
+        )
+    print("─" * 100)
+
+
+# ── Noisy Neighbor ────────────────────────────────────────────────────────
+
+LOAD_PROFILES = {"constant": 1, "poisson": 1, "ramp": 2, "closed": 1}
+
+
+@dataclass
+class NeighborTarget:
+    label: str
+    base_url: str
+    model: str
+    # constant:RPS | poisson:RPS | ramp:FROM_RPS:TO_RPS | closed:WORKERS
+    load: str
+
+
+def parse_target(spec: str) -> NeighborTarget:
+    """argparse type for --target label=...,url=...,model=...,load=..."""
+    try:
+        fields = dict(part.split("=", 1) for part in spec.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected key=value pairs: {spec}") from None
+    if "url" not in fields or "load" not in fields:
+        raise argparse.ArgumentTypeError(f"url and load are required: {spec}")
+    kind, *params = fields["load"].split(":")
+    if LOAD_PROFILES.get(kind) != len(params):
+        raise argparse.ArgumentTypeError(f"unknown load profile {fields['load']!r} "
+                                         "(constant:RPS, poisson:RPS, ramp:FROM:TO, closed:WORKERS)")
+    try:
+        [float(p) for p in params]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"bad number in load profile {fields['load']!r}") from None
+    return NeighborTarget(label=fields.get("label", fields["url"]), base_url=fields["url"],
+                          model=fields.get("model", ""), load=fields["load"])
+
+
+def load_offsets(load: str, duration_s: float, rng: random.Random):
+    """Send times (s) within duration_s for an open-loop profile; a ramp thins Poisson arrivals at its peak rate"""
+    kind, *params = load.split(":")
+    rates = [float(p) for p in params]
+    peak = max(rates)
+    if peak <= 0:
+        return
+    t = 0.0
+    while True:
+        t += 1 / peak if kind == "constant" else rng.expovariate(peak)
+        if t >= duration_s:
+            return
+        if kind == "ramp" and rng.random() * peak > rates[0] + (rates[1] - rates[0]) * t / duration_s:
+            continue
+        yield t
+
+
+async def drive_target(target: NeighborTarget, client: AsyncOpenAI, prompt: str, max_tokens: int,
+                       duration_s: float, wall_start: float, rng: random.Random) -> list:
+    """Apply the target's load from wall_start for duration_s. Returns [(offset, result)]."""
+    kind, *params = target.load.split(":")
+    if kind != "closed":
+        return await dispatch_open_loop(client, target.model, prompt, max_tokens,
+                                        load_offsets(target.load, duration_s, rng), wall_start)
+
+    deadline = wall_start + duration_s
+
+    async def worker() -> list:
+        timed = []
+        await asyncio.sleep(max(wall_start - time.perf_counter(), 0))
+        while time.perf_counter() < deadline:
+            offset = time.perf_counter() - wall_start
+            timed.append((offset, await send_request(client, target.model, prompt, max_tokens)))
+        return timed
+
+    per_worker = await asyncio.gather(*[worker() for _ in range(int(params[0]))])
+    return sorted((item for timed in per_worker for item in timed), key=lambda item: item[0])
+
+
+async def run_neighbor_phase(targets: list, clients: dict, prompt_size: str, max_tokens: int,
+                             duration_s: float, seed: int) -> dict:
+    """
+    Drive all targets on one shared clock. Each target's arrivals are seeded the same way in
+    every phase, so solo and co-located runs see identical schedules.
+    Returns {label: (ConfigResult, [(offset, result)])}.
+    """
+    epoch_start = time.time()
+    wall_start = time.perf_counter()
+
+    async def drive(i: int, target: NeighborTarget) -> tuple:
+        timed = await drive_target(target, clients[target.label], PROMPTS[prompt_size], max_tokens,
+                                   duration_s, wall_start, random.Random(seed + i))
+        config = ConfigResult(prompt_size=target.label, max_tokens=max_tokens,
+                              results=[r for _, r in timed], wall_start=epoch_start,
+                              wall_end=epoch_start + time.perf_counter() - wall_start)
+        return target.label, (config, timed)
+
+    return dict(await asyncio.gather(*[drive(i, t) for i, t in enumerate(targets)]))
+
+
+def print_neighbor_results(targets: list, solo: dict, shared: dict, duration_s: float, windows: int,
+                           slo: SLO):
+    print()
+    print("=" * 110)
+    print(f"  NOISY NEIGHBOR  ({duration_s:g}s per phase, solo = that target alone, shared = all at once)")
+    print("=" * 110)
+    print()
+    print(f"  Latency from scheduled send  │  SLO: {slo.describe()}  │  Δ = shared / solo")
+    print()
+
+    header = (
+        f"{'Target':<12} {'Load':<14} {'Phase':<6} │{'Reqs':>5} │"
+        f"{'TTFT p50':>9} {'p99':>8} │"
+        f"{'TPOT p50':>9} {'p99':>8} │"
+        f"{'ITL p99':>8} {'E2E p99':>8} │"
+        f"{'Tok/s':>7} {'Good/s':>6} {'Err':>4}"
+    )
+    print(header)
+    print("─" * 110)
+
+    def metrics(c: ConfigResult) -> dict:
+        ttft, tpot, e2e = c.ttft_percentiles(), c.tpot_percentiles(), c.e2e_percentiles()
+        return {
+            "ttft_p50": ttft["p50"], "ttft_p99": ttft["p99"],
+            "tpot_p50": tpot["p50"], "tpot_p99": tpot["p99"],
+            "itl_p99": c.itl_percentiles()["p99"], "e2e_p99": e2e["p99"],
+            "tok_s": c.throughput_tok_s(), "good_s": c.goodput_req_s(slo),
+        }
+
+    for i, target in enumerate(targets):
+        if i > 0:
+            print("─" * 110)
+        rows = {}
+        for phase, runs in (("solo", solo), ("shared", shared)):
+            config = runs[target.label][0]
+            m = rows[phase] = metrics(config)
+            print(
+                f"{(target.label if phase == 'solo' else ''):<12} "
+                f"{(target.load if phase == 'solo' else ''):<14} {phase:<6} │{len(config.results):>5} │"
+                f"{fmt(m['ttft_p50'], 'ms', 0, 9)} {fmt(m['ttft_p99'], 'ms', 0, 8)} │"
+                f"{fmt(m['tpot_p50'], 'ms', 1, 9)} {fmt(m['tpot_p99'], 'ms', 1, 8)} │"
+                f"{fmt(m['itl_p99'], 'ms', 1, 8)} {fmt(m['e2e_p99'], 's', 2, 8)} │"
+                f"{m['tok_s']:>7.1f} {m['good_s']:>6.2f} {config.failures:>4}"
+            )
+        ratio = {
+            k: rows["shared"][k] / rows["solo"][k] if rows["solo"][k] and rows["shared"][k] is not None else None
+            for k in rows["solo"]
+        }
+        print(
+            f"{'':<12} {'':<14} {'Δ':<6} │{'':>5} │"
+            f"{fmt(ratio['ttft_p50'], 'x', 2, 9)} {fmt(ratio['ttft_p99'], 'x', 2, 8)} │"
+            f"{fmt(ratio['tpot_p50'], 'x', 2, 9)} {fmt(ratio['tpot_p99'], 'x', 2, 8)} │"
+            f"{fmt(ratio['itl_p99'], 'x', 2, 8)} {fmt(ratio['e2e_p99'], 'x', 2, 8)} │"
+            f"{fmt(ratio['tok_s'], 'x', 2, 7)} {fmt(ratio['good_s'], 'x', 2, 6)}"
+        )
+    print("─" * 110)
+
+    # How interference tracks the neighbors' load over the shared phase
+    print()
+    print("  Shared phase over time (requests sent/s, TTFT p50 of requests sent in the window)")
+    print()
+    width = duration_s / windows
+    print(f"{'Window':>13} │" + "".join(f"{t.label[:20]:>22} │" for t in targets))
+    print("─" * (15 + 24 * len(targets)))
+    for w in range(windows):
+        lo, hi = w * width, (w + 1) * width
+        cells = []
+        for target in targets:
+            sent = [r for offset, r in shared[target.label][1] if lo <= offset < hi]
+            ttft = [r.ttft_ms for r in sent if r.error is None and r.ttft_ms is not None]
+            median = statistics.median(ttft) if ttft else None
+            cells.append(f"{len(sent) / width:>8.1f}/s {fmt(median, 'ms', 0, 10)}")
+        print(f"{f'{lo:.0f}-{hi:.0f}s':>13} │" + "".join(f" {cell:>21} │" for cell in cells))
+    print("─" * (15 + 24 * len(targets)))
+
+
+# ── Routing Decision Batching ─────────────────────────────────────────────
+
+def import_router(base_url: str, model: str):
+    """
+    router_service with base_url as its router model and decision caching off, so every
+    decision goes through the router's own prompt, decode mode and DecisionBatcher.
+    Imported on demand: the other modes don't need the router's dependencies.
+    """
+    os.environ["ROUTER_MODEL_URL"] = base_url.rstrip("/") + "/chat/completions"
+    os.environ["ROUTER_MODEL"] = model
+    os.environ["ROUTING_CACHE_SIZE"] = "0"
+    import router_service
+    return router_service
+
+
+async def run_routing_batch(
+    rs,
+    burst: int,
+    window_ms: float,
+    max_batch: int,
+    num_bursts: int,
+    spread_ms: float,
+) -> tuple:
+    """
+    Fire num_bursts bursts of `burst` routing decisions through router_agent_decision,
+    arrivals spread evenly over spread_ms. window_ms=0 sends each decision alone through the
+    same batcher (max batch 1), so both sides use the same /v1/completions call and prompt
+    and differ only in batching. Latency runs from each decision's arrival to its answer.
+    Returns (ConfigResult, HTTP calls, wall s).
+    """
+    batcher = rs.DecisionBatcher(rs.UPSTREAMS["router"], window_ms / 1000, max_batch if window_ms > 0 else 1)
+    rs.decision_batcher = batcher
+    # Any positive window sends decisions through the batcher; with max batch 1 none of them wait
+    rs.DECISION_BATCH_WINDOW_MS = window_ms or 0.001
+
+    async def decide(i: int, delay_s: float) -> RequestResult:
+        await asyncio.sleep(delay_s)
+        result = RequestResult()
+        t_start = time.perf_counter()
+        decision = await rs.router_agent_decision(ROUTING_MESSAGES[i % len(ROUTING_MESSAGES)])
+        result.e2e_s = time.perf_counter() - t_start
+        # The router falls back to route_simple rather than raising
+        if decision.decided_by == "fallback":
+            result.error = decision.reason
+        elif decision.usage:
+            result.completion_tokens = decision.usage.get("completion_tokens", 0)
+        return result
+
+    results = []
+    epoch_start = time.time()
+    wall_start = time.perf_counter()
+    for _ in range(num_bursts):
+        step_s = spread_ms / 1000 / burst
+        results.extend(await asyncio.gather(*[decide(i, i * step_s) for i in range(burst)]))
+    wall_s = time.perf_counter() - wall_start
+
+    config = ConfigResult(concurrency=burst, prompt_size=f"{window_ms:g}ms", results=results,
+                          wall_start=epoch_start, wall_end=epoch_start + wall_s)
+    return config, batcher.batches, wall_s
+
+
+def print_routing_batch_results(rows: list, spread_ms: float):
+    print()
+    print("=" * 90)
+    print("  ROUTING DECISION BATCHING")
+    print("=" * 90)
+    print()
+    print(f"  Decision latency from arrival (ms), arrivals spread over {spread_ms:g}ms per burst")
+    print()
+
+    header = (
+        f"{'Window':>7} {'Burst':>5} │"
+        f"{'p50':>8} {'p90':>8} {'p99':>8} │"
+        f"{'Dec/s':>7} {'Calls':>6} {'Per call':>8} {'Err':>4}"
+    )
+    print(header)
+    print("─" * 90)
+
+    current_burst = None
+    for config, calls, wall_s in rows:
+        if config.concurrency != current_burst:
+            if current_burst is not None:
+                print("─" * 90)
+            current_burst = config.concurrency
+        vals = [r.e2e_s * 1000 for r in config.successful]
+        decisions_s = len(config.successful) / wall_s if wall_s > 0 else 0.0
+        per_call = len(config.results) / calls if calls else 0.0
+        print(
+            f"{config.prompt_size:>7} {config.concurrency:>5} │"
+            f"{fmt(config.percentile(vals, 50), '', 0, 8)} {fmt(config.percentile(vals, 90), '', 0, 8)}"
+            f" {fmt(config.percentile(vals, 99), '', 0, 8)} │"
+            f"{decisions_s:>7.1f} {calls:>6} {per_call:>8.1f} {config.failures:>4}"
+        )
+
+    print("─" * 90)
+
+
 # ── Helpers ────────────────────────────────────────────────────────────────
 
 def fmt(val, suffix="", decimals=1, width=8):
@@ -372,23 +1082,26 @@ def fmt(val, suffix="", decimals=1, width=8):
 
 # ── Output Formatting ─────────────────────────────────────────────────────
 
-def print_sweep_results(configs: list, num_requests: int, label: str = ""):
+def print_sweep_results(configs: list, num_requests: int, label: str = "", slo: Optional[SLO] = None):
     total_failures = sum(c.failures for c in configs)
+    slo = slo or SLO()
 
     print()
-    print("=" * 90)
+    print("=" * 105)
     title = "  SINGLE-REQUEST SWEEP RESULTS"
     if label:
         title += f"  [{label}]"
     print(title)
-    print("=" * 90)
+    print("=" * 105)
 
     print()
     print("  Metric Definitions:")
     print("    TTFT     Time To First Token (ms)")
     print("    TPOT     Time Per Output Token (ms)")
     print("    E2E      End-to-End latency (s)")
-    print("    Tok/s    Output tokens per second")
+    print("    Tok/s    Aggregate output tokens per second of wall-clock time")
+    print("    Req/s    Completed requests per second of wall-clock time")
+    print(f"    Good/s   Requests per second meeting the SLO: {slo.describe()}")
     print()
     print(f"  {num_requests} requests per configuration")
     if total_failures > 0:
@@ -400,19 +1113,19 @@ def print_sweep_results(configs: list, num_requests: int, label: str = ""):
         f"{'TTFT p50':>9} {'p90':>8} {'p99':>8} │"
         f"{'TPOT p50':>9} {'p90':>8} │"
         f"{'E2E p50':>8} {'p90':>8} │"
-        f"{'Tok/s':>7}"
+        f"{'Tok/s':>7} {'Req/s':>6} {'Good/s':>6}"
     )
     if total_failures > 0:
         header += f" {'Err':>4}"
 
     print(header)
-    print("─" * 90)
+    print("─" * 105)
 
     current_prompt = None
     for c in configs:
         if c.prompt_size != current_prompt:
             if current_prompt is not None:
-                print("─" * 90)
+                print("─" * 105)
             current_prompt = c.prompt_size
 
         ttft = c.ttft_percentiles()
@@ -425,15 +1138,62 @@ def print_sweep_results(configs: list, num_requests: int, label: str = ""):
             f"{fmt(ttft['p50'], 'ms', 0, 9)} {fmt(ttft['p90'], 'ms', 0, 8)} {fmt(ttft['p99'], 'ms', 0, 8)} │"
             f"{fmt(tpot['p50'], 'ms', 1, 9)} {fmt(tpot['p90'], 'ms', 1, 8)} │"
             f"{fmt(e2e['p50'], 's', 2, 8)} {fmt(e2e['p90'], 's', 2, 8)} │"
-            f"{throughput:>7.1f}"
+            f"{throughput:>7.1f} {c.requests_s():>6.2f} {c.goodput_req_s(slo):>6.2f}"
         )
         if total_failures > 0:
             line += f" {c.failures:>4}"
 
         print(line)
 
+    print("─" * 105)
+
+
+def print_jitter_results(configs: list, stall_ms: float):
+    print()
+    print("=" * 90)
+    print("  STREAMING JITTER (inter-token latency)")
+    print("=" * 90)
+    print()
+    print(f"  ITL over every gap between streamed chunks; a stall is a gap over {stall_ms:g}ms")
+    print()
+
+    header = (
+        f"{'Prompt':<8} {'Conc':>4} │"
+        f"{'ITL p50':>9} {'p90':>8} {'p99':>8} {'max':>9} │"
+        f"{'Stalls':>7} {'Stalled req':>12}"
+    )
+    print(header)
     print("─" * 90)
 
+    current_prompt = None
+    for c in configs:
+        if c.prompt_size != current_prompt:
+            if current_prompt is not None:
+                print("─" * 90)
+            current_prompt = c.prompt_size
+        itl = c.itl_percentiles()
+        gaps, stalled = c.stalls(stall_ms)
+        print(
+            f"{(c.model or c.prompt_size)[-8:]:<8} {c.concurrency:>4g} │"
+            f"{fmt(itl['p50'], 'ms', 1, 9)} {fmt(itl['p90'], 'ms', 1, 8)} {fmt(itl['p99'], 'ms', 1, 8)}"
+            f" {fmt(itl['max'], 'ms', 0, 9)} │"
+            f"{gaps:>7} {f'{stalled}/{len(c.successful)}':>12}"
+        )
+
+    print("─" * 90)
+
+
+def save_timeline(filepath: str, configs: list):
+    """One row per streamed chunk, for plotting token arrival per request"""
+    with open(filepath, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["prompt_size", "concurrency", "request", "chunk", "t_ms", "model"])
+        for c in configs:
+            for i, r in enumerate(c.successful):
+                for j, t in enumerate(r.chunk_times):
+                    writer.writerow([c.prompt_size, c.concurrency, i, j, f"{t * 1000:.2f}", c.model])
+    print(f"\nChunk timeline saved to {filepath}")
+
 
 def print_multi_turn_results(turn_results: list):
     print()
@@ -471,23 +1231,34 @@ def print_multi_turn_results(turn_results: list):
                 print("  → Prefix caching not observed (TTFT grows with context)")
 
 
+def auto_save_path(label: str, mode: str = "") -> str:
+    """File name for --save without one: results[-MODE][-LABEL]-TIMESTAMP.csv"""
+    parts = "".join(f"-{part}" for part in (mode, label) if part)
+    return time.strftime(f"results{parts}-%Y%m%d-%H%M%S.csv")
+
+
 def save_results(filepath: str, configs: list, multi_turn: list,
-                 label: str = "", num_requests: int = 10):
+                 label: str = "", num_requests: int = 10, slo: Optional[SLO] = None,
+                 stall_ms: float = 100):
+    slo = slo or SLO()
     if filepath.endswith(".csv"):
-        save_csv(filepath, configs, multi_turn, label, num_requests)
+        save_csv(filepath, configs, multi_turn, label, num_requests, slo, stall_ms)
     else:
-        save_json(filepath, configs, multi_turn, label, num_requests)
+        save_json(filepath, configs, multi_turn, label, num_requests, slo, stall_ms)
     print(f"\nResults saved to {filepath}")
 
 
 def save_csv(filepath: str, configs: list, multi_turn: list,
-             label: str = "", num_requests: int = 10):
+             label: str = "", num_requests: int = 10, slo: Optional[SLO] = None,
+             stall_ms: float = 100):
     total_failures = sum(c.failures for c in configs)
+    slo = slo or SLO()
 
     with open(filepath, "w", newline="") as f:
         writer = csv.writer(f)
 
-        writer.writerow([f"# label={label}, {num_requests} requests per config"])
+        writer.writerow([f"# label={label}, {num_requests} requests per config, SLO: {slo.describe()}"
+                         f", stall > {stall_ms:g}ms"])
         writer.writerow([])
 
         sweep_header = [
@@ -496,6 +1267,11 @@ def save_csv(filepath: str, configs: list, multi_turn: list,
             "tpot_p50_ms", "tpot_p90_ms", "tpot_p99_ms",
             "e2e_p50_s", "e2e_p90_s", "e2e_p99_s",
             "throughput_tok_s",
+            # Appended after throughput_tok_s so --compare reads older files the same way
+            "requests_s", "input_tok_s", "goodput_req_s", "slo_attainment",
+            "wall_start", "wall_end", "wall_s",
+            "itl_p50_ms", "itl_p90_ms", "itl_p99_ms", "itl_max_ms", "stalls", "stalled_requests",
+            "model",
         ]
         if total_failures > 0:
             sweep_header.append("errors")
@@ -505,6 +1281,7 @@ def save_csv(filepath: str, configs: list, multi_turn: list,
             ttft = c.ttft_percentiles()
             tpot = c.tpot_percentiles()
             e2e = c.e2e_percentiles()
+            itl = c.itl_percentiles()
             row = [
                 c.prompt_size, c.concurrency,
                 f"{ttft['p50']:.1f}" if ttft["p50"] is not None else "",
@@ -517,6 +1294,14 @@ def save_csv(filepath: str, configs: list, multi_turn: list,
                 f"{e2e['p90']:.2f}" if e2e["p90"] is not None else "",
                 f"{e2e['p99']:.2f}" if e2e["p99"] is not None else "",
                 f"{c.throughput_tok_s():.1f}",
+                f"{c.requests_s():.2f}",
+                f"{c.input_tok_s():.1f}",
+                f"{c.goodput_req_s(slo):.2f}",
+                f"{c.slo_attainment(slo):.3f}" if c.results else "",
+                f"{c.wall_start:.3f}", f"{c.wall_end:.3f}", f"{c.wall_s:.2f}",
+                *(f"{itl[k]:.1f}" if itl[k] is not None else "" for k in ("p50", "p90", "p99", "max")),
+                *c.stalls(stall_ms),
+                c.model,
             ]
             if total_failures > 0:
                 row.append(c.failures)
@@ -538,10 +1323,14 @@ def save_csv(filepath: str, configs: list, multi_turn: list,
 
 
 def save_json(filepath: str, configs: list, multi_turn: list,
-              label: str = "", num_requests: int = 10):
+              label: str = "", num_requests: int = 10, slo: Optional[SLO] = None,
+              stall_ms: float = 100):
+    slo = slo or SLO()
     data = {
         "label": label,
         "num_requests_per_config": num_requests,
+        "slo": {"ttft_ms": slo.ttft_ms, "tpot_ms": slo.tpot_ms, "e2e_s": slo.e2e_s},
+        "stall_ms": stall_ms,
         "sweep": [],
         "multi_turn": multi_turn,
     }
@@ -550,11 +1339,21 @@ def save_json(filepath: str, configs: list, multi_turn: list,
         entry = {
             "concurrency": c.concurrency,
             "prompt_size": c.prompt_size,
+            "model": c.model,
             "ttft": c.ttft_percentiles(),
             "tpot": c.tpot_percentiles(),
             "e2e": c.e2e_percentiles(),
             "throughput_tok_s": c.throughput_tok_s(),
+            "requests_s": c.requests_s(),
+            "input_tok_s": c.input_tok_s(),
+            "goodput_req_s": c.goodput_req_s(slo),
+            "slo_attainment": c.slo_attainment(slo),
+            "wall_start": c.wall_start,
+            "wall_end": c.wall_end,
+            "wall_s": c.wall_s,
+            "itl": c.itl_percentiles(),
         }
+        entry["stalls"], entry["stalled_requests"] = c.stalls(stall_ms)
         if c.failures > 0:
             entry["errors"] = c.failures
         data["sweep"].append(entry)
@@ -649,17 +1448,173 @@ async def async_main():
                         help="Save results (default: results-LABEL-TIMESTAMP.csv)")
     parser.add_argument("--compare", nargs="+", metavar="FILE",
                         help="Compare multiple result CSV files")
+    parser.add_argument("--routing-batch-windows", metavar="MS",
+                        help="Benchmark the router's batched routing decisions instead (imports "
+                             "router_service): comma-separated batch windows in ms (0 = unbatched), "
+                             "one burst size per --concurrency level")
+    parser.add_argument("--routing-batch-max", type=int, default=16,
+                        help="Max routing prompts per batched call")
+    parser.add_argument("--routing-spread-ms", type=float, default=20,
+                        help="Spread each burst's arrivals evenly over this many ms")
+    parser.add_argument("--session-affinity", action="store_true",
+                        help="Against the router: compare multi-turn TTFT with conversation affinity "
+                             "off and on, --num-requests conversations per mode")
+    parser.add_argument("--arrival-rate", metavar="RPS",
+                        help="Open-loop mode: comma-separated request rates (req/s) to sweep, "
+                             "--num-requests per rate, sent on schedule regardless of completions")
+    parser.add_argument("--arrival-process", default="poisson", choices=["poisson", "constant"],
+                        help="Open-loop inter-arrival times: exponential or fixed")
+    parser.add_argument("--slo-ttft-ms", type=float, default=1000,
+                        help="TTFT SLO for goodput (ms)")
+    parser.add_argument("--slo-tpot-ms", type=float, default=100,
+                        help="TPOT SLO for goodput (ms)")
+    parser.add_argument("--slo-e2e-s", type=float,
+                        help="End-to-end latency SLO for goodput (s, default: none)")
+    parser.add_argument("--slo-attainment", type=float, default=0.9,
+                        help="Fraction of requests within SLO that defines the saturation knee")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for Poisson arrivals")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="Replay a JSONL trace with its original timing (messages, max_tokens, "
+                             "timestamp, optional session_id and model per line)")
+    parser.add_argument("--time-scale", type=float, default=1.0,
+                        help="Trace replay speed-up (2 = twice as fast)")
+    parser.add_argument("--target", action="append", type=parse_target, metavar="SPEC",
+                        help="Noisy-neighbor mode, repeat per endpoint: label=NAME,url=BASE_URL,"
+                             "model=MODEL,load=constant:RPS|poisson:RPS|ramp:FROM:TO|closed:WORKERS")
+    parser.add_argument("--duration-s", type=float, default=60,
+                        help="Noisy-neighbor phase length (solo per target, then shared)")
+    parser.add_argument("--neighbor-windows", type=int, default=6,
+                        help="Time windows in the shared-phase breakdown")
+    parser.add_argument("--stall-ms", type=float, default=100,
+                        help="Count inter-token gaps longer than this as stalls")
+    parser.add_argument("--timeline", metavar="FILE",
+                        help="Save every streamed chunk's arrival time per request to CSV")
     args = parser.parse_args()
+    slo = SLO(ttft_ms=args.slo_ttft_ms, tpot_ms=args.slo_tpot_ms, e2e_s=args.slo_e2e_s)
+    if args.arrival_rate:
+        rates = [float(x) for x in args.arrival_rate.split(",")]
+        if min(rates) <= 0:
+            parser.error("--arrival-rate values must be > 0")
+    if args.time_scale <= 0:
+        parser.error("--time-scale must be > 0")
+    if args.save and args.session_affinity:
+        parser.error("--save is not supported with --session-affinity")
+    if args.save == "auto":
+        mode = ("routing-batch" if args.routing_batch_windows else "neighbor" if args.target
+                else "trace" if args.trace else "open-loop" if args.arrival_rate else "")
+        args.save = auto_save_path(args.label, mode)
 
     # Compare mode
     if args.compare:
         compare_csv_files(args.compare)
         return
 
-    # Auto-generate filename
-    if args.save == "auto":
-        label_part = f"-{args.label}" if args.label else ""
-        args.save = time.strftime(f"results{label_part}-%Y%m%d-%H%M%S.csv")
+    # Routing decision batching mode
+    if args.routing_batch_windows:
+        windows = [float(x) for x in args.routing_batch_windows.split(",")]
+        bursts = [int(x) for x in args.concurrency.split(",")]
+        rs = import_router(args.base_url, args.model)
+        print(f"  Routing decisions through router_service on {args.model} @ {args.base_url}"
+              f" ({rs.ROUTING_DECODE_MODE})")
+        rows = []
+        async with rs.lifespan(rs.app):
+            if args.warmup > 0:
+                await run_routing_batch(rs, args.warmup, 0, 1, 1, 0)
+            for burst in bursts:
+                for window in windows:
+                    print(f"  burst={burst} window={window:g}ms ... ", end="", flush=True)
+                    row = await run_routing_batch(rs, burst, window, args.routing_batch_max,
+                                                  args.num_requests, args.routing_spread_ms)
+                    p99 = row[0].percentile([r.e2e_s * 1000 for r in row[0].successful], 99)
+                    print(f"p99={fmt(p99, 'ms', 0, 0)}  calls={row[1]}")
+                    rows.append(row)
+        print_routing_batch_results(rows, args.routing_spread_ms)
+        if args.save:
+            configs = [config for config, _, _ in rows]
+            save_results(args.save, configs, [], args.label, len(configs[0].results) if configs else 0,
+                         slo, args.stall_ms)
+        return
+
+    # Conversation affinity mode
+    if args.session_affinity:
+        client = AsyncOpenAI(base_url=args.base_url, api_key="not-needed")
+        print(f"  Multi-turn conversations through the router @ {args.base_url}")
+        runs = await run_affinity_comparison(client, args.model, args.max_tokens, args.num_requests)
+        print_affinity_results(runs)
+        return
+
+    # Noisy-neighbor mode
+    if args.target:
+        if len(args.target) < 2:
+            parser.error("noisy-neighbor mode needs at least two --target endpoints")
+        if len({t.label for t in args.target}) < len(args.target):
+            parser.error("--target labels must be unique")
+        prompt_size = args.prompt_sizes.split(",")[0].strip()
+        clients = {}
+        for target in args.target:
+            target.model = target.model or args.model
+            clients[target.label] = AsyncOpenAI(base_url=target.base_url, api_key="not-needed")
+            print(f"  {target.label:<12} {target.model} @ {target.base_url}  load={target.load}")
+            for _ in range(args.warmup):
+                await send_request(clients[target.label], target.model, PROMPTS[prompt_size], args.max_tokens)
+        solo = {}
+        for target in args.target:
+            print(f"  solo {target.label} ({args.duration_s:g}s) ... ", end="", flush=True)
+            solo.update(await run_neighbor_phase([target], clients, prompt_size, args.max_tokens,
+                                                 args.duration_s, args.seed + args.target.index(target)))
+            print(f"{len(solo[target.label][0].results)} requests")
+        print(f"  shared, all targets ({args.duration_s:g}s) ... ", end="", flush=True)
+        shared = await run_neighbor_phase(args.target, clients, prompt_size, args.max_tokens,
+                                          args.duration_s, args.seed)
+        print(f"{sum(len(c.results) for c, _ in shared.values())} requests")
+        print_neighbor_results(args.target, solo, shared, args.duration_s, args.neighbor_windows, slo)
+        if args.save:
+            configs = [replace(runs[target.label][0], prompt_size=f"{target.label}/{phase}", model=target.model)
+                       for target in args.target for phase, runs in (("solo", solo), ("shared", shared))]
+            save_results(args.save, configs, [], args.label, len(configs[0].results), slo, args.stall_ms)
+        return
+
+    # Trace replay mode
+    if args.trace:
+        client = AsyncOpenAI(base_url=args.base_url, api_key="not-needed")
+        print(f"  Replaying {args.trace} at {args.time_scale:g}x @ {args.base_url}", flush=True)
+        configs, peak, max_lag = await run_trace(client, args.model, args.trace, args.max_tokens,
+                                                 args.time_scale)
+        configs = list(configs.values())
+        print_trace_results(configs, args.trace, args.time_scale, peak, max_lag, slo)
+        print_jitter_results(configs, args.stall_ms)
+        if args.save:
+            save_results(args.save, configs, [], args.label, len(configs[0].results) if configs else 0,
+                         slo, args.stall_ms)
+        if args.timeline:
+            save_timeline(args.timeline, configs)
+        return
+
+    # Open-loop mode
+    if args.arrival_rate:
+        prompt_sizes = [x.strip() for x in args.prompt_sizes.split(",")]
+        client = AsyncOpenAI(base_url=args.base_url, api_key="not-needed")
+        rng = random.Random(args.seed)
+        print(f"  Open-loop {args.arrival_process} arrivals on {args.model} @ {args.base_url}")
+        for _ in range(args.warmup):
+            await send_request(client, args.model, PROMPTS[prompt_sizes[0]], args.max_tokens)
+        configs = []
+        for prompt_size in prompt_sizes:
+            for rate in rates:
+                print(f"  prompt={prompt_size} rate={rate:g}/s ... ", end="", flush=True)
+                config = await run_open_loop(client, args.model, rate, prompt_size, args.max_tokens,
+                                             args.num_requests, args.arrival_process, rng)
+                attainment = config.slo_attainment(slo) or 0.0
+                p99 = config.ttft_percentiles()["p99"]
+                print(f"TTFT_p99={fmt(p99, 'ms', 0, 0)}  SLO={attainment * 100:.0f}%")
+                configs.append(config)
+        print_open_loop_results(configs, args.arrival_process, slo, args.slo_attainment)
+        print_jitter_results(configs, args.stall_ms)
+        if args.save:
+            save_results(args.save, configs, [], args.label, args.num_requests, slo, args.stall_ms)
+        if args.timeline:
+            save_timeline(args.timeline, configs)
+        return
 
     concurrency_levels = [int(x) for x in args.concurrency.split(",")]
     prompt_sizes = [x.strip() for x in args.prompt_sizes.split(",")]
@@ -706,12 +1661,14 @@ async def async_main():
 
             ttft_str = f"{ttft_p50:.0f}ms" if ttft_p50 is not None else "—"
             tpot_str = f"{tpot_p50:.1f}ms" if tpot_p50 is not None else "—"
-            progress = f"TTFT_p50={ttft_str}  TPOT_p50={tpot_str}  tok/s={throughput:.1f}"
+            progress = (f"TTFT_p50={ttft_str}  TPOT_p50={tpot_str}  tok/s={throughput:.1f}"
+                        f"  goodput={config.goodput_req_s(slo):.2f}/s")
             if fail > 0:
                 progress += f"  errors={fail}"
             print(progress)
 
-    print_sweep_results(all_configs, args.num_requests, args.label)
+    print_sweep_results(all_configs, args.num_requests, args.label, slo)
+    print_jitter_results(all_configs, args.stall_ms)
 
     # ── Multi-turn test ──
     print("\n  Running multi-turn conversation (5 turns) ...", flush=True)
@@ -721,7 +1678,9 @@ async def async_main():
     # ── Save results ──
     if args.save:
         save_results(args.save, all_configs, multi_turn_results,
-                     args.label, args.num_requests)
+                     args.label, args.num_requests, slo, args.stall_ms)
+    if args.timeline:
+        save_timeline(args.timeline, all_configs)
 
     print()
 
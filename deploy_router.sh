@@ -20,9 +20,11 @@ fi
 ROUTER_CODE=$(cat "$SCRIPT_DIR/router_service.py" | base64 | tr -d '\n')
 
 # Create/update ConfigMap with router code
-echo "[1/4] Creating ConfigMap with router service code..."
+echo "[1/4] Creating ConfigMap with router service code, routing rules and examples..."
 kubectl create configmap router-agent-code \
     --from-file=router_service.py="$SCRIPT_DIR/router_service.py" \
+    --from-file=router_rules.json="$SCRIPT_DIR/router_rules.json" \
+    --from-file=routing_examples.jsonl="$SCRIPT_DIR/routing_examples.jsonl" \
     -n qgpu-demo \
     --dry-run=client -o yaml | kubectl apply -f -
 
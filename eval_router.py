@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Offline evaluation of the router's decision engines.
+
+Scores the embedding engine (nearest centroid, leave-one-out over the labeled set) and the
+router LLM on the same labeled prompts, and compares accuracy, agreement and latency.
+
+Usage:
+    python3 eval_router.py
+    python3 eval_router.py --examples my_labeled.jsonl --decode-mode label
+    python3 eval_router.py --no-llm --csv eval.csv
+
+Upstreams are configured with the same environment variables as router_service.py
+(ROUTER_MODEL_URL, EMBEDDING_URL, EMBEDDING_MODEL, ...), e.g. through kubectl port-forward.
+"""
+
+import argparse
+import asyncio
+import csv
+import os
+import time
+
+# Every prompt must reach the engines: no cached decisions
+os.environ["ROUTING_CACHE_SIZE"] = "0"
+
+import router_service as rs  # noqa: E402
+
+
+# ── Helpers ────────────────────────────────────────────────────────────────
+
+def percentile(values: list, p: int):
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * (p / 100)
+    f = int(k)
+    if f + 1 >= len(ordered):
+        return ordered[f]
+    return ordered[f] + (k - f) * (ordered[f + 1] - ordered[f])
+
+
+def fmt(val, suffix="", decimals=1, width=8):
+    if val is None:
+        return "—".rjust(width)
+    return f"{val:.{decimals}f}{suffix}".rjust(width)
+
+
+# ── Engines ────────────────────────────────────────────────────────────────
+
+async def embed_examples(texts: list) -> tuple:
+    """Embed each prompt on its own, as the router would. Returns (vectors, latencies in ms)."""
+    vectors, latencies = [], []
+    for text in texts:
+        start = time.perf_counter()
+        batch, _ = await rs.call_embeddings(rs.UPSTREAMS["embedding"], [text])
+        latencies.append((time.perf_counter() - start) * 1000)
+        vectors.append(batch[0])
+    return vectors, latencies
+
+
+def leave_one_out(vectors: list, actions: list) -> list:
+    """Nearest-centroid prediction for each example with that example left out of its centroid"""
+    units = [rs.unit_vector(v) for v in vectors]
+    sums = {}
+    for unit, action in zip(units, actions):
+        total = sums.get(action)
+        sums[action] = unit if total is None else [a + b for a, b in zip(total, unit)]
+
+    predictions = []
+    for unit, action in zip(units, actions):
+        held_out = [a - b for a, b in zip(sums[action], unit)]
+        centroids = {other: rs.unit_vector(total) for other, total in sums.items() if other != action}
+        if any(held_out):
+            centroids[action] = rs.unit_vector(held_out)
+        predictions.append(rs.rank_actions(centroids, unit)[0][1])
+    return predictions
+
+
+async def llm_decisions(texts: list) -> tuple:
+    """Router LLM decision per prompt. Returns (actions, latencies in ms, fallback count)."""
+    actions, latencies, fallbacks = [], [], 0
+    for text in texts:
+        start = time.perf_counter()
+        decision = await rs.router_agent_decision(text)
+        latencies.append((time.perf_counter() - start) * 1000)
+        actions.append(decision.action)
+        if decision.decided_by == "fallback":
+            fallbacks += 1
+    return actions, latencies, fallbacks
+
+
+# ── Output ─────────────────────────────────────────────────────────────────
+
+def print_results(labels: list, engines: dict, llm_actions):
+    print()
+    print("=" * 90)
+    print(f"  ROUTER DECISION ENGINES  ({len(labels)} labeled prompts)")
+    print("=" * 90)
+    header = (
+        f"{'Engine':<12} │{'Accuracy':>9} {'vs LLM':>8} │"
+        f"{'p50':>9} {'p90':>9} {'p99':>9} │{'Fallback':>9}"
+    )
+    print(header)
+    print("─" * 90)
+    for name, (actions, latencies, fallbacks) in engines.items():
+        accuracy = sum(a == b for a, b in zip(actions, labels)) / len(labels) * 100
+        agreement = None
+        if llm_actions is not None and name != "llm":
+            agreement = sum(a == b for a, b in zip(actions, llm_actions)) / len(labels) * 100
+        print(
+            f"{name:<12} │{fmt(accuracy, '%', 1, 9)} {fmt(agreement, '%', 1, 8)} │"
+            f"{fmt(percentile(latencies, 50), 'ms', 1, 9)} {fmt(percentile(latencies, 90), 'ms', 1, 9)}"
+            f" {fmt(percentile(latencies, 99), 'ms', 1, 9)} │{fallbacks:>9}"
+        )
+    print("─" * 90)
+
+    print()
+    print("  Per-action accuracy")
+    for action in sorted(set(labels)):
+        idx = [i for i, label in enumerate(labels) if label == action]
+        cells = "  ".join(
+            f"{name}={sum(engines[name][0][i] == action for i in idx) / len(idx) * 100:.0f}%"
+            for name in engines
+        )
+        print(f"    {action:<18} n={len(idx):<4} {cells}")
+
+
+def print_mistakes(texts: list, labels: list, engines: dict):
+    print()
+    print("  Misrouted prompts")
+    for i, (text, label) in enumerate(zip(texts, labels)):
+        wrong = {name: result[0][i] for name, result in engines.items() if result[0][i] != label}
+        if wrong:
+            got = ", ".join(f"{name}={action}" for name, action in wrong.items())
+            print(f"    [{label}] {text[:60]!r} → {got}")
+
+
+def save_csv(filepath: str, texts: list, labels: list, engines: dict):
+    with open(filepath, "w", newline="") as f:
+        writer = csv.writer(f)
+        header = ["text", "label"]
+        for name in engines:
+            header += [f"{name}_action", f"{name}_ms"]
+        writer.writerow(header)
+        for i, (text, label) in enumerate(zip(texts, labels)):
+            row = [text, label]
+            for actions, latencies, _ in engines.values():
+                row += [actions[i], f"{latencies[i]:.2f}"]
+            writer.writerow(row)
+    print(f"\nResults saved to {filepath}")
+
+
+# ── Main ───────────────────────────────────────────────────────────────────
+
+async def async_main():
+    parser = argparse.ArgumentParser(description="Compare the router's embedding and LLM decision engines")
+    parser.add_argument("--examples", default=rs.ROUTING_EXAMPLES_FILE,
+                        help="Labeled JSONL prompts ({\"text\": ..., \"action\": ...})")
+    parser.add_argument("--decode-mode", default=rs.ROUTING_DECODE_MODE,
+                        choices=["freeform", "guided_json", "label"],
+                        help="ROUTING_DECODE_MODE for the LLM engine")
+    parser.add_argument("--no-llm", action="store_true", help="Only evaluate the embedding engine")
+    parser.add_argument("--csv", metavar="FILE", help="Save per-prompt decisions to CSV")
+    parser.add_argument("--verbose", action="store_true", help="List misrouted prompts")
+    args = parser.parse_args()
+
+    examples = rs.load_routing_examples(args.examples)
+    texts = [text for text, _ in examples]
+    labels = [action for _, action in examples]
+    print(f"  {len(examples)} labeled prompts from {args.examples}")
+    print(f"  Embedding: {rs.EMBEDDING_MODEL} @ {rs.EMBEDDING_URL}")
+    if not args.no_llm:
+        print(f"  Router LLM: {rs.ROUTER_MODEL} @ {rs.ROUTER_MODEL_URL} ({args.decode_mode})")
+    rs.ROUTING_DECODE_MODE = args.decode_mode
+
+    engines = {}
+    async with rs.lifespan(rs.app):
+        print("  Embedding prompts ...", flush=True)
+        vectors, embed_ms = await embed_examples(texts)
+        engines["embedding"] = (leave_one_out(vectors, labels), embed_ms, 0)
+
+        llm_actions = None
+        if not args.no_llm:
+            print("  Asking the router LLM ...", flush=True)
+            llm_actions, llm_ms, fallbacks = await llm_decisions(texts)
+            engines["llm"] = (llm_actions, llm_ms, fallbacks)
+
+    print_results(labels, engines, llm_actions)
+    if args.verbose:
+        print_mistakes(texts, labels, engines)
+    if args.csv:
+        save_csv(args.csv, texts, labels, engines)
+    print()
+
+
+def main():
+    asyncio.run(async_main())
+
+
+if __name__ == "__main__":
+    main()
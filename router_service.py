@@ -8,99 +8,2470 @@ Router Agent Service - LLM-powered routing agent that can:
 """
 
 import os
+import re
 import json
 import asyncio
 import time
+import math
+import random
+import socket
+import heapq
+import hashlib
+import itertools
 import aiohttp
-from fastapi import FastAPI, HTTPException
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import Literal, Optional
+from urllib.parse import urlsplit
 import logging
 
+try:
+    import numpy as np
+except ImportError:  # optional: only the semantic response cache needs it
+    np = None
+
+try:
+    from tokenizers import Tokenizer
+except ImportError:  # optional: context shaping falls back to a chars/4 estimate
+    Tokenizer = None
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Router Agent Service")
-
 # Configuration from environment
 ROUTER_MODEL_URL = os.getenv("ROUTER_MODEL_URL", "http://vllm-half-a:8000/v1/chat/completions")
 SIMPLE_AGENT_URL = os.getenv("SIMPLE_AGENT_URL", "http://vllm-half-a:8000/v1/chat/completions")
 SPECIALIST_AGENT_URL = os.getenv("SPECIALIST_AGENT_URL", "http://vllm-half-b:8000/v1/chat/completions")
+SIMPLE_AGENT_MODEL = os.getenv("SIMPLE_AGENT_MODEL", "Qwen/Qwen2.5-0.5B-Instruct")
+SPECIALIST_AGENT_MODEL = os.getenv("SPECIALIST_AGENT_MODEL", "Qwen/Qwen2.5-1.5B-Instruct")
 # Gemini API configuration - can be set via environment or secret
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
 GEMINI_SECRET_NAME = os.getenv("GEMINI_SECRET_NAME", "gemini-api-key")
 GEMINI_SECRET_KEY = os.getenv("GEMINI_SECRET_KEY", "api-key")
-GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent"
+GEMINI_API_URL = os.getenv("GEMINI_API_URL", "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent")
+GEMINI_STREAM_URL = GEMINI_API_URL.replace(":generateContent", ":streamGenerateContent")
+
+# Router model configuration
+ROUTER_MODEL = os.getenv("ROUTER_MODEL", "Qwen/Qwen2.5-0.5B-Instruct")
+
+# Upstream connection pool defaults. Each can be overridden per upstream with
+# the upstream's prefix, e.g. SPECIALIST_AGENT_POOL_LIMIT=32 or GEMINI_TIMEOUT_S=10.
+UPSTREAM_POOL_LIMIT = int(os.getenv("UPSTREAM_POOL_LIMIT", "64"))
+UPSTREAM_POOL_LIMIT_PER_HOST = int(os.getenv("UPSTREAM_POOL_LIMIT_PER_HOST", "0"))  # 0 = no per-host cap
+UPSTREAM_KEEPALIVE_S = float(os.getenv("UPSTREAM_KEEPALIVE_S", "60"))
+UPSTREAM_DNS_TTL_S = int(os.getenv("UPSTREAM_DNS_TTL_S", "300"))
+UPSTREAM_CONNECT_TIMEOUT_S = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT_S", "5"))
+UPSTREAM_TIMEOUT_S = float(os.getenv("UPSTREAM_TIMEOUT_S", "30"))
+
+# Admission control defaults, also overridable per upstream (e.g. SPECIALIST_AGENT_MAX_CONCURRENCY=8).
+# Requests beyond MAX_CONCURRENCY wait in a bounded queue; a full queue answers 429 and a
+# request still queued after QUEUE_TIMEOUT_S answers 503, both with Retry-After.
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "32"))  # 0 = unlimited
+UPSTREAM_MAX_QUEUE = int(os.getenv("UPSTREAM_MAX_QUEUE", "64"))
+UPSTREAM_QUEUE_TIMEOUT_S = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT_S", "5"))
+
+# Priority classes: each request is "interactive", "normal" or "batch" (ChatRequest.priority or
+# X-Priority) with a deadline (deadline_ms or X-Deadline-Ms, else the class default). Admission
+# queues serve higher classes first and earliest deadline first within a class; a full queue
+# sheds its lowest-class waiter for a higher-class arrival, and expired requests are refused.
+PRIORITY_TIERS = {"interactive": 0, "normal": 1, "batch": 2}
+DEFAULT_PRIORITY = os.getenv("DEFAULT_PRIORITY", "normal")
+PRIORITY_DEADLINE_S = {
+    name: float(os.getenv(f"PRIORITY_{name.upper()}_DEADLINE_S", default))
+    for name, default in (("interactive", "10"), ("normal", "30"), ("batch", "300"))
+}
+
+# Replica pools: an upstream URL may be a comma-separated list of endpoints, and with
+# RESOLVE_INTERVAL_S > 0 each endpoint's hostname (e.g. a headless Service) is re-resolved and
+# expanded to one replica per address. Calls go to the replica with the fewest outstanding
+# requests ("least_outstanding") or the better of two random picks by outstanding x latency
+# ("p2c"). Replicas failing active /health checks, or REPLICA_EJECT_FAILURES calls in a row,
+# are ejected until a health check passes. All overridable per upstream.
+REPLICA_BALANCING = os.getenv("REPLICA_BALANCING", "least_outstanding")
+REPLICA_RESOLVE_INTERVAL_S = float(os.getenv("REPLICA_RESOLVE_INTERVAL_S", "0"))  # 0 = use URLs as given
+REPLICA_HEALTH_INTERVAL_S = float(os.getenv("REPLICA_HEALTH_INTERVAL_S", "10"))  # 0 = no active checks
+REPLICA_EJECT_FAILURES = int(os.getenv("REPLICA_EJECT_FAILURES", "3"))
+REPLICA_EJECT_S = float(os.getenv("REPLICA_EJECT_S", "30"))
+
+# Circuit breakers: over the last BREAKER_WINDOW calls to an upstream, an error rate (errors and
+# calls slower than BREAKER_SLOW_CALL_S) of BREAKER_ERROR_RATE opens the breaker. Calls are then
+# refused instantly for BREAKER_OPEN_S, after which one half-open probe decides whether to close.
+BREAKER_ENABLED = os.getenv("BREAKER_ENABLED", "true").lower() in ("1", "true", "yes")
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "20"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "5"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_CALL_S = float(os.getenv("BREAKER_SLOW_CALL_S", "10"))
+BREAKER_OPEN_S = float(os.getenv("BREAKER_OPEN_S", "30"))
+
+# Hedged requests: if a non-streaming backend call has not answered by its recent HEDGE_QUANTILE
+# latency, send a duplicate to an alternate backend and keep whichever answers first
+HEDGED_REQUESTS = os.getenv("HEDGED_REQUESTS", "false").lower() in ("1", "true", "yes")
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", "0.95"))
+HEDGE_MIN_DELAY_S = float(os.getenv("HEDGE_MIN_DELAY_S", "0.05"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+
+# Load-aware routing: override decisions whose backend is saturated. An upstream counts as
+# saturated when its waiting requests (router queue + vLLM num_requests_waiting) reach
+# LOAD_MAX_WAITING, its KV cache usage reaches LOAD_MAX_KV_USAGE, or the estimated queueing
+# delay exceeds LOAD_QUEUE_SLO_S. All three are overridable per upstream prefix.
+LOAD_AWARE_ROUTING = os.getenv("LOAD_AWARE_ROUTING", "false").lower() in ("1", "true", "yes")
+LOAD_MAX_WAITING = int(os.getenv("LOAD_MAX_WAITING", "8"))
+LOAD_MAX_KV_USAGE = float(os.getenv("LOAD_MAX_KV_USAGE", "0.95"))
+LOAD_QUEUE_SLO_S = float(os.getenv("LOAD_QUEUE_SLO_S", "2"))
+LOAD_SCRAPE_INTERVAL_S = float(os.getenv("LOAD_SCRAPE_INTERVAL_S", "0"))  # 0 = don't scrape vLLM /metrics
+
+# Routing decision cache (0 entries disables it)
+ROUTING_CACHE_SIZE = int(os.getenv("ROUTING_CACHE_SIZE", "4096"))
+ROUTING_CACHE_TTL_S = float(os.getenv("ROUTING_CACHE_TTL_S", "600"))
+ROUTING_CACHE_HASH_KEYS = os.getenv("ROUTING_CACHE_HASH_KEYS", "false").lower() in ("1", "true", "yes")
+
+# Decision engine for prompts the rules and cache don't settle: "llm" (the router model generates
+# a decision) or "embedding" (nearest centroid of labeled example prompts in embedding space,
+# using a vLLM /v1/embeddings endpoint; the LLM still decides if the embedding call fails or the
+# top two actions are closer than EMBEDDING_MIN_MARGIN)
+ROUTING_ENGINE = os.getenv("ROUTING_ENGINE", "llm")
+EMBEDDING_URL = os.getenv("EMBEDDING_URL", "http://vllm-embed:8000/v1/embeddings")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "BAAI/bge-small-en-v1.5")
+ROUTING_EXAMPLES_FILE = os.getenv("ROUTING_EXAMPLES_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "routing_examples.jsonl"))
+EMBEDDING_MIN_MARGIN = float(os.getenv("EMBEDDING_MIN_MARGIN", "0"))
+
+# How the router LLM is asked for a decision: "freeform" (JSON described in the prompt, parsed
+# leniently), "guided_json" (vLLM guided decoding against the RoutingDecision schema) or "label"
+# (one guided_choice label in at most ROUTING_LABEL_MAX_TOKENS tokens, confidence from logprobs)
+ROUTING_DECODE_MODE = os.getenv("ROUTING_DECODE_MODE", "freeform")
+ROUTING_LABEL_MAX_TOKENS = int(os.getenv("ROUTING_LABEL_MAX_TOKENS", "2"))
+
+# Micro-batched routing decisions: hold router-LLM decisions for up to DECISION_BATCH_WINDOW_MS
+# (or DECISION_BATCH_MAX prompts) and send them as one /v1/completions call. 0 = no batching.
+DECISION_BATCH_WINDOW_MS = float(os.getenv("DECISION_BATCH_WINDOW_MS", "0"))
+DECISION_BATCH_MAX = int(os.getenv("DECISION_BATCH_MAX", "16"))
+
+# Single-flight: concurrent requests with identical messages, max_tokens, temperature, model and
+# stream flag share one routing decision and one backend call
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "false").lower() in ("1", "true", "yes")
+
+# Conversation affinity: pin the follow-up turns of a conversation to the backend that answered it,
+# so vLLM's prefix cache still holds the conversation's KV blocks
+SESSION_AFFINITY = os.getenv("SESSION_AFFINITY", "false").lower() in ("1", "true", "yes")
+SESSION_AFFINITY_TTL_S = float(os.getenv("SESSION_AFFINITY_TTL_S", "1800"))
+SESSION_AFFINITY_MAX = int(os.getenv("SESSION_AFFINITY_MAX", "10000"))
+
+# Context shaping: fit each request into the target backend's context window before dispatch,
+# by clamping max_tokens and dropping the oldest turns. MAX_MODEL_LEN matches vLLM's --max-model-len
+# (override per upstream, e.g. SPECIALIST_AGENT_MAX_MODEL_LEN)
+CONTEXT_SHAPING = os.getenv("CONTEXT_SHAPING", "false").lower() in ("1", "true", "yes")
+MAX_MODEL_LEN = int(os.getenv("MAX_MODEL_LEN", "2048"))
+CONTEXT_TOKENIZER = os.getenv("CONTEXT_TOKENIZER", "Qwen/Qwen2.5-0.5B-Instruct")  # HF Hub name or tokenizer.json path
+CONTEXT_MIN_COMPLETION_TOKENS = int(os.getenv("CONTEXT_MIN_COMPLETION_TOKENS", "64"))
+CONTEXT_TOKEN_CACHE_SIZE = int(os.getenv("CONTEXT_TOKEN_CACHE_SIZE", "4096"))
+
+# Semantic response cache: answers keyed by prompt embedding (via EMBEDDING_URL), served when a
+# new single-turn prompt is at least RESPONSE_CACHE_THRESHOLD cosine-similar. Needs numpy.
+# Requests with temperature > 0 (or unset) bypass it unless RESPONSE_CACHE_SAMPLED is set.
+# Streamed answers are stored once the stream completes.
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.95"))
+RESPONSE_CACHE_TTL_S = float(os.getenv("RESPONSE_CACHE_TTL_S", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "10000"))
+RESPONSE_CACHE_MAX_MB = float(os.getenv("RESPONSE_CACHE_MAX_MB", "64"))
+RESPONSE_CACHE_SAMPLED = os.getenv("RESPONSE_CACHE_SAMPLED", "false").lower() in ("1", "true", "yes")
+
+# Rule-based pre-classifier that answers obvious prompts without the router LLM
+ROUTER_RULES_FILE = os.getenv("ROUTER_RULES_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "router_rules.json"))
+ROUTER_RULES_ENABLED = os.getenv("ROUTER_RULES_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# Speculative dispatch: start the simple-agent answer while the router LLM decides
+SPECULATIVE_DISPATCH = os.getenv("SPECULATIVE_DISPATCH", "false").lower() in ("1", "true", "yes")
+
+
+def base_url(url: str) -> str:
+    """'http://vllm-half-a:8000/v1/chat/completions' -> 'http://vllm-half-a:8000'"""
+    return url.split("/v1/", 1)[0]
+
+
+def upstream_setting(prefix: str, name: str, default, cast=int):
+    """Read a per-upstream override such as SIMPLE_AGENT_POOL_LIMIT, else the global default."""
+    value = os.getenv(f"{prefix}_{name}")
+    if value is None or value == "":
+        return default
+    return cast(value)
+
+
+# (priority class, absolute monotonic deadline or None) of the request being served. Set per
+# request in chat_completions; tasks spawned for it (speculation, hedges) inherit it.
+request_class: ContextVar[tuple] = ContextVar("request_class", default=(DEFAULT_PRIORITY, None))
+
+
+class AdmissionGate:
+    """
+    Concurrency limit with a bounded wait queue and a queue-time limit. Waiters are ordered by
+    priority class, then earliest deadline; slots are handed directly from a releasing request
+    to the first waiter. A full queue sheds its lowest-class waiter to admit a higher class.
+    """
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int, queue_timeout_s: float):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout_s = queue_timeout_s
+        self.active = 0
+        # Heap of (tier, deadline, sequence, future)
+        self._waiters = []
+        self._sequence = itertools.count()
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.rejected_deadline = 0
+        self.shed = 0
+        self.wait_s_total = 0.0
+        # Average time a request holds a slot, used to size Retry-After
+        self.hold_avg_s = 1.0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def retry_after_s(self) -> int:
+        if self.max_concurrency <= 0:
+            return 1
+        return max(1, math.ceil((len(self._waiters) + 1) * self.hold_avg_s / self.max_concurrency))
+
+    def _reject(self, status_code: int, detail: str):
+        raise HTTPException(status_code=status_code, detail=detail,
+                            headers={"Retry-After": str(self.retry_after_s())})
+
+    def _remove(self, entry: tuple) -> bool:
+        try:
+            self._waiters.remove(entry)
+        except ValueError:
+            return False
+        heapq.heapify(self._waiters)
+        return True
+
+    def _shed(self, entry: tuple):
+        """Refuse a queued waiter to make room for a higher-priority arrival"""
+        self._remove(entry)
+        self.shed += 1
+        ADMISSION_REJECTIONS.labels(self.name, "shed").inc()
+        entry[3].set_exception(HTTPException(
+            status_code=503, detail=f"{self.name} is overloaded: shed for higher-priority work",
+            headers={"Retry-After": str(self.retry_after_s())}))
+
+    async def acquire(self):
+        priority, deadline = request_class.get()
+        tier = PRIORITY_TIERS[priority]
+        now = time.monotonic()
+        if deadline is None:
+            deadline = now + PRIORITY_DEADLINE_S[priority]
+        if now >= deadline:
+            self.rejected_deadline += 1
+            ADMISSION_REJECTIONS.labels(self.name, "deadline").inc()
+            raise HTTPException(status_code=504, detail=f"{self.name}: request deadline passed before admission")
+        if self.max_concurrency <= 0 or (self.active < self.max_concurrency and not self._waiters):
+            self.active += 1
+            self.admitted += 1
+            ADMISSION_WAIT_SECONDS.observe(0.0, self.name)
+            return
+        if len(self._waiters) >= self.max_queue:
+            worst = max(self._waiters) if self._waiters else None
+            if worst is None or worst[0] <= tier:
+                self.rejected_queue_full += 1
+                ADMISSION_REJECTIONS.labels(self.name, "queue_full").inc()
+                self._reject(429, f"{self.name} is overloaded: queue full")
+            self._shed(worst)
+
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (tier, deadline, next(self._sequence), waiter)
+        heapq.heappush(self._waiters, entry)
+        start = time.perf_counter()
+        timeout_s = min(self.queue_timeout_s, deadline - now)
+        try:
+            await asyncio.wait_for(waiter, timeout_s)
+        except asyncio.TimeoutError:
+            if timeout_s < self.queue_timeout_s:
+                self.rejected_deadline += 1
+                ADMISSION_REJECTIONS.labels(self.name, "deadline").inc()
+                raise HTTPException(status_code=504, detail=f"{self.name}: request deadline passed while queued")
+            self.rejected_timeout += 1
+            ADMISSION_REJECTIONS.labels(self.name, "queue_timeout").inc()
+            self._reject(503, f"{self.name} is overloaded: queued longer than {self.queue_timeout_s}s")
+        except HTTPException:
+            # Shed from the queue
+            raise
+        except BaseException:
+            # Cancelled (e.g. client went away) just after being handed a slot: pass it on
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                self.release()
+            raise
+        finally:
+            if not waiter.done() or waiter.cancelled():
+                self._remove(entry)
+        waited = time.perf_counter() - start
+        self.admitted += 1
+        self.wait_s_total += waited
+        ADMISSION_WAIT_SECONDS.observe(waited, self.name)
+
+    def release(self, held_s: Optional[float] = None):
+        if held_s is not None:
+            self.hold_avg_s += 0.1 * (held_s - self.hold_avg_s)
+        while self._waiters:
+            waiter = heapq.heappop(self._waiters)[3]
+            if not waiter.done():
+                # Hand the slot straight to the next waiter; active count is unchanged
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "active": self.active,
+            "queue_depth": self.queue_depth,
+            "max_queue": self.max_queue,
+            "queue_timeout_s": self.queue_timeout_s,
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+            "rejected_deadline": self.rejected_deadline,
+            "shed": self.shed,
+            "queued_by_priority": {
+                name: sum(1 for entry in self._waiters if entry[0] == tier) for name, tier in PRIORITY_TIERS.items()
+            },
+            "avg_wait_ms": round(self.wait_s_total / self.admitted * 1000, 2) if self.admitted else 0.0,
+        }
+
+
+class CircuitBreaker:
+    """
+    Closed / open / half-open breaker over a sliding window of call outcomes.
+    A call fails if it errored or took longer than slow_call_s.
+    """
+
+    def __init__(self, name: str, window: int, min_calls: int, error_rate: float,
+                 slow_call_s: float, open_s: float):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_s = slow_call_s
+        self.open_s = open_s
+        self.state = "closed"
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probing = False
+        # Start time of the half-open probe in flight, which identifies its call in UpstreamPool.end
+        self.probe_started: Optional[float] = None
+        self.opened_total = 0
+        self.rejected = 0
+
+    def _transition(self, state: str):
+        if state != self.state:
+            logger.warning(f"Circuit breaker {self.name}: {self.state} -> {state}")
+            self.state = state
+            BREAKER_TRANSITIONS.labels(self.name, state).inc()
+
+    def retry_after_s(self) -> int:
+        return max(1, math.ceil(self._opened_at + self.open_s - time.monotonic()))
+
+    def allow(self) -> bool:
+        """Whether a call may go out now. In half-open state only one probe is let through."""
+        if not BREAKER_ENABLED or self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() - self._opened_at < self.open_s:
+                self.rejected += 1
+                return False
+            self._transition("half_open")
+        if self._probing:
+            self.rejected += 1
+            return False
+        self._probing = True
+        return True
+
+    def abandon(self):
+        """The probe ended without an outcome (rejected by admission control, cancelled, discarded)"""
+        self._probing = False
+        self.probe_started = None
+
+    def is_open(self) -> bool:
+        """Open and still cooling down (a call now would be refused)"""
+        return BREAKER_ENABLED and self.state == "open" and time.monotonic() - self._opened_at < self.open_s
+
+    def record(self, ok: bool, elapsed_s: float):
+        failed = not ok or elapsed_s > self.slow_call_s
+        if self.state == "half_open":
+            self._probing = False
+            self.probe_started = None
+            if failed:
+                self._open()
+            else:
+                self._outcomes.clear()
+                self._transition("closed")
+            return
+        self._outcomes.append(failed)
+        if self.state == "closed" and len(self._outcomes) >= self.min_calls:
+            if sum(self._outcomes) / len(self._outcomes) >= self.error_rate:
+                self._open()
+
+    def _open(self):
+        self._opened_at = time.monotonic()
+        self.opened_total += 1
+        self._transition("open")
+
+    def stats(self) -> dict:
+        return {
+            "enabled": BREAKER_ENABLED,
+            "state": self.state,
+            "window_calls": len(self._outcomes),
+            "window_failures": sum(self._outcomes),
+            "opened_total": self.opened_total,
+            "rejected": self.rejected,
+            "retry_after_s": self.retry_after_s() if self.state == "open" else None,
+        }
+
+
+class Replica:
+    """One endpoint of an upstream, with the signals used to balance and eject it"""
+
+    def __init__(self, url: str, source: Optional[str] = None):
+        self.url = url
+        # The configured URL this replica was resolved from
+        self.source = source or url
+        self.outstanding = 0
+        self.requests_total = 0
+        self.latency_avg_s = None
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self.vllm_load = {}
+
+    def available(self, now: float) -> bool:
+        return self.healthy and now >= self.ejected_until
+
+    def score(self) -> float:
+        """Expected wait: outstanding calls times recent latency (unknown latency counts as fast)"""
+        return (self.outstanding + 1) * (self.latency_avg_s or 0.001)
+
+    def eject(self, upstream: str, reason: str, duration_s: float):
+        if self.available(time.monotonic()):
+            self.ejections += 1
+            REPLICA_EJECTIONS.labels(upstream, reason).inc()
+            logger.warning(f"Ejecting {upstream} replica {self.url} ({reason})")
+        self.ejected_until = time.monotonic() + duration_s
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "available": self.available(time.monotonic()),
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "requests_total": self.requests_total,
+            "latency_avg_ms": round(self.latency_avg_s * 1000, 1) if self.latency_avg_s is not None else None,
+            "consecutive_failures": self.consecutive_failures,
+            "ejections": self.ejections,
+        }
+
+
+class UpstreamPool:
+    """
+    One long-lived aiohttp session per upstream, with its own keep-alive pool,
+    connection limits, DNS cache and timeouts. Sessions are opened in the app
+    lifespan hook so every request reuses warm connections.
+    """
+
+    def __init__(self, name: str, url: str, model: Optional[str], env_prefix: str):
+        self.name = name
+        # Configured endpoints; url is the first, for callers that need a single address
+        self.urls = [u.strip() for u in url.split(",") if u.strip()] or [url]
+        self.url = self.urls[0]
+        self.model = model
+        self.replicas = [Replica(u) for u in self.urls]
+        self.balancing = upstream_setting(env_prefix, "BALANCING", REPLICA_BALANCING, str)
+        self.resolve_interval_s = upstream_setting(env_prefix, "RESOLVE_INTERVAL_S", REPLICA_RESOLVE_INTERVAL_S, float)
+        self.health_interval_s = upstream_setting(env_prefix, "HEALTH_INTERVAL_S", REPLICA_HEALTH_INTERVAL_S, float)
+        self.eject_failures = upstream_setting(env_prefix, "EJECT_FAILURES", REPLICA_EJECT_FAILURES)
+        self.eject_s = upstream_setting(env_prefix, "EJECT_S", REPLICA_EJECT_S, float)
+        self.limit = upstream_setting(env_prefix, "POOL_LIMIT", UPSTREAM_POOL_LIMIT)
+        self.limit_per_host = upstream_setting(env_prefix, "POOL_LIMIT_PER_HOST", UPSTREAM_POOL_LIMIT_PER_HOST)
+        self.keepalive_s = upstream_setting(env_prefix, "KEEPALIVE_S", UPSTREAM_KEEPALIVE_S, float)
+        self.dns_ttl_s = upstream_setting(env_prefix, "DNS_TTL_S", UPSTREAM_DNS_TTL_S)
+        self.connect_timeout_s = upstream_setting(env_prefix, "CONNECT_TIMEOUT_S", UPSTREAM_CONNECT_TIMEOUT_S, float)
+        self.timeout_s = upstream_setting(env_prefix, "TIMEOUT_S", UPSTREAM_TIMEOUT_S, float)
+        self.gate = AdmissionGate(
+            name,
+            upstream_setting(env_prefix, "MAX_CONCURRENCY", UPSTREAM_MAX_CONCURRENCY),
+            upstream_setting(env_prefix, "MAX_QUEUE", UPSTREAM_MAX_QUEUE),
+            upstream_setting(env_prefix, "QUEUE_TIMEOUT_S", UPSTREAM_QUEUE_TIMEOUT_S, float),
+        )
+        self.breaker = CircuitBreaker(
+            name,
+            upstream_setting(env_prefix, "BREAKER_WINDOW", BREAKER_WINDOW),
+            upstream_setting(env_prefix, "BREAKER_MIN_CALLS", BREAKER_MIN_CALLS),
+            upstream_setting(env_prefix, "BREAKER_ERROR_RATE", BREAKER_ERROR_RATE, float),
+            upstream_setting(env_prefix, "BREAKER_SLOW_CALL_S", BREAKER_SLOW_CALL_S, float),
+            upstream_setting(env_prefix, "BREAKER_OPEN_S", BREAKER_OPEN_S, float),
+        )
+        # Latencies of recent successful non-streaming calls, for the hedge delay
+        self.recent_latencies = deque(maxlen=256)
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.in_flight = 0
+        self.requests_total = 0
+        self.prompt_tokens_total = 0
+        self.completion_tokens_total = 0
+        # Load signals: recent call latency, plus vLLM's own gauges when scraping is enabled
+        self.latency_avg_s = None
+        self.load_max_waiting = upstream_setting(env_prefix, "LOAD_MAX_WAITING", LOAD_MAX_WAITING)
+        self.load_max_kv_usage = upstream_setting(env_prefix, "LOAD_MAX_KV_USAGE", LOAD_MAX_KV_USAGE, float)
+        self.load_queue_slo_s = upstream_setting(env_prefix, "LOAD_QUEUE_SLO_S", LOAD_QUEUE_SLO_S, float)
+        self.max_model_len = upstream_setting(env_prefix, "MAX_MODEL_LEN", MAX_MODEL_LEN)
+        self.vllm_waiting = 0.0
+        self.vllm_running = 0.0
+        self.vllm_kv_usage = None
+        self.vllm_scraped_at = None
+
+    def pick(self) -> Replica:
+        """Choose the replica for one call; if every replica is ejected, fall back to all of them"""
+        if len(self.replicas) == 1:
+            return self.replicas[0]
+        now = time.monotonic()
+        candidates = [r for r in self.replicas if r.available(now)] or self.replicas
+        if self.balancing == "p2c" and len(candidates) > 2:
+            return min(random.sample(candidates, 2), key=Replica.score)
+        if self.balancing == "p2c":
+            return min(candidates, key=Replica.score)
+        # Least outstanding; random among ties so idle replicas share the load
+        fewest = min(r.outstanding for r in candidates)
+        return random.choice([r for r in candidates if r.outstanding == fewest])
+
+    def base_urls(self) -> set:
+        return {base_url(r.url) for r in self.replicas}
+
+    async def begin(self):
+        """
+        Admit one call (may queue or raise 429/503), pick its replica and count it in flight.
+        Returns (start time, replica). An open circuit breaker refuses the call with 503 before
+        it is queued.
+        """
+        if not self.breaker.allow():
+            BREAKER_REJECTIONS.labels(self.name).inc()
+            raise HTTPException(status_code=503, detail=f"{self.name} circuit breaker is open",
+                                headers={"Retry-After": str(self.breaker.retry_after_s())})
+        # In half-open state the only call let through is the probe
+        probe = self.breaker.state == "half_open"
+        try:
+            await self.gate.acquire()
+        except BaseException:
+            if probe:
+                self.breaker.abandon()
+            raise
+        replica = self.pick()
+        replica.outstanding += 1
+        replica.requests_total += 1
+        self.in_flight += 1
+        self.requests_total += 1
+        started = time.perf_counter()
+        if probe:
+            self.breaker.probe_started = started
+        return started, replica
+
+    def end(self, started: float, replica: Replica, ok: Optional[bool] = None):
+        """
+        Release the call's slot. ok feeds the circuit breaker and the replica's failure count:
+        True for an answer, False for an upstream failure, None when the outcome says nothing
+        about the upstream (cancelled, or a stream whose outcome was recorded when it opened).
+        """
+        elapsed = time.perf_counter() - started
+        self.in_flight -= 1
+        replica.outstanding -= 1
+        self.gate.release(elapsed)
+        if ok is not None:
+            self.breaker.record(ok, elapsed)
+            if ok:
+                self.recent_latencies.append(elapsed)
+                replica.consecutive_failures = 0
+            else:
+                replica.consecutive_failures += 1
+                if len(self.replicas) > 1 and replica.consecutive_failures >= self.eject_failures:
+                    replica.eject(self.name, "failures", self.eject_s)
+        elif started == self.breaker.probe_started:
+            # A cancelled or discarded probe says nothing about the upstream; let the next call probe.
+            # Calls admitted before the breaker opened may end now too; they must not free the probe slot.
+            self.breaker.abandon()
+        if self.latency_avg_s is None:
+            self.latency_avg_s = elapsed
+        else:
+            self.latency_avg_s += 0.1 * (elapsed - self.latency_avg_s)
+        if replica.latency_avg_s is None:
+            replica.latency_avg_s = elapsed
+        else:
+            replica.latency_avg_s += 0.1 * (elapsed - replica.latency_avg_s)
+
+    async def resolve_replicas(self):
+        """Re-resolve each configured URL's hostname and keep one replica per address"""
+        loop = asyncio.get_running_loop()
+        known = {r.url: r for r in self.replicas}
+        replicas = []
+        for url in self.urls:
+            parts = urlsplit(url)
+            port = parts.port or (443 if parts.scheme == "https" else 80)
+            try:
+                infos = await loop.getaddrinfo(parts.hostname, port, type=socket.SOCK_STREAM)
+            except OSError as e:
+                logger.warning(f"Resolving {parts.hostname} for {self.name} failed: {e}")
+                replicas.extend(r for r in self.replicas if r.source == url)
+                continue
+            for address in sorted({info[4][0] for info in infos}):
+                host = f"[{address}]" if ":" in address else address
+                resolved = parts._replace(netloc=f"{host}:{parts.port}" if parts.port else host).geturl()
+                replicas.append(known.get(resolved) or Replica(resolved, url))
+        if replicas and {r.url for r in replicas} != set(known):
+            logger.info(f"{self.name} replicas: " + ", ".join(r.url for r in replicas))
+            self.replicas = replicas
+
+    async def check_health(self):
+        """Probe each replica's /health: failures eject it, a pass readmits it"""
+        for replica in list(self.replicas):
+            try:
+                async with self.session.get(base_url(replica.url) + "/health",
+                                            timeout=aiohttp.ClientTimeout(total=2)) as resp:
+                    healthy = resp.status == 200
+            except Exception:
+                healthy = False
+            if healthy:
+                replica.healthy = True
+                replica.consecutive_failures = 0
+                replica.ejected_until = 0.0
+            else:
+                if len(self.replicas) > 1:
+                    replica.eject(self.name, "health", self.health_interval_s)
+                replica.healthy = False
+
+    async def maintain_replicas(self):
+        """Background task: re-resolve and health-check the replica set on their intervals"""
+        next_resolve = next_health = 0.0
+        while True:
+            now = time.monotonic()
+            if self.resolve_interval_s > 0 and now >= next_resolve:
+                await self.resolve_replicas()
+                next_resolve = now + self.resolve_interval_s
+            if self.health_interval_s > 0 and len(self.replicas) > 1 and now >= next_health:
+                await self.check_health()
+                next_health = now + self.health_interval_s
+            intervals = [i for i in (self.resolve_interval_s, self.health_interval_s) if i > 0]
+            await asyncio.sleep(min(intervals))
+
+    def saturation(self) -> Optional[str]:
+        """Why this upstream is saturated, or None if it can take more work"""
+        waiting = self.gate.queue_depth + self.vllm_waiting
+        if waiting >= self.load_max_waiting:
+            return f"{self.name} has {waiting:.0f} requests waiting (limit {self.load_max_waiting})"
+        if self.vllm_kv_usage is not None and self.vllm_kv_usage >= self.load_max_kv_usage:
+            return f"{self.name} KV cache {self.vllm_kv_usage:.0%} full"
+        if self.latency_avg_s is not None and waiting:
+            # Work ahead of a new request drains at roughly concurrency / latency per second
+            slots = max(1, self.gate.max_concurrency or self.in_flight or 1)
+            expected_wait_s = waiting * self.latency_avg_s / slots
+            if expected_wait_s > self.load_queue_slo_s:
+                return f"{self.name} expected queueing {expected_wait_s:.1f}s exceeds SLO {self.load_queue_slo_s}s"
+        return None
+
+    def load(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": self.gate.queue_depth,
+            "latency_avg_ms": round(self.latency_avg_s * 1000, 1) if self.latency_avg_s is not None else None,
+            "vllm_waiting": self.vllm_waiting,
+            "vllm_running": self.vllm_running,
+            "vllm_kv_usage": self.vllm_kv_usage,
+            "vllm_scraped_age_s": round(time.monotonic() - self.vllm_scraped_at, 1) if self.vllm_scraped_at else None,
+            "saturated": self.saturation(),
+        }
+
+    def hedge_delay_s(self) -> Optional[float]:
+        """HEDGE_QUANTILE of recent call latency, or None until there are enough samples"""
+        if len(self.recent_latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.recent_latencies)
+        return max(HEDGE_MIN_DELAY_S, ordered[min(len(ordered) - 1, int(HEDGE_QUANTILE * len(ordered)))])
+
+    def record_usage(self, usage: dict):
+        self.prompt_tokens_total += usage.get("prompt_tokens", 0)
+        self.completion_tokens_total += usage.get("completion_tokens", 0)
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_s,
+            ttl_dns_cache=self.dns_ttl_s,
+            use_dns_cache=True,
+        )
+        timeout = aiohttp.ClientTimeout(total=self.timeout_s, connect=self.connect_timeout_s)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def stats(self) -> dict:
+        """Pool occupancy. aiohttp has no public accessor, so peek at the connector internals."""
+        connector = self.session.connector if self.session is not None else None
+        acquired = len(getattr(connector, "_acquired", ()))
+        idle = sum(len(conns) for conns in getattr(connector, "_conns", {}).values())
+        return {
+            "in_flight": self.in_flight,
+            "requests_total": self.requests_total,
+            "connections_in_use": acquired,
+            "connections_idle": idle,
+            "limit": self.limit,
+            "limit_per_host": self.limit_per_host,
+            # Approximate: in-flight calls not holding a socket are queued inside aiohttp
+            "waiting_for_connection": max(0, self.in_flight - acquired),
+            "timeout_s": self.timeout_s,
+            "prompt_tokens_total": self.prompt_tokens_total,
+            "completion_tokens_total": self.completion_tokens_total,
+            "admission": self.gate.stats(),
+            "breaker": self.breaker.stats(),
+            "load": self.load(),
+            "balancing": self.balancing,
+            "replicas": [r.stats() for r in self.replicas],
+        }
+
+
+UPSTREAMS = {
+    "router": UpstreamPool("router", ROUTER_MODEL_URL, ROUTER_MODEL, "ROUTER_MODEL"),
+    "simple": UpstreamPool("simple", SIMPLE_AGENT_URL, SIMPLE_AGENT_MODEL, "SIMPLE_AGENT"),
+    "specialist": UpstreamPool("specialist", SPECIALIST_AGENT_URL, SPECIALIST_AGENT_MODEL, "SPECIALIST_AGENT"),
+    "gemini": UpstreamPool("gemini", GEMINI_API_URL, None, "GEMINI"),
+    "embedding": UpstreamPool("embedding", EMBEDDING_URL, EMBEDDING_MODEL, "EMBEDDING"),
+}
+
+
+VLLM_LOAD_GAUGES = {
+    "vllm:num_requests_waiting": "vllm_waiting",
+    "vllm:num_requests_running": "vllm_running",
+    "vllm:gpu_cache_usage_perc": "vllm_kv_usage",
+    "vllm:kv_cache_usage_perc": "vllm_kv_usage",
+}
+
+
+def parse_vllm_load(text: str) -> dict:
+    """Sum the vLLM load gauges we care about out of a Prometheus text payload"""
+    values = {}
+    for line in text.splitlines():
+        if not line.startswith("vllm:"):
+            continue
+        attr = VLLM_LOAD_GAUGES.get(line.split("{", 1)[0].split(" ", 1)[0])
+        if attr is None:
+            continue
+        try:
+            value = float(line.rsplit(" ", 1)[1])
+        except ValueError:
+            continue
+        values[attr] = values.get(attr, 0.0) + value
+    return values
+
+
+async def scrape_vllm_load():
+    """
+    Background task: poll each vLLM pod's /metrics and attach the load gauges to the replicas
+    served by it. An upstream's load is its replicas' queues summed and KV usage averaged.
+    """
+    while True:
+        by_url = {}
+        for pool in UPSTREAMS.values():
+            if pool.model is not None:
+                for replica in pool.replicas:
+                    by_url.setdefault(base_url(replica.url) + "/metrics", (pool.session, []))[1].append(replica)
+        for url, (session, replicas) in by_url.items():
+            try:
+                async with session.get(url, timeout=aiohttp.ClientTimeout(total=2)) as resp:
+                    values = parse_vllm_load(await resp.text()) if resp.status == 200 else None
+            except Exception as e:
+                logger.debug(f"vLLM metrics scrape of {url} failed: {e}")
+                values = None
+            if values is not None:
+                for replica in replicas:
+                    replica.vllm_load = values
+        for pool in UPSTREAMS.values():
+            loads = [r.vllm_load for r in pool.replicas if r.vllm_load]
+            if not loads:
+                continue
+            pool.vllm_waiting = sum(load.get("vllm_waiting", 0.0) for load in loads)
+            pool.vllm_running = sum(load.get("vllm_running", 0.0) for load in loads)
+            kv = [load["vllm_kv_usage"] for load in loads if "vllm_kv_usage" in load]
+            pool.vllm_kv_usage = sum(kv) / len(kv) if kv else None
+            pool.vllm_scraped_at = time.monotonic()
+        await asyncio.sleep(LOAD_SCRAPE_INTERVAL_S)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    for pool in UPSTREAMS.values():
+        await pool.start()
+    logger.info("Upstream pools ready: " + ", ".join(
+        f"{p.name}(limit={p.limit}, timeout={p.timeout_s}s)" for p in UPSTREAMS.values()))
+    if CONTEXT_SHAPING:
+        await asyncio.to_thread(token_counter.load, CONTEXT_TOKENIZER)
+    background = []
+    if LOAD_SCRAPE_INTERVAL_S > 0:
+        background.append(asyncio.create_task(scrape_vllm_load()))
+    for pool in UPSTREAMS.values():
+        if pool.model is not None and (pool.resolve_interval_s > 0 or
+                                       (pool.health_interval_s > 0 and len(pool.urls) > 1)):
+            background.append(asyncio.create_task(pool.maintain_replicas()))
+    try:
+        yield
+    finally:
+        for task in background:
+            task.cancel()
+        for pool in UPSTREAMS.values():
+            await pool.close()
+
+
+app = FastAPI(title="Router Agent Service", lifespan=lifespan)
+
+
+class ChatRequest(BaseModel):
+    messages: list
+    model: Optional[str] = None
+    max_tokens: Optional[int] = 200
+    temperature: Optional[float] = 0.7
+    stream: Optional[bool] = False
+    # Conversation affinity: an explicit session id (also read from X-Session-ID), and a
+    # per-request switch overriding SESSION_AFFINITY
+    session_id: Optional[str] = None
+    session_affinity: Optional[bool] = None
+    # Scheduling class ("interactive", "normal", "batch"; also X-Priority) and the client's
+    # deadline in ms from arrival (also X-Deadline-Ms); defaults come from the class
+    priority: Optional[str] = None
+    deadline_ms: Optional[float] = None
+
+
+class RoutingDecision(BaseModel):
+    action: Literal["route_simple", "route_specialist", "answer_self", "route_gemini"]
+    reason: str
+    confidence: Optional[float] = None
+    decided_by: str = "llm"
+    # Tokens spent by the router LLM on this decision (None when no LLM call was made)
+    usage: Optional[dict] = None
+    # Set when load-aware routing replaced the decided action: {"original_action", "reason"}
+    override: Optional[dict] = None
+
+
+def make_usage(prompt_tokens: int = 0, completion_tokens: int = 0) -> dict:
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def gemini_usage(metadata: dict) -> dict:
+    """Map Gemini usageMetadata onto OpenAI usage fields"""
+    usage = make_usage(metadata.get("promptTokenCount", 0), metadata.get("candidatesTokenCount", 0))
+    usage["total_tokens"] = metadata.get("totalTokenCount", usage["total_tokens"])
+    return usage
+
+
+def normalize_prompt(text: str) -> str:
+    """Fold case and collapse whitespace so trivially different prompts share a cache key"""
+    return " ".join(text.casefold().split())
+
+
+class RoutingCache:
+    """
+    In-process LRU + TTL cache of routing decisions keyed on the normalized user message.
+    Keys can be stored as SHA-256 digests to bound memory for long prompts.
+    """
+
+    def __init__(self, capacity: int, ttl_s: float, hash_keys: bool = False):
+        self.capacity = capacity
+        self.ttl_s = ttl_s
+        self.hash_keys = hash_keys
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def key(self, user_message: str) -> str:
+        normalized = normalize_prompt(user_message)
+        if self.hash_keys:
+            return hashlib.sha256(normalized.encode()).hexdigest()
+        return normalized
+
+    def get(self, user_message: str) -> Optional[RoutingDecision]:
+        if self.capacity <= 0:
+            return None
+        key = self.key(user_message)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, decision = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return decision.model_copy(update={"decided_by": "cache", "usage": None})
+
+    def put(self, user_message: str, decision: RoutingDecision):
+        if self.capacity <= 0:
+            return
+        key = self.key(user_message)
+        self._entries[key] = (time.monotonic() + self.ttl_s, decision)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "capacity": self.capacity,
+            "ttl_s": self.ttl_s,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+routing_cache = RoutingCache(ROUTING_CACHE_SIZE, ROUTING_CACHE_TTL_S, ROUTING_CACHE_HASH_KEYS)
+
+
+class SessionAffinity:
+    """
+    LRU + TTL map from a conversation to the action that last served it. A conversation is
+    identified by its session id, or else by its opening (the messages up to and including
+    the first user message), which every later turn of the same conversation repeats.
+    """
+
+    def __init__(self, capacity: int, ttl_s: float):
+        self.capacity = capacity
+        self.ttl_s = ttl_s
+        self._pins: "OrderedDict[str, tuple]" = OrderedDict()
+        self.pinned = 0
+        self.escalated = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def key(request: ChatRequest) -> Optional[str]:
+        """The conversation's key, or None when affinity is off for this request"""
+        enabled = SESSION_AFFINITY if request.session_affinity is None else request.session_affinity
+        if not enabled or SESSION_AFFINITY_MAX <= 0:
+            return None
+        if request.session_id:
+            return "session:" + request.session_id
+        opening = []
+        for message in request.messages:
+            opening.append(message)
+            if message.get("role") == "user":
+                break
+        return hashlib.sha256(json.dumps(opening, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, request: ChatRequest, key: str) -> Optional[str]:
+        """Pinned action for a follow-up turn; first turns are neither looked up nor counted"""
+        if not request.session_id and not any(m.get("role") == "assistant" for m in request.messages):
+            return None
+        entry = self._pins.get(key)
+        if entry is not None and time.monotonic() >= entry[0]:
+            del self._pins[key]
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._pins.move_to_end(key)
+        return entry[1]
+
+    def pin(self, key: str, action: str):
+        # Gemini keeps no KV cache for us, so a Gemini turn leaves the existing pin alone
+        if action == "route_gemini":
+            return
+        self._pins[key] = (time.monotonic() + self.ttl_s, action)
+        self._pins.move_to_end(key)
+        while len(self._pins) > self.capacity:
+            self._pins.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        follow_ups = self.pinned + self.escalated + self.misses
+        return {
+            "enabled": SESSION_AFFINITY,
+            "sessions": len(self._pins),
+            "capacity": self.capacity,
+            "ttl_s": self.ttl_s,
+            "follow_ups": follow_ups,
+            "pinned": self.pinned,
+            "escalated": self.escalated,
+            "misses": self.misses,
+            "hit_rate": round(self.pinned / follow_ups, 4) if follow_ups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+session_affinity = SessionAffinity(SESSION_AFFINITY_MAX, SESSION_AFFINITY_TTL_S)
+
+
+# ChatML framing per message (<|im_start|>role\n ... <|im_end|>\n), and the assistant header
+CHATML_MESSAGE_TOKENS = 4
+CHATML_REPLY_TOKENS = 3
+
+
+class TokenCounter:
+    """
+    Prompt token counts for context shaping: the Qwen tokenizer when the optional `tokenizers`
+    package can load it, else a chars/4 estimate. Counts are cached per message text, since
+    every turn of a conversation resends the earlier ones.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.tokenizer = None
+        self._counts: "OrderedDict[str, int]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, name: str):
+        if Tokenizer is None:
+            logger.info("tokenizers not installed, estimating prompt tokens as chars/4")
+            return
+        try:
+            self.tokenizer = Tokenizer.from_file(name) if os.path.isfile(name) else Tokenizer.from_pretrained(name)
+            logger.info(f"Context shaping tokenizer: {name}")
+        except Exception as e:
+            logger.warning(f"Could not load tokenizer {name} ({e}), estimating prompt tokens as chars/4")
+
+    def count(self, text: str) -> int:
+        key = hashlib.sha256(text.encode()).digest() if len(text) > 64 else text
+        count = self._counts.get(key)
+        if count is not None:
+            self._counts.move_to_end(key)
+            self.hits += 1
+            return count
+        self.misses += 1
+        if self.tokenizer is not None:
+            count = len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+        else:
+            count = (len(text) + 3) // 4
+        if self.capacity > 0:
+            self._counts[key] = count
+            while len(self._counts) > self.capacity:
+                self._counts.popitem(last=False)
+        return count
+
+    def prompt_tokens(self, messages: list) -> int:
+        total = CHATML_REPLY_TOKENS
+        for message in messages:
+            content = message.get("content") or ""
+            if not isinstance(content, str):
+                content = json.dumps(content)
+            total += self.count(content) + CHATML_MESSAGE_TOKENS
+        return total
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "tokenizer": CONTEXT_TOKENIZER if self.tokenizer is not None else "chars/4",
+            "cached_counts": len(self._counts),
+            "cache_hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+token_counter = TokenCounter(CONTEXT_TOKEN_CACHE_SIZE)
+
+
+class ContextShapingStats:
+    """Shaping outcomes (trimmed / clamped / rejected) per upstream"""
+
+    def __init__(self):
+        self.outcomes = {}
+        self.dropped_messages = 0
+
+    def record(self, upstream: str, outcome: str, dropped: int = 0):
+        self.outcomes[(upstream, outcome)] = self.outcomes.get((upstream, outcome), 0) + 1
+        self.dropped_messages += dropped
+
+    def record_all(self, outcomes: list):
+        """Record outcomes a shape_request call deferred, once its answer is the one returned"""
+        for outcome in outcomes:
+            self.record(*outcome)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": CONTEXT_SHAPING,
+            "max_model_len": {name: pool.max_model_len for name, pool in UPSTREAMS.items()
+                              if name not in ("gemini", "embedding")},
+            **token_counter.stats(),
+            "outcomes": {f"{upstream}/{outcome}": count for (upstream, outcome), count in self.outcomes.items()},
+            "dropped_messages": self.dropped_messages,
+        }
+
+
+context_shaping = ContextShapingStats()
+
+
+def context_length_error(limit: int, prompt_tokens: int, max_tokens: int) -> HTTPException:
+    """The 400 vLLM itself would return, raised before the request reaches a GPU"""
+    return HTTPException(status_code=400, detail=(
+        f"This model's maximum context length is {limit} tokens. However, you requested "
+        f"{prompt_tokens + max_tokens} tokens ({prompt_tokens} in the messages, {max_tokens} in the completion). "
+        f"Please reduce the length of the messages or completion."))
+
+
+def check_context(request: ChatRequest):
+    """
+    Reject up front a request whose system prompt and last message alone cannot fit even the
+    largest backend window, before the routing decision spends any GPU time on it
+    """
+    if not CONTEXT_SHAPING:
+        return
+    limit = max(pool.max_model_len for name, pool in UPSTREAMS.items() if name not in ("gemini", "embedding"))
+    kept = [m for m in request.messages[:-1] if m.get("role") == "system"] + request.messages[-1:]
+    prompt_tokens = token_counter.prompt_tokens(kept)
+    min_completion = min(request.max_tokens or CONTEXT_MIN_COMPLETION_TOKENS, CONTEXT_MIN_COMPLETION_TOKENS)
+    if prompt_tokens + min_completion > limit:
+        context_shaping.record("all", "rejected")
+        raise context_length_error(limit, prompt_tokens, min_completion)
+
+
+def shape_request(request: ChatRequest, upstream: UpstreamPool, outcomes: Optional[list] = None) -> ChatRequest:
+    """
+    Fit the request into the upstream's context window: drop the oldest non-system turns while
+    the prompt leaves less than CONTEXT_MIN_COMPLETION_TOKENS of room, then clamp max_tokens
+    to what is left. Raises the context-length 400 when even the last message does not fit.
+    Outcomes are recorded at once, or appended to outcomes as (upstream, outcome, dropped) for
+    a caller that may discard the answer (speculative and hedged calls).
+    """
+    if not CONTEXT_SHAPING or upstream.name == "gemini":
+        return request
+
+    def note(outcome: str, dropped: int = 0):
+        if outcomes is None:
+            context_shaping.record(upstream.name, outcome, dropped)
+        else:
+            outcomes.append((upstream.name, outcome, dropped))
+
+    limit = upstream.max_model_len
+    wanted = request.max_tokens or CONTEXT_MIN_COMPLETION_TOKENS
+    min_completion = min(wanted, CONTEXT_MIN_COMPLETION_TOKENS)
+    messages = list(request.messages)
+    prompt_tokens = token_counter.prompt_tokens(messages)
+    if prompt_tokens + wanted <= limit:
+        return request
+
+    dropped = 0
+    while prompt_tokens + min_completion > limit:
+        oldest = next((i for i, m in enumerate(messages[:-1]) if m.get("role") != "system"), None)
+        if oldest is None:
+            note("rejected")
+            raise context_length_error(limit, prompt_tokens, min_completion)
+        # Drop a whole exchange: the oldest turn and any assistant replies that followed it
+        del messages[oldest]
+        dropped += 1
+        while oldest < len(messages) - 1 and messages[oldest].get("role") == "assistant":
+            del messages[oldest]
+            dropped += 1
+        prompt_tokens = token_counter.prompt_tokens(messages)
+
+    max_tokens = min(wanted, limit - prompt_tokens)
+    if dropped:
+        note("trimmed", dropped)
+    if max_tokens < wanted:
+        note("clamped")
+    logger.info(f"Context shaping for {upstream.name}: dropped {dropped} messages, "
+                f"max_tokens {request.max_tokens} -> {max_tokens} ({prompt_tokens} prompt tokens of {limit})")
+    return request.model_copy(update={"messages": messages, "max_tokens": max_tokens})
+
+
+class SemanticResponseCache:
+    """
+    Answers keyed by the embedding of a single-turn prompt. Vectors are rows of one float32
+    matrix (grown by doubling up to max_entries), so a lookup is one matrix-vector product.
+    Entries expire after ttl_s; the least recently used go first at max_entries or max_bytes
+    (vectors plus answer text). An entry only matches prompts with the same model, max_tokens
+    and system prompt.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl_s: float, threshold: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self.threshold = threshold
+        self._vectors = None
+        self._scopes = None
+        self._expires = None  # 0 marks an empty slot
+        self._last_used = None
+        self._entries = []
+        self.size = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = {}
+        self.errors = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.hit_similarity_total = 0.0
+        if RESPONSE_CACHE_ENABLED and np is None:
+            logger.warning("RESPONSE_CACHE_ENABLED is set but numpy is not installed; response cache disabled")
+
+    @property
+    def enabled(self) -> bool:
+        return RESPONSE_CACHE_ENABLED and np is not None and self.max_entries > 0
+
+    def bypass_reason(self, request) -> Optional[str]:
+        # None leaves sampling to the upstream's default temperature
+        sampled = request.temperature is None or request.temperature > 0
+        if sampled and not RESPONSE_CACHE_SAMPLED:
+            return "temperature"
+        if any(m.get("role") == "assistant" for m in request.messages):
+            return "multi_turn"
+        return None
+
+    @staticmethod
+    def scope(request) -> int:
+        # Serialized, since system content may be a list of parts; fits the int64 scope column
+        system = [m.get("content", "") for m in request.messages if m.get("role") == "system"]
+        identity = json.dumps([request.model, request.max_tokens, system], sort_keys=True, default=str)
+        return int.from_bytes(hashlib.sha256(identity.encode()).digest()[:8], "big", signed=True)
+
+    async def lookup(self, request, user_message: str):
+        """
+        Embed the prompt and look it up. Returns (hit, key): hit is (entry, similarity) or None,
+        key is what put() needs to store this request's answer, or None if the cache is bypassed.
+        """
+        if not self.enabled:
+            return None, None
+        reason = self.bypass_reason(request)
+        if reason is not None:
+            self.bypassed[reason] = self.bypassed.get(reason, 0) + 1
+            return None, None
+        try:
+            vectors, _ = await call_embeddings(UPSTREAMS["embedding"], [user_message])
+        except HTTPException as e:
+            self.errors += 1
+            logger.warning(f"Response cache embedding failed: {e.detail}, bypassing cache")
+            return None, None
+        vector = np.asarray(vectors[0], dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        key = (vector, self.scope(request))
+        return self.get(*key), key
+
+    def get(self, vector, scope: int, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        if not self.size:
+            self.misses += 1
+            return None
+        live = (self._expires > now) & (self._scopes == scope)
+        similarities = np.where(live, self._vectors @ vector, -2.0)
+        slot = int(np.argmax(similarities))
+        similarity = float(similarities[slot])
+        if similarity < self.threshold:
+            self.misses += 1
+            return None
+        self._last_used[slot] = now
+        self.hits += 1
+        self.hit_similarity_total += similarity
+        return self._entries[slot], similarity
+
+    def put(self, vector, scope: int, entry: dict, now: Optional[float] = None):
+        """Store an answer: entry holds text, action and source"""
+        now = time.monotonic() if now is None else now
+        entry_bytes = vector.nbytes + len(entry["text"].encode())
+        if entry_bytes > self.max_bytes:
+            return
+        if self._vectors is None:
+            self._allocate(len(vector), min(256, self.max_entries))
+        self._expire(now)
+        while self.size and self.bytes + entry_bytes > self.max_bytes:
+            self._clear(self._lru_slot())
+            self.evictions += 1
+        slot = self._free_slot()
+        self._vectors[slot] = vector
+        self._scopes[slot] = scope
+        self._expires[slot] = now + self.ttl_s
+        self._last_used[slot] = now
+        self._entries[slot] = {**entry, "bytes": entry_bytes}
+        self.size += 1
+        self.bytes += entry_bytes
+
+    def _allocate(self, dim: int, rows: int):
+        vectors = np.zeros((rows, dim), dtype=np.float32)
+        scopes = np.zeros(rows, dtype=np.int64)
+        expires = np.zeros(rows, dtype=np.float64)
+        last_used = np.zeros(rows, dtype=np.float64)
+        if self._vectors is not None:
+            old = len(self._vectors)
+            vectors[:old], scopes[:old] = self._vectors, self._scopes
+            expires[:old], last_used[:old] = self._expires, self._last_used
+        self._vectors, self._scopes, self._expires, self._last_used = vectors, scopes, expires, last_used
+        self._entries.extend([None] * (rows - len(self._entries)))
+
+    def _expire(self, now: float):
+        for slot in np.flatnonzero((self._expires > 0) & (self._expires <= now)):
+            self._clear(int(slot))
+            self.expirations += 1
+
+    def _lru_slot(self) -> int:
+        return int(np.argmin(np.where(self._expires > 0, self._last_used, np.inf)))
+
+    def _free_slot(self) -> int:
+        empty = np.flatnonzero(self._expires == 0)
+        if len(empty):
+            return int(empty[0])
+        rows = len(self._vectors)
+        if rows < self.max_entries:
+            self._allocate(self._vectors.shape[1], min(rows * 2, self.max_entries))
+            return rows
+        slot = self._lru_slot()
+        self._clear(slot)
+        self.evictions += 1
+        return slot
+
+    def _clear(self, slot: int):
+        self.bytes -= self._entries[slot]["bytes"]
+        self.size -= 1
+        self._entries[slot] = None
+        self._expires[slot] = 0.0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "size": self.size,
+            "max_entries": self.max_entries,
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "ttl_s": self.ttl_s,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "avg_hit_similarity": round(self.hit_similarity_total / self.hits, 4) if self.hits else None,
+            "bypassed": self.bypassed,
+            "errors": self.errors,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+response_cache = SemanticResponseCache(RESPONSE_CACHE_MAX_ENTRIES, int(RESPONSE_CACHE_MAX_MB * 2 ** 20),
+                                       RESPONSE_CACHE_TTL_S, RESPONSE_CACHE_THRESHOLD)
+
+
+def _keywords_matcher(keywords):
+    regex = re.compile(r"\b(?:" + "|".join(re.escape(k) for k in keywords) + r")\b", re.IGNORECASE)
+    return lambda text, words: regex.search(text) is not None
+
+
+# Rule condition builders: config key -> function(value) returning a matcher(text, word_count).
+# Register new condition types here to extend the rule language.
+RULE_CONDITIONS = {
+    "pattern": lambda value: (lambda regex: lambda text, words: regex.search(text) is not None)(
+        re.compile(value, re.IGNORECASE | re.DOTALL)),
+    "keywords": _keywords_matcher,
+    "min_chars": lambda value: lambda text, words: len(text) >= value,
+    "max_chars": lambda value: lambda text, words: len(text) <= value,
+    "min_words": lambda value: lambda text, words: words >= value,
+    "max_words": lambda value: lambda text, words: words <= value,
+}
+
+
+class RoutingRule:
+    """A named set of conditions that must all hold for the rule to fire"""
+
+    def __init__(self, name: str, action: str, matchers: list, confidence: float = 1.0):
+        self.name = name
+        self.action = action
+        self.matchers = matchers
+        self.confidence = confidence
+        self.hits = 0
+
+    @classmethod
+    def from_config(cls, config: dict) -> "RoutingRule":
+        name = config["name"]
+        action = config["action"]
+        if action not in ("route_simple", "route_specialist", "answer_self", "route_gemini"):
+            raise ValueError(f"Rule {name!r} has invalid action {action!r}")
+        matchers = []
+        for key, value in config.items():
+            if key in ("name", "action", "confidence") or key.startswith("_"):
+                continue
+            if key not in RULE_CONDITIONS:
+                raise ValueError(f"Rule {name!r} has unknown condition {key!r}")
+            matchers.append(RULE_CONDITIONS[key](value))
+        if not matchers:
+            raise ValueError(f"Rule {name!r} has no conditions")
+        return cls(name, action, matchers, config.get("confidence", 1.0))
+
+    def matches(self, text: str, words: int) -> bool:
+        return all(matcher(text, words) for matcher in self.matchers)
+
+
+class PreClassifier:
+    """
+    Rule-based fast path in front of the router LLM. Rules are compiled once at
+    startup; a prompt no rule is sure about falls through to the LLM.
+    """
+
+    def __init__(self, rules: list):
+        self.rules = rules
+        self.evaluated = 0
+        self.fallthrough = 0
+        self.eval_time_s = 0.0
+        # Average router LLM decision time, used to estimate what each rule hit saves
+        self.llm_decision_avg_s = None
+
+    @classmethod
+    def from_file(cls, path: str) -> "PreClassifier":
+        if not ROUTER_RULES_ENABLED:
+            return cls([])
+        if not os.path.exists(path):
+            logger.warning(f"Routing rules file {path} not found, pre-classifier disabled")
+            return cls([])
+        with open(path) as f:
+            config = json.load(f)
+        rules = [RoutingRule.from_config(rule) for rule in config.get("rules", [])]
+        logger.info(f"Loaded {len(rules)} routing rules from {path}")
+        return cls(rules)
+
+    def classify(self, user_message: str) -> Optional[RoutingDecision]:
+        if not self.rules:
+            return None
+        start = time.perf_counter()
+        text = user_message.strip()
+        words = len(text.split())
+        decision = None
+        for rule in self.rules:
+            if rule.matches(text, words):
+                rule.hits += 1
+                decision = RoutingDecision(action=rule.action, reason=f"Matched rule '{rule.name}'",
+                                           confidence=rule.confidence, decided_by="rules")
+                break
+        self.evaluated += 1
+        if decision is None:
+            self.fallthrough += 1
+        self.eval_time_s += time.perf_counter() - start
+        return decision
+
+    def observe_llm_decision(self, seconds: float):
+        if self.llm_decision_avg_s is None:
+            self.llm_decision_avg_s = seconds
+        else:
+            self.llm_decision_avg_s += 0.1 * (seconds - self.llm_decision_avg_s)
+
+    def stats(self) -> dict:
+        hits = sum(rule.hits for rule in self.rules)
+        llm_avg = self.llm_decision_avg_s
+        return {
+            "rules": len(self.rules),
+            "evaluated": self.evaluated,
+            "hits": hits,
+            "fallthrough": self.fallthrough,
+            "hit_rate": round(hits / self.evaluated, 4) if self.evaluated else 0.0,
+            "avg_eval_us": round(self.eval_time_s / self.evaluated * 1e6, 2) if self.evaluated else 0.0,
+            "llm_decision_avg_ms": round(llm_avg * 1000, 1) if llm_avg is not None else None,
+            "estimated_time_saved_s": round(hits * llm_avg, 3) if llm_avg is not None else None,
+            "per_rule": {
+                rule.name: {
+                    "action": rule.action,
+                    "hits": rule.hits,
+                    "hit_rate": round(rule.hits / self.evaluated, 4) if self.evaluated else 0.0,
+                }
+                for rule in self.rules
+            },
+        }
+
+
+pre_classifier = PreClassifier.from_file(ROUTER_RULES_FILE)
+
+
+class Metric:
+    """
+    Minimal Prometheus metric family with labels, rendered in the text exposition
+    format. Kept dependency-free so the router container only needs the
+    packages it already pip-installs at start.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._children = {}
+        METRICS.append(self)
+        if not labelnames and hasattr(self, "_new_child"):
+            # Unlabelled metrics are exported as 0 from the start
+            self.labels()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _label_str(self, values: tuple, extra: tuple = ()) -> str:
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in self._children.items():
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def _render_child(self, values, child):
+        return [f"{self.name}{self._label_str(values)} {child.value}"]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1.0):
+        self.labels().dec(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class _HistogramValue:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self, width: int):
+        self.counts = array("q", bytes(8 * width))
+        self.sum = 0.0
+
+
+class Histogram(Metric):
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        super().__init__(name, help_text, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(len(self.buckets) + 1)
+
+    def observe(self, value: float, *labelvalues):
+        child = self.labels(*labelvalues)
+        child.counts[bisect_left(self.buckets, value)] += 1
+        child.sum += value
+
+    def _render_child(self, values, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, child.counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{self._label_str(values, (('le', bound),))} {cumulative}")
+        cumulative += child.counts[-1]
+        lines.append(f"{self.name}_bucket{self._label_str(values, (('le', '+Inf'),))} {cumulative}")
+        lines.append(f"{self.name}_sum{self._label_str(values)} {child.sum}")
+        lines.append(f"{self.name}_count{self._label_str(values)} {cumulative}")
+        return lines
+
+
+class CallbackMetric(Metric):
+    """Metric whose samples are read from live state at scrape time: fn() -> [(labelvalues, value)]"""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple, fn, kind: str = "gauge"):
+        super().__init__(name, help_text, labelnames)
+        self.fn = fn
+        self.kind = kind
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, value in self.fn():
+            lines.append(f"{self.name}{self._label_str(values)} {value}")
+        return lines
+
+
+METRICS = []
+
+REQUESTS_TOTAL = Counter("router_requests_total", "Chat completion requests by action, backend and outcome",
+                         ("action", "backend", "status"))
+IN_FLIGHT = Gauge("router_in_flight_requests", "Chat completion requests currently being handled")
+DECISIONS_TOTAL = Counter("router_decisions_total", "Routing decisions by decision engine", ("decided_by",))
+DECISION_LLM_SECONDS = Histogram("router_decision_llm_seconds", "Router LLM call latency for routing decisions")
+DECISION_PARSE_SECONDS = Histogram("router_decision_parse_seconds", "Time spent parsing the router LLM output",
+                                   buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005))
+DECISION_BATCH_SIZE = Histogram("router_decision_batch_size", "Routing prompts per batched router LLM call",
+                                buckets=(1, 2, 4, 8, 16, 32, 64))
+DECISION_PARSE_FAILURES = Counter("router_decision_parse_failures_total",
+                                  "Routing decisions whose LLM output was not valid JSON")
+DECISION_INVALID_ACTIONS = Counter("router_decision_invalid_actions_total",
+                                   "Routing decisions with an unknown action, defaulted to route_simple")
+ROUTING_SECONDS = Histogram("router_routing_seconds", "Time from request arrival to routing decision", ("action",))
+BACKEND_SECONDS = Histogram("router_backend_seconds", "Backend call latency (whole stream for streaming requests)",
+                            ("backend",))
+PRIORITY_SECONDS = Histogram("router_request_seconds", "Routing plus backend time by priority class", ("priority",))
+GEMINI_SECONDS = Histogram("router_gemini_seconds", "Gemini API call latency, including failed calls", ("status",))
+GEMINI_FALLBACKS = Counter("router_gemini_fallbacks_total", "Gemini calls that fell back to the specialist agent")
+LOAD_OVERRIDES = Counter("router_load_overrides_total", "Routing decisions overridden because the backend was saturated",
+                         ("from_action", "to_action"))
+BREAKER_TRANSITIONS = Counter("router_breaker_transitions_total", "Circuit breaker state changes",
+                              ("upstream", "state"))
+BREAKER_REJECTIONS = Counter("router_breaker_rejections_total", "Calls refused by an open circuit breaker",
+                             ("upstream",))
+REPLICA_EJECTIONS = Counter("router_replica_ejections_total", "Upstream replicas taken out of rotation",
+                            ("upstream", "reason"))
+HEDGES_TOTAL = Counter("router_hedges_total", "Hedged backend calls by trigger and winner",
+                       ("trigger", "winner"))
+ADMISSION_WAIT_SECONDS = Histogram("router_admission_wait_seconds", "Time spent queued for an upstream slot",
+                                   ("upstream",))
+ADMISSION_REJECTIONS = Counter("router_admission_rejections_total", "Calls rejected by upstream admission control",
+                               ("upstream", "reason"))
+
+
+# Log-spaced latency bucket upper bounds: 1ms .. ~70s in 25% steps, plus an overflow bucket
+LATENCY_BUCKETS_S = tuple(0.001 * 1.25 ** i for i in range(51))
+STATS_WINDOWS_S = {"1m": 60, "5m": 300, "15m": 900}
+# Windows are read over whole slots, so each covers its stated span to within one slot
+STATS_SLOT_S = 5
+STATS_SLOTS = max(STATS_WINDOWS_S.values()) // STATS_SLOT_S
+
+
+class RollingHistogram:
+    """
+    Fixed-bucket latency histogram over a ring of 5-second slots, read back
+    over 1m/5m/15m windows. All storage is preallocated; record() is a bisect
+    plus a few array increments. No locks are needed because every request is
+    recorded on the event loop thread.
+    """
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS_S):
+        self.buckets = buckets
+        width = len(buckets) + 1
+        self._counts = [array("q", bytes(8 * width)) for _ in range(STATS_SLOTS)]
+        self._sums = array("d", bytes(8 * STATS_SLOTS))
+        self._maxes = array("d", bytes(8 * STATS_SLOTS))
+        self._epochs = array("q", [-1] * STATS_SLOTS)
+
+    def _slot(self, now: float) -> int:
+        epoch = int(now // STATS_SLOT_S)
+        slot = epoch % STATS_SLOTS
+        if self._epochs[slot] != epoch:
+            # Slot last held data from a previous lap of the ring: clear it in place
+            counts = self._counts[slot]
+            for i in range(len(counts)):
+                counts[i] = 0
+            self._sums[slot] = 0.0
+            self._maxes[slot] = 0.0
+            self._epochs[slot] = epoch
+        return slot
+
+    def record(self, value: float, now: Optional[float] = None):
+        slot = self._slot(time.time() if now is None else now)
+        self._counts[slot][bisect_left(self.buckets, value)] += 1
+        self._sums[slot] += value
+        if value > self._maxes[slot]:
+            self._maxes[slot] = value
+
+    def snapshot(self, window_s: int, now: Optional[float] = None, scale: float = 1000.0) -> dict:
+        """Count, mean, percentiles and max over the window; latencies scaled to ms by default"""
+        current = int((time.time() if now is None else now) // STATS_SLOT_S)
+        oldest = current - window_s // STATS_SLOT_S + 1
+        merged = [0] * (len(self.buckets) + 1)
+        total_sum = 0.0
+        peak = 0.0
+        for slot in range(STATS_SLOTS):
+            if oldest <= self._epochs[slot] <= current:
+                for i, c in enumerate(self._counts[slot]):
+                    merged[i] += c
+                total_sum += self._sums[slot]
+                peak = max(peak, self._maxes[slot])
+        count = sum(merged)
+        result = {"count": count}
+        if count == 0:
+            return result
+        result["mean"] = round(total_sum / count * scale, 2)
+        for p in (50, 90, 95, 99):
+            result[f"p{p}"] = round(self._quantile(merged, count, p / 100, peak) * scale, 2)
+        result["max"] = round(peak * scale, 2)
+        return result
+
+    def _quantile(self, merged: list, count: int, q: float, peak: float) -> float:
+        rank = q * count
+        seen = 0
+        for i, c in enumerate(merged):
+            seen += c
+            if seen >= rank and c:
+                # Report the bucket's upper bound, capped by the observed max
+                return min(self.buckets[i], peak) if i < len(self.buckets) else peak
+        return peak
+
+
+class RollingCounter:
+    """Event counter over the same slot ring as RollingHistogram"""
+
+    def __init__(self):
+        self._counts = array("q", bytes(8 * STATS_SLOTS))
+        self._epochs = array("q", [-1] * STATS_SLOTS)
+
+    def add(self, n: int = 1, now: Optional[float] = None):
+        epoch = int((time.time() if now is None else now) // STATS_SLOT_S)
+        slot = epoch % STATS_SLOTS
+        if self._epochs[slot] != epoch:
+            self._counts[slot] = 0
+            self._epochs[slot] = epoch
+        self._counts[slot] += n
+
+    def total(self, window_s: int, now: Optional[float] = None) -> int:
+        current = int((time.time() if now is None else now) // STATS_SLOT_S)
+        oldest = current - window_s // STATS_SLOT_S + 1
+        return sum(self._counts[s] for s in range(STATS_SLOTS) if oldest <= self._epochs[s] <= current)
+
+
+class BackendStats:
+    """Rolling request, error and per-stage latency stats for one backend"""
+
+    STAGES = ("routing", "backend", "total")
+
+    def __init__(self):
+        self.requests = RollingCounter()
+        self.errors = RollingCounter()
+        self.latency = {stage: RollingHistogram() for stage in self.STAGES}
+
+    def record(self, routing_s: float, backend_s: float, error: bool, now: float):
+        self.requests.add(1, now)
+        if error:
+            self.errors.add(1, now)
+        self.latency["routing"].record(routing_s, now)
+        self.latency["backend"].record(backend_s, now)
+        self.latency["total"].record(routing_s + backend_s, now)
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        result = {}
+        for window, seconds in STATS_WINDOWS_S.items():
+            requests = self.requests.total(seconds, now)
+            errors = self.errors.total(seconds, now)
+            result[window] = {
+                "requests": requests,
+                "errors": errors,
+                "error_rate": round(errors / requests, 4) if requests else 0.0,
+                "latency_ms": {stage: hist.snapshot(seconds, now) for stage, hist in self.latency.items()},
+            }
+        return result
+
+
+class RouterStats:
+    """Live per-action counts and per-backend latency for /routing/stats"""
+
+    def __init__(self):
+        self.action_totals = {}
+        self.actions = {}
+        self.backends = {}
+        self.priorities = {}
+
+    def record(self, action: str, backend: str, routing_s: float, backend_s: float, error: bool = False):
+        now = time.time()
+        self.action_totals[action] = self.action_totals.get(action, 0) + 1
+        counter = self.actions.get(action)
+        if counter is None:
+            counter = self.actions[action] = RollingCounter()
+        counter.add(1, now)
+
+        stats = self.backends.get(backend)
+        if stats is None:
+            stats = self.backends[backend] = BackendStats()
+        stats.record(routing_s, backend_s, error, now)
+
+        # The same stats per priority class of the request being recorded
+        priority = request_class.get()[0]
+        by_class = self.priorities.get(priority)
+        if by_class is None:
+            by_class = self.priorities[priority] = BackendStats()
+        by_class.record(routing_s, backend_s, error, now)
+
+        REQUESTS_TOTAL.labels(action, backend, "error" if error else "ok").inc()
+        PRIORITY_SECONDS.observe(routing_s + backend_s, priority)
+        ROUTING_SECONDS.observe(routing_s, action)
+        BACKEND_SECONDS.observe(backend_s, backend)
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        return {
+            "actions": {
+                action: {"total": self.action_totals[action],
+                         **{window: counter.total(seconds, now) for window, seconds in STATS_WINDOWS_S.items()}}
+                for action, counter in self.actions.items()
+            },
+            "backends": {backend: stats.snapshot() for backend, stats in self.backends.items()},
+            "priorities": {priority: stats.snapshot() for priority, stats in self.priorities.items()},
+        }
+
+
+router_stats = RouterStats()
+
+# Backend label recorded in stats for each action when no response source is known (e.g. on error)
+ACTION_BACKENDS = {
+    "route_simple": "simple_agent",
+    "route_specialist": "specialist_agent",
+    "answer_self": "router_agent",
+    "route_gemini": "gemini",
+}
+
+
+def backend_label(source: str) -> str:
+    """'specialist_agent (gemini_fallback)' -> 'specialist_agent'"""
+    return source.split(" ", 1)[0]
+
+
+async def call_llm(upstream: UpstreamPool, messages: list, max_tokens: int = 200, model: Optional[str] = None,
+                   temperature: float = 0.7):
+    """Call an LLM endpoint through the upstream's pooled session. Returns (response_text, usage)."""
+    choice, usage = await call_llm_choice(upstream, messages, max_tokens, model, {"temperature": temperature})
+    return choice["message"]["content"], usage
+
+
+async def call_llm_choice(upstream: UpstreamPool, messages: list, max_tokens: int = 200,
+                          model: Optional[str] = None, extra: Optional[dict] = None):
+    """
+    call_llm returning the whole first choice (message, logprobs, ...) instead of its text.
+    extra is merged into the request body, e.g. vLLM guided decoding parameters.
+    """
+    payload = {
+        "model": model or upstream.model,
+        "messages": messages,
+        "max_tokens": max_tokens,
+        "temperature": 0.7,
+        **(extra or {}),
+    }
+    started, replica = await upstream.begin()
+    ok = None
+    try:
+        async with upstream.session.post(replica.url, json=payload) as resp:
+            if resp.status != 200:
+                # 4xx means the upstream is up and rejected this request; only 5xx counts against it
+                ok = resp.status < 500
+                error_text = await resp.text()
+                raise HTTPException(status_code=resp.status, detail=f"LLM call failed: {error_text}")
+            data = await resp.json()
+            usage = data.get("usage") or make_usage()
+            upstream.record_usage(usage)
+            ok = True
+            return data["choices"][0], usage
+    except HTTPException:
+        raise
+    except asyncio.TimeoutError:
+        ok = False
+        raise HTTPException(status_code=504, detail="LLM call timed out")
+    except Exception as e:
+        ok = False
+        raise HTTPException(status_code=500, detail=f"LLM call error: {str(e)}")
+    finally:
+        upstream.end(started, replica, ok)
+
+
+def completions_url(url: str) -> str:
+    return base_url(url) + "/v1/completions"
+
+
+async def call_completions(upstream: UpstreamPool, prompts: list, max_tokens: int = 200,
+                           stop: Optional[list] = None, extra: Optional[dict] = None):
+    """
+    One /v1/completions call for a list of raw prompts through the upstream's pooled session.
+    Returns (choices in prompt order, usage for the whole batch).
+    """
+    payload = {
+        "model": upstream.model,
+        "prompt": prompts,
+        "max_tokens": max_tokens,
+        "temperature": 0.7,
+        **(extra or {}),
+    }
+    if stop:
+        payload["stop"] = stop
+    started, replica = await upstream.begin()
+    ok = None
+    try:
+        async with upstream.session.post(completions_url(replica.url), json=payload) as resp:
+            if resp.status != 200:
+                ok = resp.status < 500
+                error_text = await resp.text()
+                raise HTTPException(status_code=resp.status, detail=f"LLM call failed: {error_text}")
+            data = await resp.json()
+            choices = [{"text": ""}] * len(prompts)
+            for choice in data["choices"]:
+                choices[choice["index"]] = choice
+            usage = data.get("usage") or make_usage()
+            upstream.record_usage(usage)
+            ok = True
+            return choices, usage
+    except HTTPException:
+        raise
+    except asyncio.TimeoutError:
+        ok = False
+        raise HTTPException(status_code=504, detail="LLM call timed out")
+    except Exception as e:
+        ok = False
+        raise HTTPException(status_code=500, detail=f"LLM call error: {str(e)}")
+    finally:
+        upstream.end(started, replica, ok)
+
+
+async def call_embeddings(upstream: UpstreamPool, inputs: list):
+    """One /v1/embeddings call for a list of texts. Returns (vectors in input order, usage)."""
+    payload = {"model": upstream.model, "input": inputs}
+    started, replica = await upstream.begin()
+    ok = None
+    try:
+        async with upstream.session.post(replica.url, json=payload) as resp:
+            if resp.status != 200:
+                ok = resp.status < 500
+                error_text = await resp.text()
+                raise HTTPException(status_code=resp.status, detail=f"Embedding call failed: {error_text}")
+            data = await resp.json()
+            vectors = [None] * len(inputs)
+            for item in data["data"]:
+                vectors[item["index"]] = item["embedding"]
+            usage = data.get("usage") or {}
+            upstream.record_usage(usage)
+            ok = True
+            return vectors, make_usage(usage.get("prompt_tokens", 0))
+    except HTTPException:
+        raise
+    except asyncio.TimeoutError:
+        ok = False
+        raise HTTPException(status_code=504, detail="Embedding call timed out")
+    except Exception as e:
+        ok = False
+        raise HTTPException(status_code=500, detail=f"Embedding call error: {str(e)}")
+    finally:
+        upstream.end(started, replica, ok)
+
+
+async def call_gemini(upstream: UpstreamPool, prompt: str):
+    """Call Google Gemini API. Returns (response_text, usage) on success, (None, None) on failure."""
+    if not GEMINI_API_KEY:
+        logger.warning("Gemini API key not configured, will fallback")
+        return None, None
+
+    url = f"{upstream.url}?key={GEMINI_API_KEY}"
+    payload = {
+        "contents": [{
+            "parts": [{"text": prompt}]
+        }]
+    }
+
+    try:
+        started, replica = await upstream.begin()
+    except HTTPException as e:
+        logger.warning(f"Gemini admission rejected: {e.detail}, will fallback")
+        return None, None
+    # Any failure counts against Gemini's breaker, including 4xx: a bad key fails every call
+    ok = None
+    try:
+        async with upstream.session.post(url, json=payload) as resp:
+            ok = False
+            if resp.status != 200:
+                error_text = await resp.text()
+                logger.warning(f"Gemini API returned {resp.status}: {error_text}, will fallback")
+                return None, None
+            data = await resp.json()
+            usage = gemini_usage(data.get("usageMetadata", {}))
+            upstream.record_usage(usage)
+            ok = True
+            return data["candidates"][0]["content"]["parts"][0]["text"], usage
+    except Exception as e:
+        ok = False
+        logger.warning(f"Gemini API error: {e}, will fallback")
+        return None, None
+    finally:
+        upstream.end(started, replica, ok)
+
 
-# Router model configuration
-ROUTER_MODEL = os.getenv("ROUTER_MODEL", "Qwen/Qwen2.5-0.5B-Instruct")
+def stream_timeout(upstream: UpstreamPool) -> aiohttp.ClientTimeout:
+    """Streams can run longer than the total timeout; bound the gap between chunks instead."""
+    return aiohttp.ClientTimeout(total=None, connect=upstream.connect_timeout_s, sock_read=upstream.timeout_s)
 
 
-class ChatRequest(BaseModel):
-    messages: list
-    model: Optional[str] = None
-    max_tokens: Optional[int] = 200
-    temperature: Optional[float] = 0.7
+def sse_event(payload: dict) -> bytes:
+    return f"data: {json.dumps(payload)}\n\n".encode()
 
 
-class RoutingDecision(BaseModel):
-    action: Literal["route_simple", "route_specialist", "answer_self", "route_gemini"]
-    reason: str
-    confidence: Optional[float] = None
+class UpstreamStream:
+    """An open upstream SSE response and the admission slot it holds; close() releases both, once"""
+
+    def __init__(self, upstream: UpstreamPool, resp: aiohttp.ClientResponse, started: float, replica: Replica):
+        self.upstream = upstream
+        self.resp = resp
+        self.started = started
+        self.replica = replica
+        self.closed = False
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.resp.release()
+        self.upstream.end(self.started, self.replica)
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """
+    Runs on_close however the response ends: finished, failed, or the client went away.
+    The body generator's own finally only runs if the body is iterated to an end.
+    """
+
+    def __init__(self, content, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
 
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.on_close()
 
-async def call_llm(session: aiohttp.ClientSession, url: str, messages: list, model: str, max_tokens: int = 200):
-    """Call an LLM endpoint"""
+
+async def open_llm_stream(upstream: UpstreamPool, messages: list, max_tokens: int = 200, model: Optional[str] = None,
+                          temperature: float = 0.7):
+    """
+    Start a streaming completion and return it as an UpstreamStream.
+    Errors are raised here, before the client has been sent any bytes.
+    The caller owns the stream and must close() it, which relay_llm_stream does when it ends.
+    """
     payload = {
-        "model": model,
+        "model": model or upstream.model,
         "messages": messages,
         "max_tokens": max_tokens,
-        "temperature": 0.7
+        "temperature": temperature,
+        "stream": True,
+        "stream_options": {"include_usage": True},
     }
+    started, replica = await upstream.begin()
     try:
-        async with session.post(url, json=payload, timeout=aiohttp.ClientTimeout(total=30)) as resp:
-            if resp.status != 200:
-                error_text = await resp.text()
-                raise HTTPException(status_code=resp.status, detail=f"LLM call failed: {error_text}")
-            data = await resp.json()
-            return data["choices"][0]["message"]["content"]
+        resp = await upstream.session.post(replica.url, json=payload, timeout=stream_timeout(upstream))
     except asyncio.TimeoutError:
+        upstream.end(started, replica, ok=False)
         raise HTTPException(status_code=504, detail="LLM call timed out")
     except Exception as e:
+        upstream.end(started, replica, ok=False)
         raise HTTPException(status_code=500, detail=f"LLM call error: {str(e)}")
+    except BaseException:
+        upstream.end(started, replica)
+        raise
+    if resp.status != 200:
+        try:
+            error_text = await resp.text()
+        finally:
+            resp.release()
+            upstream.end(started, replica, ok=resp.status < 500)
+        raise HTTPException(status_code=resp.status, detail=f"LLM call failed: {error_text}")
+    # The breaker judges a stream by how quickly it opened, not by how long it ran
+    upstream.breaker.record(True, time.perf_counter() - started)
+    replica.consecutive_failures = 0
+    return UpstreamStream(upstream, resp, started, replica)
+
+
+async def relay_llm_stream(stream: UpstreamStream, routing_usage: dict):
+    """
+    Forward upstream SSE events line by line, without re-buffering. Stops before [DONE].
+    Only the final usage chunk is parsed, to count tokens and attach the routing call's usage.
+    """
+    upstream = stream.upstream
+    try:
+        async for line in stream.resp.content:
+            line = line.strip()
+            if not line.startswith(b"data:"):
+                continue
+            if line == b"data: [DONE]":
+                break
+            if b'"usage"' in line:
+                data = json.loads(line[len(b"data:"):])
+                if data.get("usage"):
+                    upstream.record_usage(data["usage"])
+                    data["usage"]["routing"] = routing_usage
+                    line = b"data: " + json.dumps(data).encode()
+            yield line + b"\n\n"
+    finally:
+        stream.close()
 
 
-async def call_gemini(session: aiohttp.ClientSession, prompt: str):
-    """Call Google Gemini API. Returns (response_text, True) on success, (None, False) on failure."""
+async def open_gemini_stream(upstream: UpstreamPool, prompt: str):
+    """Start a Gemini SSE stream. Returns an UpstreamStream, or None so the caller can fall back."""
     if not GEMINI_API_KEY:
         logger.warning("Gemini API key not configured, will fallback")
-        return None, False
+        return None
 
-    url = f"{GEMINI_API_URL}?key={GEMINI_API_KEY}"
+    url = f"{GEMINI_STREAM_URL}?alt=sse&key={GEMINI_API_KEY}"
     payload = {
         "contents": [{
             "parts": [{"text": prompt}]
         }]
     }
-
     try:
-        async with session.post(url, json=payload, timeout=aiohttp.ClientTimeout(total=30)) as resp:
-            if resp.status != 200:
-                error_text = await resp.text()
-                logger.warning(f"Gemini API returned {resp.status}: {error_text}, will fallback")
-                return None, False
-            data = await resp.json()
-            return data["candidates"][0]["content"]["parts"][0]["text"], True
+        started, replica = await upstream.begin()
+    except HTTPException as e:
+        logger.warning(f"Gemini admission rejected: {e.detail}, will fallback")
+        return None
+    try:
+        resp = await upstream.session.post(url, json=payload, timeout=stream_timeout(upstream))
     except Exception as e:
+        upstream.end(started, replica, ok=False)
         logger.warning(f"Gemini API error: {e}, will fallback")
-        return None, False
+        return None
+    except BaseException:
+        upstream.end(started, replica)
+        raise
+    if resp.status != 200:
+        try:
+            error_text = await resp.text()
+        except Exception as e:
+            error_text = str(e)
+        finally:
+            resp.release()
+            upstream.end(started, replica, ok=False)
+        logger.warning(f"Gemini API returned {resp.status}: {error_text}, will fallback")
+        return None
+    upstream.breaker.record(True, time.perf_counter() - started)
+    return UpstreamStream(upstream, resp, started, replica)
+
+
+async def relay_gemini_stream(stream: UpstreamStream, chunk_id: str, model: str, routing_usage: dict):
+    """Translate Gemini SSE events into OpenAI chat.completion.chunk events."""
+    upstream = stream.upstream
+    usage = None
+    base = {"id": chunk_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model}
+    try:
+        async for line in stream.resp.content:
+            line = line.strip()
+            if not line.startswith(b"data:"):
+                continue
+            data = json.loads(line[len(b"data:"):])
+            for candidate in data.get("candidates", [])[:1]:
+                text = "".join(part.get("text", "") for part in candidate.get("content", {}).get("parts", []))
+                if text:
+                    yield sse_event({**base, "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None}]})
+            if "usageMetadata" in data:
+                usage = data["usageMetadata"]
+    finally:
+        stream.close()
+
+    yield sse_event({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+    usage = gemini_usage(usage or {})
+    upstream.record_usage(usage)
+    yield sse_event({**base, "choices": [], "usage": {**usage, "routing": routing_usage}})
+
+
+async def stream_chat_completion(request: ChatRequest, decision: RoutingDecision, user_message: str,
+                                 routing_s: float = 0.0, cache_key=None):
+    """
+    Open the decided upstream as an SSE stream and proxy it to the client chunk by chunk.
+    With a cache_key, the relayed events are kept and the assembled answer is stored in the
+    response cache once the stream completes.
+    """
+    backend_start = time.perf_counter()
+    chunk_id = f"chatcmpl-router-{int(time.time())}"
+    model = request.model or "router-agent"
+    routing_usage = decision.usage or make_usage()
+
+    if decision.action == "route_gemini":
+        logger.info("Streaming from Gemini")
+        gemini_start = time.perf_counter()
+        stream = await open_gemini_stream(UPSTREAMS["gemini"], user_message)
+        if stream is not None:
+            upstream, source = UPSTREAMS["gemini"], "gemini"
+            body = relay_gemini_stream(stream, chunk_id, model, routing_usage)
+        else:
+            GEMINI_SECONDS.observe(time.perf_counter() - gemini_start, "error")
+            logger.info("Gemini unavailable, falling back to Specialist Agent")
+            GEMINI_FALLBACKS.inc()
+            upstream, source = UPSTREAMS["specialist"], "specialist_agent (gemini_fallback)"
+    else:
+        upstream, source = {
+            "route_specialist": (UPSTREAMS["specialist"], "specialist_agent"),
+            "answer_self": (UPSTREAMS["router"], "router_agent"),
+        }.get(decision.action, (UPSTREAMS["simple"], "simple_agent"))
+        stream = None
+
+    if stream is None:
+        logger.info(f"Streaming from {upstream.name}")
+        shaped = shape_request(request, upstream)
+        stream = await open_llm_stream(upstream, shaped.messages, shaped.max_tokens,
+                                       temperature=shaped.temperature)
+        body = relay_llm_stream(stream, routing_usage)
+
+    finished = False
+
+    def release():
+        # Normally the body's finally has done this; covers a body that was never run to an end
+        nonlocal finished
+        stream.close()
+        if not finished:
+            finished = True
+            IN_FLIGHT.dec()
+
+    async def event_stream():
+        # First chunk carries the role and the routing metadata; usage arrives in the final upstream chunk
+        yield sse_event({
+            "id": chunk_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}],
+            "routing_metadata": {
+                "action": decision.action,
+                "reason": decision.reason,
+                "decided_by": decision.decided_by,
+                "override": decision.override,
+                "source": source,
+            },
+        })
+        error = True
+        events = [] if cache_key is not None else None
+        try:
+            async for event in body:
+                if events is not None:
+                    events.append(event)
+                yield event
+            yield b"data: [DONE]\n\n"
+            error = False
+        finally:
+            backend_s = time.perf_counter() - backend_start
+            if source == "gemini":
+                GEMINI_SECONDS.observe(backend_s, "error" if error else "ok")
+            router_stats.record(decision.action, backend_label(source), routing_s, backend_s, error)
+            release()
+        if events is not None:
+            response_cache.put(*cache_key, {"text": stream_text(events), "action": decision.action,
+                                            "source": source})
+
+    return ClosingStreamingResponse(event_stream(), release, media_type="text/event-stream",
+                                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def stream_text(events: list) -> str:
+    """Assemble the answer text from relayed chat.completion.chunk SSE events"""
+    parts = []
+    for event in events:
+        data = json.loads(event[len(b"data:"):])
+        for choice in data.get("choices", [])[:1]:
+            parts.append(choice.get("delta", {}).get("content") or "")
+    return "".join(parts)
+
+
+def choice_text(choice: dict) -> str:
+    """Generated text of a chat or completions choice"""
+    return choice["message"]["content"] if "message" in choice else choice["text"]
+
+
+def choice_logprob(choice: dict) -> Optional[float]:
+    """Summed logprob of the generated tokens of a chat or completions choice, if returned"""
+    logprobs = choice.get("logprobs")
+    if not logprobs:
+        return None
+    if "content" in logprobs:
+        values = [token["logprob"] for token in logprobs["content"] or []]
+    else:
+        values = logprobs.get("token_logprobs") or []
+    values = [v for v in values if v is not None]
+    return sum(values) if values else None
+
+
+def chat_prompt(messages: list) -> str:
+    """Render messages with the Qwen2.5 (ChatML) chat template, for /v1/completions"""
+    turns = "".join(f"<|im_start|>{m['role']}\n{m['content']}<|im_end|>\n" for m in messages)
+    return turns + "<|im_start|>assistant\n"
 
 
-async def router_agent_decision(session: aiohttp.ClientSession, user_message: str) -> RoutingDecision:
+def split_usage(usage: dict, n: int) -> list:
+    """Split a batch's usage evenly across its n requests (vLLM only reports the batch total)"""
+    shares = []
+    for i in range(n):
+        share = {key: usage.get(key, 0) // n + (1 if i < usage.get(key, 0) % n else 0)
+                 for key in ("prompt_tokens", "completion_tokens")}
+        shares.append(make_usage(**share))
+    return shares
+
+
+class DecisionBatcher:
+    """
+    Collects routing prompts for up to window_s, or until max_batch are waiting, and sends
+    them to the router model as a single /v1/completions call with a list of prompts. Each
+    caller gets its own completion choice and an even share of the batch's token usage.
+    """
+
+    def __init__(self, upstream: UpstreamPool, window_s: float, max_batch: int):
+        self.upstream = upstream
+        self.window_s = window_s
+        self.max_batch = max_batch
+        self._pending = []
+        self._timer = None
+        self._sending = set()
+        self.batches = 0
+        self.prompts = 0
+        self.full_flushes = 0
+        self.largest_batch = 0
+
+    async def submit(self, messages: list, max_tokens: int, extra: Optional[dict] = None):
+        """
+        Queue one routing prompt and wait for its (choice, usage). extra (decoding parameters)
+        is taken from the first prompt of each batch: every decision uses ROUTING_DECODE_MODE.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((chat_prompt(messages), max_tokens, extra, future))
+        if len(self._pending) >= self.max_batch:
+            self.full_flushes += 1
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window_s, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._send(batch))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, batch: list):
+        self.batches += 1
+        self.prompts += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        DECISION_BATCH_SIZE.observe(len(batch))
+        extra = dict(batch[0][2] or {})
+        if extra.get("logprobs") is True:
+            # The completions API takes the number of logprobs per token, not a flag
+            extra["logprobs"] = 1
+        try:
+            choices, usage = await call_completions(self.upstream, [prompt for prompt, _, _, _ in batch],
+                                                    max(tokens for _, tokens, _, _ in batch),
+                                                    stop=["<|im_end|>"], extra=extra)
+        except Exception as e:
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, _, _, future), choice, share in zip(batch, choices, split_usage(usage, len(batch))):
+            if not future.done():
+                future.set_result((choice, share))
+
+    def stats(self) -> dict:
+        return {
+            "enabled": DECISION_BATCH_WINDOW_MS > 0,
+            "window_ms": DECISION_BATCH_WINDOW_MS,
+            "max_batch": self.max_batch,
+            "batches": self.batches,
+            "prompts": self.prompts,
+            "avg_batch_size": round(self.prompts / self.batches, 2) if self.batches else 0.0,
+            "largest_batch": self.largest_batch,
+            "full_flushes": self.full_flushes,
+            "pending": len(self._pending),
+        }
+
+
+decision_batcher = DecisionBatcher(UPSTREAMS["router"], DECISION_BATCH_WINDOW_MS / 1000, DECISION_BATCH_MAX)
+
+
+# Single-word labels for ROUTING_DECODE_MODE=label, chosen to differ in their first token
+ROUTING_LABELS = {
+    "simple": "route_simple",
+    "specialist": "route_specialist",
+    "self": "answer_self",
+    "gemini": "route_gemini",
+}
+
+
+def routing_decision_schema() -> dict:
+    """JSON schema for the router LLM's output: the action and reason fields of RoutingDecision"""
+    schema = RoutingDecision.model_json_schema()
+    return {
+        "type": "object",
+        "properties": {name: schema["properties"][name] for name in ("action", "reason")},
+        "required": ["action", "reason"],
+    }
+
+
+ROUTING_DECISION_SCHEMA = routing_decision_schema()
+
+
+def label_routing_request(user_message: str):
+    """Compact prompt for label mode. Returns (messages, max_tokens, extra request parameters)."""
+    routing_prompt = f"""Pick where to send this request. Answer with one word:
+simple - quick, simple queries (small model)
+specialist - complex, detailed responses (larger model)
+self - you can answer it well yourself
+gemini - needs Google's knowledge or up-to-date information
+
+Request: "{user_message}"
+"""
+    messages = [
+        {"role": "system", "content": "You are a routing agent. Answer with one label only."},
+        {"role": "user", "content": routing_prompt}
+    ]
+    extra = {"guided_choice": list(ROUTING_LABELS), "temperature": 0, "logprobs": True}
+    return messages, ROUTING_LABEL_MAX_TOKENS, extra
+
+
+def parse_routing_label(text: str) -> Optional[str]:
+    """Map a (possibly truncated) label back to its action by unique prefix match"""
+    text = text.strip().lower()
+    matches = [label for label in ROUTING_LABELS if text and (label.startswith(text) or text.startswith(label))]
+    return ROUTING_LABELS[matches[0]] if len(matches) == 1 else None
+
+
+async def router_agent_decision(user_message: str) -> RoutingDecision:
     """
     Use LLM to make routing decision.
     The router agent analyzes the prompt and decides where to route it.
+    Successful decisions are cached, so repeated prompts skip the LLM round trip.
     """
+    if ROUTING_DECODE_MODE == "label":
+        return await router_label_decision(user_message)
+
     routing_prompt = f"""You are a smart router agent. Analyze the user's request and decide the best action:
 
 User request: "{user_message}"
@@ -124,8 +2495,16 @@ JSON response:"""
         {"role": "user", "content": routing_prompt}
     ]
     
+    extra = None
+    if ROUTING_DECODE_MODE == "guided_json":
+        extra = {"guided_json": ROUTING_DECISION_SCHEMA, "temperature": 0}
+
     try:
-        response_text = await call_llm(session, ROUTER_MODEL_URL, messages, ROUTER_MODEL, max_tokens=150)
+        llm_start = time.perf_counter()
+        choice, usage = await request_routing_choice(messages, 150, extra)
+        response_text = choice_text(choice)
+        parse_start = time.perf_counter()
+        DECISION_LLM_SECONDS.observe(parse_start - llm_start)
         
         # Extract JSON from response (handle cases where LLM adds extra text)
         response_text = response_text.strip()
@@ -142,104 +2521,834 @@ JSON response:"""
         
         # Validate action
         valid_actions = ["route_simple", "route_specialist", "answer_self", "route_gemini"]
-        if decision.get("action") not in valid_actions:
+        cacheable = decision.get("action") in valid_actions
+        if not cacheable:
             logger.warning(f"Invalid action {decision.get('action')}, defaulting to route_simple")
+            DECISION_INVALID_ACTIONS.inc()
             decision["action"] = "route_simple"
+        decision["decided_by"] = "llm"
+        decision["usage"] = usage
         
-        return RoutingDecision(**decision)
+        result = RoutingDecision(**decision)
+        DECISION_PARSE_SECONDS.observe(time.perf_counter() - parse_start)
+        if cacheable:
+            routing_cache.put(user_message, result)
+        return result
     
     except json.JSONDecodeError as e:
         logger.error(f"Failed to parse routing decision: {e}, response: {response_text}")
+        DECISION_PARSE_FAILURES.inc()
         # Default fallback
         return RoutingDecision(
             action="route_simple",
-            reason="Failed to parse routing decision, defaulting to simple agent"
+            reason="Failed to parse routing decision, defaulting to simple agent",
+            decided_by="fallback"
         )
     except Exception as e:
         logger.error(f"Routing decision error: {e}")
         return RoutingDecision(
             action="route_simple",
-            reason=f"Error in routing: {str(e)}, defaulting to simple agent"
+            reason=f"Error in routing: {str(e)}, defaulting to simple agent",
+            decided_by="fallback"
         )
 
 
-@app.post("/v1/chat/completions")
-async def chat_completions(request: ChatRequest):
-    """Main chat endpoint - router agent decides where to route"""
-    async with aiohttp.ClientSession() as session:
-        # Get user message
-        user_message = request.messages[-1]["content"] if request.messages else ""
+async def request_routing_choice(messages: list, max_tokens: int, extra: Optional[dict] = None):
+    """Ask the router model, through the decision batcher when batching is on. Returns (choice, usage)."""
+    if DECISION_BATCH_WINDOW_MS > 0:
+        return await decision_batcher.submit(messages, max_tokens, extra)
+    return await call_llm_choice(UPSTREAMS["router"], messages, max_tokens, extra=extra)
+
+
+async def router_label_decision(user_message: str) -> RoutingDecision:
+    """
+    Label mode: the router model picks one guided_choice label in a couple of tokens.
+    Nothing is left to parse; confidence is the probability of the generated label.
+    """
+    messages, max_tokens, extra = label_routing_request(user_message)
+    try:
+        llm_start = time.perf_counter()
+        choice, usage = await request_routing_choice(messages, max_tokens, extra)
+        parse_start = time.perf_counter()
+        DECISION_LLM_SECONDS.observe(parse_start - llm_start)
+
+        label = choice_text(choice).strip()
+        action = parse_routing_label(label)
+        logprob = choice_logprob(choice)
+        result = RoutingDecision(
+            action=action or "route_simple",
+            reason=f"router label: {label}",
+            confidence=round(math.exp(logprob), 4) if logprob is not None else None,
+            decided_by="llm",
+            usage=usage,
+        )
+        DECISION_PARSE_SECONDS.observe(time.perf_counter() - parse_start)
+        if action is None:
+            logger.warning(f"Unknown routing label {label!r}, defaulting to route_simple")
+            DECISION_INVALID_ACTIONS.inc()
+        else:
+            routing_cache.put(user_message, result)
+        return result
+    except Exception as e:
+        logger.error(f"Routing decision error: {e}")
+        return RoutingDecision(
+            action="route_simple",
+            reason=f"Error in routing: {str(e)}, defaulting to simple agent",
+            decided_by="fallback"
+        )
+
+
+def quick_decision(user_message: str) -> Optional[RoutingDecision]:
+    """Decisions that need no LLM call: the rule fast path, then the decision cache"""
+    decision = pre_classifier.classify(user_message) or routing_cache.get(user_message)
+    if decision is not None:
+        DECISIONS_TOTAL.labels(decision.decided_by).inc()
+    return decision
+
+
+# A follow-up turn leaves its pinned backend only for an action further down this list
+ESCALATION_RANK = {"answer_self": 0, "route_simple": 1, "route_specialist": 2, "route_gemini": 3}
+
+
+def affinity_decision(request: ChatRequest, key: Optional[str], user_message: str) -> Optional[RoutingDecision]:
+    """
+    Keep a follow-up turn on its conversation's pinned backend without asking the router LLM.
+    A rule or cached decision for the new turn that escalates past the pinned action wins.
+    """
+    if key is None:
+        return None
+    action = session_affinity.get(request, key)
+    if action is None:
+        return None
+    quick = pre_classifier.classify(user_message) or routing_cache.get(user_message)
+    if quick is not None and ESCALATION_RANK[quick.action] > ESCALATION_RANK[action]:
+        session_affinity.escalated += 1
+        DECISIONS_TOTAL.labels(quick.decided_by).inc()
+        return quick
+    session_affinity.pinned += 1
+    DECISIONS_TOTAL.labels("affinity").inc()
+    return RoutingDecision(action=action, reason="conversation pinned to its backend", decided_by="affinity")
+
+
+def unit_vector(vector: list) -> list:
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+def build_centroids(vectors: list, actions: list) -> dict:
+    """Per-action mean of the unit-normalized example vectors, itself normalized"""
+    sums = {}
+    for vector, action in zip(vectors, actions):
+        vector = unit_vector(vector)
+        total = sums.get(action)
+        if total is None:
+            sums[action] = vector
+        else:
+            sums[action] = [a + b for a, b in zip(total, vector)]
+    return {action: unit_vector(total) for action, total in sums.items()}
+
+
+def rank_actions(centroids: dict, vector: list) -> list:
+    """[(cosine similarity, action)] for every centroid, most similar first"""
+    vector = unit_vector(vector)
+    return sorted(((sum(a * b for a, b in zip(centroid, vector)), action)
+                   for action, centroid in centroids.items()), reverse=True)
+
+
+def load_routing_examples(path: str) -> list:
+    """[(text, action)] from a JSONL file of {"text": ..., "action": ...} lines"""
+    examples = []
+    with open(path) as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            if item.get("action") not in ACTION_BACKENDS:
+                logger.warning(f"{path}:{line_no}: unknown action {item.get('action')!r}, skipped")
+                continue
+            examples.append((item["text"], item["action"]))
+    return examples
+
+
+class EmbeddingRouter:
+    """
+    Nearest-centroid decision engine. The labeled example prompts are embedded once (on the
+    first decision), averaged per action, and each prompt goes to the action whose centroid
+    it is most similar to: one embedding call instead of a generation.
+    """
+
+    def __init__(self, upstream: UpstreamPool, examples: list):
+        self.upstream = upstream
+        self.examples = examples
+        self.centroids = {}
+        self._lock = asyncio.Lock()
+        self.decisions = 0
+        self.deferred = 0
+        self.errors = 0
+        self.embed_s_total = 0.0
+
+    @classmethod
+    def from_file(cls, upstream: UpstreamPool, path: str) -> "EmbeddingRouter":
+        if ROUTING_ENGINE != "embedding":
+            return cls(upstream, [])
+        try:
+            examples = load_routing_examples(path)
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Could not load routing examples from {path}: {e}")
+            examples = []
+        logger.info(f"Loaded {len(examples)} routing examples from {path}")
+        return cls(upstream, examples)
+
+    async def ensure_centroids(self):
+        if self.centroids or not self.examples:
+            return
+        async with self._lock:
+            if self.centroids:
+                return
+            vectors = []
+            for i in range(0, len(self.examples), 64):
+                batch, _ = await call_embeddings(self.upstream, [text for text, _ in self.examples[i:i + 64]])
+                vectors.extend(batch)
+            self.centroids = build_centroids(vectors, [action for _, action in self.examples])
+            logger.info(f"Built routing centroids for {sorted(self.centroids)} from {len(vectors)} examples")
+
+    async def classify(self, user_message: str) -> Optional[RoutingDecision]:
+        """Nearest-centroid decision, or None to leave the prompt to the LLM"""
+        await self.ensure_centroids()
+        if not self.centroids:
+            return None
+        start = time.perf_counter()
+        vectors, usage = await call_embeddings(self.upstream, [user_message])
+        self.embed_s_total += time.perf_counter() - start
+        ranked = rank_actions(self.centroids, vectors[0])
+        similarity, action = ranked[0]
+        margin = similarity - ranked[1][0] if len(ranked) > 1 else similarity
+        if margin < EMBEDDING_MIN_MARGIN:
+            self.deferred += 1
+            return None
+        self.decisions += 1
+        return RoutingDecision(
+            action=action,
+            reason=f"nearest example centroid (similarity {similarity:.2f}, margin {margin:.2f})",
+            confidence=round(similarity, 4),
+            decided_by="embedding",
+            usage=usage,
+        )
+
+    def stats(self) -> dict:
+        embedded = self.decisions + self.deferred
+        return {
+            "enabled": ROUTING_ENGINE == "embedding",
+            "examples": len(self.examples),
+            "centroids": sorted(self.centroids),
+            "decisions": self.decisions,
+            "deferred_to_llm": self.deferred,
+            "errors": self.errors,
+            "avg_embed_ms": round(self.embed_s_total / embedded * 1000, 2) if embedded else 0.0,
+        }
+
+
+embedding_router = EmbeddingRouter.from_file(UPSTREAMS["embedding"], ROUTING_EXAMPLES_FILE)
+
+
+async def llm_decision(user_message: str) -> RoutingDecision:
+    start = time.perf_counter()
+    decision = await router_agent_decision(user_message)
+    if decision.decided_by == "llm":
+        pre_classifier.observe_llm_decision(time.perf_counter() - start)
+    DECISIONS_TOTAL.labels(decision.decided_by).inc()
+    return decision
+
+
+async def engine_decision(user_message: str) -> RoutingDecision:
+    """Decision from ROUTING_ENGINE for a prompt the rules and cache did not settle"""
+    if ROUTING_ENGINE == "embedding":
+        try:
+            decision = await embedding_router.classify(user_message)
+        except Exception as e:
+            logger.warning(f"Embedding routing failed: {e}, asking the router LLM")
+            embedding_router.errors += 1
+            decision = None
+        if decision is not None:
+            routing_cache.put(user_message, decision)
+            DECISIONS_TOTAL.labels(decision.decided_by).inc()
+            return decision
+    return await llm_decision(user_message)
+
+
+# Upstream serving each action, and where to send the action instead when that upstream is down
+ACTION_UPSTREAMS = {
+    "route_simple": "simple",
+    "route_specialist": "specialist",
+    "answer_self": "router",
+    "route_gemini": "gemini",
+}
+ALTERNATE_ACTIONS = {
+    "route_simple": "route_specialist",
+    "route_specialist": "route_simple",
+    "answer_self": "route_simple",
+    "route_gemini": "route_specialist",
+}
+
+
+def override_action(decision: RoutingDecision, action: str, reason: str) -> RoutingDecision:
+    """Replace the decided action, keeping the first original action if overridden twice"""
+    original = decision.override["original_action"] if decision.override else decision.action
+    return decision.model_copy(update={
+        "action": action,
+        "override": {"original_action": original, "reason": reason},
+    })
+
+
+def apply_breaker_bypass(decision: RoutingDecision) -> RoutingDecision:
+    """Send the decision straight to the alternate backend while its own breaker is open"""
+    upstream = UPSTREAMS[ACTION_UPSTREAMS[decision.action]]
+    alternate = ALTERNATE_ACTIONS[decision.action]
+    if not upstream.breaker.is_open() or UPSTREAMS[ACTION_UPSTREAMS[alternate]].breaker.is_open():
+        return decision
+    logger.info(f"Breaker bypass: {decision.action} -> {alternate} ({upstream.name} circuit open)")
+    return override_action(decision, alternate, f"{upstream.name} circuit breaker is open")
+
+
+def apply_load_overrides(decision: RoutingDecision) -> RoutingDecision:
+    """
+    Steer away from a saturated backend: spill route_simple to answer_self on the
+    router model, or degrade route_specialist to the simple agent. Only spill to a
+    target that is itself unsaturated and is a different pod.
+    """
+    if not LOAD_AWARE_ROUTING:
+        return decision
+    spill = {
+        "route_simple": ("simple", "router", "answer_self"),
+        "route_specialist": ("specialist", "simple", "route_simple"),
+    }.get(decision.action)
+    if spill is None:
+        return decision
+    source_name, target_name, target_action = spill
+    source, target = UPSTREAMS[source_name], UPSTREAMS[target_name]
+    reason = source.saturation()
+    if reason is None or source.base_urls() & target.base_urls() or target.saturation() is not None:
+        return decision
+    logger.info(f"Load override: {decision.action} -> {target_action} ({reason})")
+    LOAD_OVERRIDES.labels(decision.action, target_action).inc()
+    return override_action(decision, target_action, reason)
+
+
+async def decide_route(user_message: str) -> RoutingDecision:
+    """Try the rule-based fast path and cache first, then the router LLM"""
+    return quick_decision(user_message) or await engine_decision(user_message)
+
+
+async def gemini_call(user_message: str):
+    """call_gemini, timed into GEMINI_SECONDS"""
+    gemini_start = time.perf_counter()
+    response_text, usage = await call_gemini(UPSTREAMS["gemini"], user_message)
+    GEMINI_SECONDS.observe(time.perf_counter() - gemini_start, "ok" if response_text is not None else "error")
+    return response_text, usage
+
+
+async def agent_call(upstream: UpstreamPool, request: ChatRequest, shaping: Optional[list] = None):
+    """call_llm with the request shaped to fit the upstream's context window (see shape_request for shaping)"""
+    shaped = shape_request(request, upstream, shaping)
+    return await call_llm(upstream, shaped.messages, shaped.max_tokens, temperature=shaped.temperature)
+
+
+def backend_call(request: ChatRequest, action: str, user_message: str, shaping: Optional[list] = None):
+    """Coroutine for the action's backend call, returning (response_text, usage)"""
+    if action == "route_gemini":
+        return gemini_call(user_message)
+    return agent_call(UPSTREAMS[ACTION_UPSTREAMS[action]], request, shaping)
+
+
+async def hedged_execute(request: ChatRequest, action: str, user_message: str):
+    """
+    Run the action's backend call. If it has not answered within the upstream's hedge delay,
+    or it fails, race a duplicate on the alternate backend and cancel whichever loses.
+    Only the call whose answer or error is returned records its context shaping.
+    Returns (response_text, usage, source).
+    """
+    alternate = ALTERNATE_ACTIONS[action]
+    if UPSTREAMS[ACTION_UPSTREAMS[alternate]].breaker.is_open():
+        alternate = None
+    delay_s = UPSTREAMS[ACTION_UPSTREAMS[action]].hedge_delay_s()
+    shaping = {action: []}
+    tasks = {asyncio.create_task(backend_call(request, action, user_message, shaping[action])): action}
+    hedge_trigger = None
+    error, error_action = None, None
+    try:
+        while tasks:
+            done, _ = await asyncio.wait(tasks, timeout=delay_s if alternate else None,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            trigger = "delay"
+            for task in done:
+                task_action = tasks.pop(task)
+                if task.exception() is None and task.result()[0] is not None:
+                    response_text, usage = task.result()
+                    context_shaping.record_all(shaping[task_action])
+                    source = ACTION_BACKENDS[task_action]
+                    if hedge_trigger is not None:
+                        HEDGES_TOTAL.labels(hedge_trigger, "hedge" if task_action != action else "primary").inc()
+                    if task_action != action:
+                        if action == "route_gemini" and hedge_trigger == "error":
+                            GEMINI_FALLBACKS.inc()
+                            source += " (gemini_fallback)"
+                        else:
+                            source += " (hedge)"
+                    return response_text, usage, source
+                if task.exception() is not None:
+                    error, error_action = task.exception(), task_action
+                trigger = "error"
+            if alternate is not None and (trigger == "delay" or not tasks):
+                logger.info(f"Hedging {action} on {alternate} after {trigger}")
+                shaping[alternate] = []
+                tasks[asyncio.create_task(backend_call(request, alternate, user_message, shaping[alternate]))] = alternate
+                hedge_trigger, alternate = trigger, None
+    finally:
+        for task in tasks:
+            task.cancel()
+    if error is not None:
+        context_shaping.record_all(shaping[error_action])
+        raise error
+    raise HTTPException(status_code=502, detail=f"{action} backend returned no answer")
+
+
+async def execute_decision(request: ChatRequest, decision: RoutingDecision, user_message: str):
+    """Run the routing decision against its backend. Returns (response_text, usage, source)."""
+    if HEDGED_REQUESTS:
+        return await hedged_execute(request, decision.action, user_message)
+
+    if decision.action == "route_simple":
+        logger.info("Routing to Simple Agent")
+        response_text, usage = await agent_call(UPSTREAMS["simple"], request)
+        source = "simple_agent"
         
-        if not user_message:
-            raise HTTPException(status_code=400, detail="No message content provided")
+    elif decision.action == "route_specialist":
+        logger.info("Routing to Specialist Agent")
+        response_text, usage = await agent_call(UPSTREAMS["specialist"], request)
+        source = "specialist_agent"
         
-        # Router agent makes decision
-        logger.info(f"Router analyzing request: {user_message[:50]}...")
-        decision = await router_agent_decision(session, user_message)
-        logger.info(f"Router decision: {decision.action} - {decision.reason}")
+    elif decision.action == "answer_self":
+        logger.info("Router answering directly")
+        response_text, usage = await agent_call(UPSTREAMS["router"], request)
+        source = "router_agent"
         
-        # Execute routing decision
-        if decision.action == "route_simple":
-            logger.info("Routing to Simple Agent")
-            response_text = await call_llm(session, SIMPLE_AGENT_URL, request.messages, 
-                                         "Qwen/Qwen2.5-0.5B-Instruct", request.max_tokens)
-            source = "simple_agent"
-            
-        elif decision.action == "route_specialist":
-            logger.info("Routing to Specialist Agent")
-            response_text = await call_llm(session, SPECIALIST_AGENT_URL, request.messages,
-                                         "Qwen/Qwen2.5-1.5B-Instruct", request.max_tokens)
-            source = "specialist_agent"
-            
-        elif decision.action == "answer_self":
-            logger.info("Router answering directly")
-            response_text = await call_llm(session, ROUTER_MODEL_URL, request.messages,
-                                         ROUTER_MODEL, request.max_tokens)
-            source = "router_agent"
-            
-        elif decision.action == "route_gemini":
-            logger.info("Routing to Gemini")
-            gemini_text, gemini_ok = await call_gemini(session, user_message)
-            if gemini_ok:
-                response_text = gemini_text
-                source = "gemini"
-            else:
-                logger.info("Gemini unavailable, falling back to Specialist Agent")
-                response_text = await call_llm(session, SPECIALIST_AGENT_URL, request.messages,
-                                             "Qwen/Qwen2.5-1.5B-Instruct", request.max_tokens)
-                source = "specialist_agent (gemini_fallback)"
+    elif decision.action == "route_gemini":
+        logger.info("Routing to Gemini")
+        response_text, usage = await gemini_call(user_message)
+        if response_text is not None:
+            source = "gemini"
+        else:
+            logger.info("Gemini unavailable, falling back to Specialist Agent")
+            GEMINI_FALLBACKS.inc()
+            response_text, usage = await agent_call(UPSTREAMS["specialist"], request)
+            source = "specialist_agent (gemini_fallback)"
 
+    else:
+        # Fallback
+        response_text, usage = await agent_call(UPSTREAMS["simple"], request)
+        source = "simple_agent"
+
+    return response_text, usage, source
+
+
+class SpeculationStats:
+    """Outcome counters for speculative simple-agent dispatch"""
+
+    KEEP_ACTIONS = ("route_simple", "answer_self")
+
+    def __init__(self):
+        self.launched = 0
+        self.kept = 0
+        self.discarded = 0
+        self.cancelled_in_flight = 0
+        self.failed = 0
+        # GPU work thrown away. Finished-but-unused answers report their upstream
+        # completion_tokens; speculations cancelled in flight are time-only, since the
+        # tokens generated before the cancel are never reported back
+        self.wasted_completion_tokens = 0
+        self.wasted_finished_s = 0.0
+        self.wasted_cancelled_s = 0.0
+
+    def discard(self, task: asyncio.Task, started: float):
+        self.discarded += 1
+        elapsed = time.perf_counter() - started
+        if not task.done():
+            task.cancel()
+            self.cancelled_in_flight += 1
+            self.wasted_cancelled_s += elapsed
+            return
+        self.wasted_finished_s += elapsed
+        if not task.cancelled() and task.exception() is None:
+            self.wasted_completion_tokens += task.result()[1].get("completion_tokens", 0)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": SPECULATIVE_DISPATCH,
+            "launched": self.launched,
+            "kept": self.kept,
+            "discarded": self.discarded,
+            "hit_rate": round(self.kept / self.launched, 4) if self.launched else 0.0,
+            "cancelled_in_flight": self.cancelled_in_flight,
+            "failed": self.failed,
+            "wasted_completion_tokens": self.wasted_completion_tokens,
+            "wasted_finished_s": round(self.wasted_finished_s, 3),
+            "wasted_cancelled_s": round(self.wasted_cancelled_s, 3),
+        }
+
+
+speculation = SpeculationStats()
+
+
+async def dispatch(request: ChatRequest, decision: RoutingDecision, user_message: str,
+                   speculative: Optional[asyncio.Task] = None, speculative_started: float = 0.0,
+                   speculative_shaping: Optional[list] = None):
+    """
+    Use the speculative simple-agent answer if the decision allows it, else execute the decision.
+    The speculative call's deferred context shaping is recorded only when its answer is kept.
+    """
+    if speculative is not None:
+        if decision.action in SpeculationStats.KEEP_ACTIONS:
+            try:
+                response_text, usage = await speculative
+                speculation.kept += 1
+                context_shaping.record_all(speculative_shaping or [])
+                return response_text, usage, "simple_agent (speculative)"
+            except HTTPException as e:
+                logger.warning(f"Speculative simple-agent call failed: {e.detail}, dispatching normally")
+                speculation.failed += 1
         else:
-            # Fallback
-            response_text = await call_llm(session, SIMPLE_AGENT_URL, request.messages,
-                                         "Qwen/Qwen2.5-0.5B-Instruct", request.max_tokens)
-            source = "simple_agent"
-        
-        # Return OpenAI-compatible response
+            speculation.discard(speculative, speculative_started)
+    return await execute_decision(request, decision, user_message)
+
+
+def cached_completion(request: ChatRequest, entry: dict, similarity: float, routing_s: float):
+    """Answer from the semantic response cache, as a JSON completion or a one-chunk SSE stream"""
+    chunk_id = f"chatcmpl-router-{int(time.time())}"
+    model = request.model or "router-agent"
+    routing_metadata = {
+        "action": entry["action"],
+        "reason": f"semantic cache hit (similarity {similarity:.3f})",
+        "decided_by": "cache",
+        "override": None,
+        "source": "cache",
+    }
+    usage = {**make_usage(), "routing": make_usage()}
+    router_stats.record(entry["action"], "cache", routing_s, 0.0)
+
+    if not request.stream:
         return {
-            "id": f"chatcmpl-router-{int(time.time())}",
+            "id": chunk_id,
             "object": "chat.completion",
             "created": int(time.time()),
-            "model": request.model or "router-agent",
-            "choices": [{
-                "index": 0,
-                "message": {
-                    "role": "assistant",
-                    "content": response_text
-                },
-                "finish_reason": "stop"
-            }],
-            "usage": {
-                "prompt_tokens": len(user_message.split()),
-                "completion_tokens": len(response_text.split()),
-                "total_tokens": len(user_message.split()) + len(response_text.split())
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": entry["text"]},
+                         "finish_reason": "stop"}],
+            "usage": usage,
+            "routing_metadata": routing_metadata,
+        }
+
+    finished = False
+
+    def release():
+        nonlocal finished
+        if not finished:
+            finished = True
+            IN_FLIGHT.dec()
+
+    async def event_stream():
+        base = {"id": chunk_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model}
+        try:
+            yield sse_event({**base, "choices": [{"index": 0, "delta": {"role": "assistant", "content": entry["text"]},
+                                                  "finish_reason": None}], "routing_metadata": routing_metadata})
+            yield sse_event({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+            yield sse_event({**base, "choices": [], "usage": usage})
+            yield b"data: [DONE]\n\n"
+        finally:
+            release()
+
+    return ClosingStreamingResponse(event_stream(), release, media_type="text/event-stream",
+                                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+class Flight:
+    """
+    One in-progress request shared by identical callers; for streams, the chunks sent so far.
+    subscribers counts the callers still waiting for it or replaying it.
+    """
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.response: Optional[ClosingStreamingResponse] = None
+        self.pump: Optional[asyncio.Task] = None
+        self.chunks = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 1
+        self.leader_left = False
+        self._changed = asyncio.Event()
+
+    def notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+
+class RequestCoalescer:
+    """
+    Single-flight for identical concurrent requests. The first caller's request runs;
+    callers arriving while it is in flight await the same result. A streamed response is
+    pumped once into a chunk list that every subscriber replays from the start, so callers
+    can join mid-stream. The flight is forgotten once its response is complete, or once every
+    caller has gone away, which also closes the upstream stream.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self.leaders = 0
+        self.collapsed = 0
+        self.collapsed_streams = 0
+
+    @staticmethod
+    def key(request: ChatRequest) -> str:
+        identity = [request.messages, request.max_tokens, request.temperature, request.model, request.stream]
+        return hashlib.sha256(json.dumps(identity, sort_keys=True, default=str).encode()).hexdigest()
+
+    async def run(self, request: ChatRequest, handler):
+        key = self.key(request)
+        flight = self._flights.get(key)
+        follower = flight is not None
+        if follower:
+            self.collapsed += 1
+            self.collapsed_streams += request.stream
+            flight.subscribers += 1
+        else:
+            self.leaders += 1
+            flight = self._flights[key] = Flight(asyncio.ensure_future(handler()))
+            flight.task.add_done_callback(lambda task: self._settle(key, flight))
+        # Shielded: one caller going away must not cancel the call the others are waiting on
+        try:
+            response = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if not follower:
+                # chat_completions releases the leader's slot, which the stream releases too
+                flight.leader_left = True
+                if flight.response is not None:
+                    IN_FLIGHT.inc()
+            self._leave(key, flight)
+            raise
+        if not isinstance(response, StreamingResponse):
+            return response
+
+        left = False
+
+        def leave():
+            # The leader's in-flight slot is released by the original stream when the pump
+            # finishes it; followers release their own
+            nonlocal left
+            if not left:
+                left = True
+                if follower:
+                    IN_FLIGHT.dec()
+                self._leave(key, flight)
+
+        return ClosingStreamingResponse(self._replay(flight, leave), leave, media_type=response.media_type,
+                                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    def _settle(self, key: str, flight: Flight):
+        """
+        Non-streaming flights end with their task. A stream is pumped from here, so it is read
+        and closed even if every caller went away while it was being opened.
+        """
+        task = flight.task
+        if task.cancelled() or task.exception() is not None or not isinstance(task.result(), StreamingResponse):
+            self._forget(key, flight)
+            return
+        flight.response = task.result()
+        if flight.leader_left:
+            IN_FLIGHT.inc()
+        if flight.subscribers:
+            flight.pump = asyncio.create_task(self._pump(key, flight))
+            # Also covers a pump cancelled before it ever ran
+            flight.pump.add_done_callback(lambda pump: flight.response.on_close())
+        else:
+            flight.response.on_close()
+            self._forget(key, flight)
+
+    def _leave(self, key: str, flight: Flight):
+        """
+        A caller went away; the last one stops the pump, which closes the upstream stream.
+        A flight still being opened stays joinable, and _settle closes it if nobody joins.
+        """
+        flight.subscribers -= 1
+        if not flight.subscribers and flight.pump is not None:
+            flight.pump.cancel()
+            self._forget(key, flight)
+
+    def _forget(self, key: str, flight: Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def _pump(self, key: str, flight: Flight):
+        body = flight.response.body_iterator
+        try:
+            async for chunk in body:
+                flight.chunks.append(chunk)
+                flight.notify()
+        except Exception as e:
+            flight.error = e
+        finally:
+            await body.aclose()
+            flight.done = True
+            flight.notify()
+            self._forget(key, flight)
+
+    async def _replay(self, flight: Flight, leave):
+        """Every chunk of the shared stream, from the first; leave() runs when the caller is done"""
+        sent = 0
+        try:
+            while True:
+                if sent < len(flight.chunks):
+                    yield flight.chunks[sent]
+                    sent += 1
+                elif flight.done:
+                    break
+                else:
+                    await flight._changed.wait()
+            if flight.error is not None:
+                raise flight.error
+        finally:
+            leave()
+
+    def stats(self) -> dict:
+        requests = self.leaders + self.collapsed
+        return {
+            "enabled": COALESCE_REQUESTS,
+            "upstream_flights": self.leaders,
+            "collapsed": self.collapsed,
+            "collapsed_streams": self.collapsed_streams,
+            "collapse_rate": round(self.collapsed / requests, 4) if requests else 0.0,
+            "in_flight": len(self._flights),
+        }
+
+
+coalescer = RequestCoalescer()
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: ChatRequest, x_session_id: Optional[str] = Header(None),
+                           x_priority: Optional[str] = Header(None), x_deadline_ms: Optional[float] = Header(None)):
+    """Main chat endpoint - router agent decides where to route"""
+    if request.session_id is None and x_session_id:
+        request.session_id = x_session_id
+    priority = request.priority or x_priority or DEFAULT_PRIORITY
+    if priority not in PRIORITY_TIERS:
+        raise HTTPException(status_code=400, detail=f"Unknown priority '{priority}', expected one of "
+                                                    + ", ".join(PRIORITY_TIERS))
+    deadline_ms = request.deadline_ms or x_deadline_ms
+    deadline_s = deadline_ms / 1000 if deadline_ms else PRIORITY_DEADLINE_S[priority]
+    request_class.set((priority, time.monotonic() + deadline_s))
+    IN_FLIGHT.inc()
+    streaming = False
+    try:
+        if COALESCE_REQUESTS:
+            response = await coalescer.run(request, lambda: route_chat_completion(request))
+        else:
+            response = await route_chat_completion(request)
+        # A streaming response releases its in-flight slot when the stream ends
+        streaming = isinstance(response, StreamingResponse)
+        return response
+    finally:
+        if not streaming:
+            IN_FLIGHT.dec()
+
+
+async def route_chat_completion(request: ChatRequest):
+    # Get user message
+    user_message = request.messages[-1]["content"] if request.messages else ""
+    
+    if not user_message:
+        raise HTTPException(status_code=400, detail="No message content provided")
+    
+    check_context(request)
+    started = time.perf_counter()
+    cached, cache_key = await response_cache.lookup(request, user_message)
+    if cached is not None:
+        logger.info(f"Semantic cache hit (similarity {cached[1]:.3f})")
+        return cached_completion(request, *cached, time.perf_counter() - started)
+
+    # Router agent makes decision
+    logger.info(f"Router analyzing request: {user_message[:50]}...")
+    speculative, speculative_started, speculative_shaping = None, 0.0, []
+    affinity_key = session_affinity.key(request)
+    decision = affinity_decision(request, affinity_key, user_message) or quick_decision(user_message)
+    if decision is None:
+        if SPECULATIVE_DISPATCH and ROUTING_ENGINE == "llm" and not request.stream:
+            # Start the likely answer on the simple agent while the router LLM decides
+            speculative = asyncio.create_task(agent_call(UPSTREAMS["simple"], request, speculative_shaping))
+            speculative_started = time.perf_counter()
+            speculation.launched += 1
+        try:
+            decision = await engine_decision(user_message)
+        except BaseException:
+            if speculative is not None:
+                speculative.cancel()
+            raise
+    logger.info(f"Router decision: {decision.action} - {decision.reason}")
+    decision = apply_load_overrides(apply_breaker_bypass(decision))
+    if affinity_key is not None and decision.override is None:
+        # Overrides are transient: the conversation keeps its pin through them
+        session_affinity.pin(affinity_key, decision.action)
+    decided = time.perf_counter()
+    routing_s = decided - started
+
+    if request.stream:
+        try:
+            return await stream_chat_completion(request, decision, user_message, routing_s, cache_key)
+        except HTTPException:
+            router_stats.record(decision.action, ACTION_BACKENDS[decision.action], routing_s,
+                                time.perf_counter() - decided, error=True)
+            raise
+    
+    # Execute routing decision
+    try:
+        response_text, usage, source = await dispatch(request, decision, user_message,
+                                                      speculative, speculative_started, speculative_shaping)
+    except HTTPException:
+        router_stats.record(decision.action, ACTION_BACKENDS[decision.action], routing_s,
+                            time.perf_counter() - decided, error=True)
+        raise
+    router_stats.record(decision.action, backend_label(source), routing_s, time.perf_counter() - decided)
+    if cache_key is not None:
+        response_cache.put(*cache_key, {"text": response_text, "action": decision.action, "source": source})
+    
+    # Return OpenAI-compatible response
+    return {
+        "id": f"chatcmpl-router-{int(time.time())}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.model or "router-agent",
+        "choices": [{
+            "index": 0,
+            "message": {
+                "role": "assistant",
+                "content": response_text
             },
-            "routing_metadata": {
-                "action": decision.action,
-                "reason": decision.reason,
-                "source": source
-            }
+            "finish_reason": "stop"
+        }],
+        "usage": {
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", 0),
+            "total_tokens": usage.get("total_tokens", 0),
+            "routing": decision.usage or make_usage()
+        },
+        "routing_metadata": {
+            "action": decision.action,
+            "reason": decision.reason,
+            "decided_by": decision.decided_by,
+            "override": decision.override,
+            "source": source
         }
+    }
 
 
 @app.get("/health")
@@ -248,10 +3357,73 @@ async def health():
     return {"status": "healthy", "service": "router-agent"}
 
 
+def _upstream_samples(fn):
+    return lambda: [((name,), fn(pool)) for name, pool in UPSTREAMS.items()]
+
+
+CallbackMetric("router_upstream_in_flight", "Calls in flight per upstream", ("upstream",),
+               _upstream_samples(lambda pool: pool.in_flight))
+CallbackMetric("router_upstream_queue_depth", "Calls waiting for an admission slot per upstream", ("upstream",),
+               _upstream_samples(lambda pool: pool.gate.queue_depth))
+CallbackMetric("router_upstream_connections_in_use", "Pooled sockets currently in use per upstream", ("upstream",),
+               _upstream_samples(lambda pool: pool.stats()["connections_in_use"]))
+CallbackMetric("router_upstream_replicas_available", "Replicas currently in rotation per upstream", ("upstream",),
+               _upstream_samples(lambda pool: sum(r.available(time.monotonic()) for r in pool.replicas)))
+CallbackMetric("router_replica_outstanding", "Calls in flight per upstream replica", ("upstream", "replica"),
+               lambda: [((name, r.url), r.outstanding) for name, pool in UPSTREAMS.items() for r in pool.replicas])
+CallbackMetric("router_upstream_breaker_open", "1 while the upstream's circuit breaker is open or half-open",
+               ("upstream",), _upstream_samples(lambda pool: int(pool.breaker.state != "closed")))
+CallbackMetric("router_upstream_prompt_tokens_total", "Prompt tokens sent to each upstream", ("upstream",),
+               _upstream_samples(lambda pool: pool.prompt_tokens_total), kind="counter")
+CallbackMetric("router_upstream_completion_tokens_total", "Completion tokens generated by each upstream", ("upstream",),
+               _upstream_samples(lambda pool: pool.completion_tokens_total), kind="counter")
+CallbackMetric("router_routing_cache_lookups_total", "Routing decision cache lookups by result", ("result",),
+               lambda: [(("hit",), routing_cache.hits), (("miss",), routing_cache.misses)], kind="counter")
+CallbackMetric("router_response_cache_lookups_total", "Semantic response cache lookups by result", ("result",),
+               lambda: [(("hit",), response_cache.hits), (("miss",), response_cache.misses)], kind="counter")
+CallbackMetric("router_response_cache_bytes", "Memory held by the semantic response cache", (),
+               lambda: [((), response_cache.bytes)])
+CallbackMetric("router_coalesced_requests_total", "Requests that joined an identical in-flight request", (),
+               lambda: [((), coalescer.collapsed)], kind="counter")
+CallbackMetric("router_session_affinity_total", "Follow-up turns by affinity outcome", ("result",),
+               lambda: [(("pinned",), session_affinity.pinned), (("escalated",), session_affinity.escalated),
+                        (("miss",), session_affinity.misses)], kind="counter")
+CallbackMetric("router_context_shaped_total", "Requests reshaped to fit a backend's context window",
+               ("upstream", "outcome"), lambda: list(context_shaping.outcomes.items()), kind="counter")
+CallbackMetric("router_context_dropped_messages_total", "Older conversation messages dropped to fit a context window",
+               (), lambda: [((), context_shaping.dropped_messages)], kind="counter")
+CallbackMetric("router_rule_hits_total", "Pre-classifier rule hits", ("rule",),
+               lambda: [((rule.name,), rule.hits) for rule in pre_classifier.rules], kind="counter")
+CallbackMetric("router_speculation_total", "Speculative simple-agent dispatches by outcome", ("outcome",),
+               lambda: [(("kept",), speculation.kept), (("discarded",), speculation.discarded),
+                        (("failed",), speculation.failed)], kind="counter")
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus text-format metrics"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.get("/routing/stats")
 async def routing_stats():
-    """Get routing statistics (placeholder for future implementation)"""
-    return {"message": "Routing stats endpoint - to be implemented"}
+    """Live routing statistics: per-action counts, per-backend latency percentiles and error rates"""
+    return {
+        **router_stats.snapshot(),
+        "upstreams": {name: pool.stats() for name, pool in UPSTREAMS.items()},
+        "routing_cache": routing_cache.stats(),
+        "pre_classifier": pre_classifier.stats(),
+        "speculation": speculation.stats(),
+        "decision_batching": decision_batcher.stats(),
+        "embedding_router": embedding_router.stats(),
+        "response_cache": response_cache.stats(),
+        "coalescing": coalescer.stats(),
+        "session_affinity": session_affinity.stats(),
+        "context_shaping": context_shaping.stats(),
+    }
 
 
 if __name__ == "__main__":
@@ -5,7 +5,7 @@ qGPU Demo — Unified Test & Chat CLI
 Usage:
   python test.py quick          Run a few prompts, show routing decisions
   python test.py full           Run all prompts with detailed output
-  python test.py csv            Run all prompts, save results to CSV
+  python test.py csv            Run all prompts, save results to CSV (sent as batch priority)
   python test.py chat           Interactive chat with the router agent
   python test.py ecommerce      Interactive e-commerce demo (router + specialist)
   python test.py health         Check health of all services
@@ -106,9 +106,11 @@ C_BOLD = "\033[1m"
 C_RED = "\033[31m"
 
 
-async def call_router(session, prompt, max_tokens=300):
+async def call_router(session, prompt, max_tokens=300, priority=None):
     """Send prompt to the router agent service and return result dict."""
     payload = {"messages": [{"role": "user", "content": prompt}], "max_tokens": max_tokens}
+    if priority:
+        payload["priority"] = priority
     start = time.time()
     try:
         async with session.post(ROUTER_URL, json=payload, timeout=aiohttp.ClientTimeout(total=60)) as resp:
@@ -174,13 +176,16 @@ async def cmd_health():
                 print(f"  {C_RED}ERR{C_RESET} {name} — {e}")
 
 
-async def cmd_test(prompts, verbose=True):
+async def cmd_test(prompts, verbose=True, priority=None):
     """Run prompts through the router and print results."""
     print(f"\n{C_BOLD}Router URL:{C_RESET} {ROUTER_URL}")
-    print(f"{C_BOLD}Prompts:{C_RESET}    {len(prompts)}\n")
+    print(f"{C_BOLD}Prompts:{C_RESET}    {len(prompts)}")
+    if priority:
+        print(f"{C_BOLD}Priority:{C_RESET}   {priority}")
+    print()
 
     async with aiohttp.ClientSession() as session:
-        tasks = [call_router(session, p) for p in prompts]
+        tasks = [call_router(session, p, priority=priority) for p in prompts]
         results = await asyncio.gather(*tasks)
 
     for i, r in enumerate(results, 1):
@@ -211,8 +216,8 @@ async def cmd_test(prompts, verbose=True):
 
 
 async def cmd_csv(prompts):
-    """Run prompts and write results to a timestamped CSV."""
-    results = await cmd_test(prompts, verbose=False)
+    """Run prompts and write results to a timestamped CSV. Sent as batch work, behind interactive traffic."""
+    results = await cmd_test(prompts, verbose=False, priority="batch")
 
     ts = datetime.now().strftime("%Y%m%d_%H%M%S")
     csv_file = f"router_test_{ts}.csv"
@@ -263,7 +268,7 @@ async def cmd_chat():
                 print(f"\n  Goodbye!\n")
                 break
 
-            r = await call_router(session, query)
+            r = await call_router(session, query, priority="interactive")
             if r["status"] != "success":
                 print(f"\n  {C_RED}Error:{C_RESET} {r['response']}\n")
                 continue
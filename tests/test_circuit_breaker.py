@@ -0,0 +1,89 @@
+"""Circuit breaker half-open probing through UpstreamPool.begin / end. Run with: python3 -m pytest tests"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BREAKER_ENABLED", "true")
+
+import pytest  # noqa: E402
+from fastapi import HTTPException  # noqa: E402
+
+import router_service as rs  # noqa: E402
+
+
+def half_open_pool() -> rs.UpstreamPool:
+    """A pool whose breaker has tripped and finished cooling down"""
+    pool = rs.UpstreamPool("breaker_test", "http://127.0.0.1:9/v1/chat/completions", None, "BREAKER_TEST")
+    pool.breaker.state = "open"
+    pool.breaker._opened_at = time.monotonic() - pool.breaker.open_s - 1
+    return pool
+
+
+def test_cancelled_probe_lets_next_call_probe():
+    async def run():
+        pool = half_open_pool()
+
+        async def probe():
+            started, replica = await pool.begin()
+            try:
+                await asyncio.sleep(10)
+            finally:
+                pool.end(started, replica)
+
+        task = asyncio.create_task(probe())
+        await asyncio.sleep(0)
+        assert pool.breaker.state == "half_open"
+        # Only one probe at a time
+        with pytest.raises(HTTPException) as refused:
+            await pool.begin()
+        assert refused.value.status_code == 503
+
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        # The cancelled probe freed its turn: the next call probes and closes the breaker
+        started, replica = await pool.begin()
+        pool.end(started, replica, ok=True)
+        assert pool.breaker.state == "closed"
+        assert pool.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_failed_probe_reopens():
+    async def run():
+        pool = half_open_pool()
+        started, replica = await pool.begin()
+        pool.end(started, replica, ok=False)
+        assert pool.breaker.state == "open"
+        assert pool.breaker.is_open()
+
+    asyncio.run(run())
+
+
+def test_older_call_ending_does_not_free_the_probe():
+    async def run():
+        pool = rs.UpstreamPool("breaker_test", "http://127.0.0.1:9/v1/chat/completions", None, "BREAKER_TEST")
+        # Admitted while closed, still running when the breaker trips and cools down
+        old_started, old_replica = await pool.begin()
+        pool.breaker.state = "open"
+        pool.breaker._opened_at = time.monotonic() - pool.breaker.open_s - 1
+
+        started, replica = await pool.begin()
+        assert pool.breaker.state == "half_open"
+        pool.end(old_started, old_replica)
+
+        # The probe is still in flight, so a second call is refused
+        with pytest.raises(HTTPException) as refused:
+            await pool.begin()
+        assert refused.value.status_code == 503
+
+        pool.end(started, replica, ok=True)
+        assert pool.breaker.state == "closed"
+        assert pool.in_flight == 0
+
+    asyncio.run(run())
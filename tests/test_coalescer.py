@@ -0,0 +1,114 @@
+"""Single-flight streams: cleanup when callers go away. Run with: python3 -m pytest tests"""
+
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+import router_service as rs  # noqa: E402
+
+CHUNKS = 20
+
+
+@pytest.fixture
+def coalescing(monkeypatch):
+    """Route chat_completions through a fresh coalescer to a fake upstream stream"""
+    upstream = {"open": asyncio.Event(), "closed": 0, "sent": 0}
+
+    async def route(request):
+        await upstream["open"].wait()
+        finished = False
+
+        def release():
+            nonlocal finished
+            if not finished:
+                finished = True
+                upstream["closed"] += 1
+                rs.IN_FLIGHT.dec()
+
+        async def body():
+            try:
+                for i in range(CHUNKS):
+                    await asyncio.sleep(0.005)
+                    upstream["sent"] += 1
+                    yield f"data: {i}\n\n".encode()
+            finally:
+                release()
+
+        return rs.ClosingStreamingResponse(body(), release, media_type="text/event-stream")
+
+    monkeypatch.setattr(rs, "COALESCE_REQUESTS", True)
+    monkeypatch.setattr(rs, "coalescer", rs.RequestCoalescer())
+    monkeypatch.setattr(rs, "route_chat_completion", route)
+    return upstream
+
+
+def chat():
+    request = rs.ChatRequest(messages=[{"role": "user", "content": "hi"}], stream=True)
+    return rs.chat_completions(request, x_session_id=None, x_priority=None, x_deadline_ms=None)
+
+
+async def read(response) -> list:
+    return [chunk async for chunk in response.body_iterator]
+
+
+def in_flight() -> float:
+    return rs.IN_FLIGHT.labels().value
+
+
+def test_leader_cancelled_while_opening_closes_stream(coalescing):
+    async def run():
+        baseline = in_flight()
+        leader = asyncio.create_task(chat())
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        coalescing["open"].set()
+        await asyncio.sleep(0.05)
+        assert coalescing["closed"] == 1
+        assert coalescing["sent"] == 0
+        assert rs.coalescer.stats()["in_flight"] == 0
+        assert in_flight() == baseline
+
+    asyncio.run(run())
+
+
+def test_last_disconnect_stops_the_pump(coalescing):
+    async def run():
+        baseline = in_flight()
+        callers = [asyncio.create_task(chat()) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        coalescing["open"].set()
+        responses = await asyncio.gather(*callers)
+        for response in responses:
+            await anext(response.body_iterator)
+            # What ClosingStreamingResponse does when the client goes away
+            await response.body_iterator.aclose()
+            response.on_close()
+        await asyncio.sleep(0.05)
+        assert coalescing["closed"] == 1
+        assert coalescing["sent"] < CHUNKS
+        assert rs.coalescer.stats()["in_flight"] == 0
+        assert in_flight() == baseline
+
+    asyncio.run(run())
+
+
+def test_callers_share_one_full_stream(coalescing):
+    async def run():
+        baseline = in_flight()
+        callers = [asyncio.create_task(chat()) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        coalescing["open"].set()
+        responses = await asyncio.gather(*callers)
+        bodies = await asyncio.gather(*(read(response) for response in responses))
+        assert all(len(body) == CHUNKS for body in bodies)
+        assert coalescing["sent"] == CHUNKS
+        assert coalescing["closed"] == 1
+        assert in_flight() == baseline
+
+    asyncio.run(run())
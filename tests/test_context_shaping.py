@@ -0,0 +1,43 @@
+"""Context shaping outcomes, recorded at once or deferred for speculative calls. Run with: python3 -m pytest tests"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import router_service as rs  # noqa: E402
+
+
+def long_conversation() -> rs.ChatRequest:
+    turns = []
+    for i in range(6):
+        turns += [{"role": "user", "content": f"question {i} " + "x" * 400},
+                  {"role": "assistant", "content": f"answer {i} " + "y" * 400}]
+    return rs.ChatRequest(messages=turns + [{"role": "user", "content": "and now?"}], max_tokens=200)
+
+
+def small_pool() -> rs.UpstreamPool:
+    pool = rs.UpstreamPool("shaping_test", "http://127.0.0.1:9/v1/chat/completions", None, "SHAPING_TEST")
+    pool.max_model_len = 512
+    return pool
+
+
+def test_deferred_outcomes_are_not_recorded_until_kept(monkeypatch):
+    monkeypatch.setattr(rs, "CONTEXT_SHAPING", True)
+    monkeypatch.setattr(rs, "context_shaping", rs.ContextShapingStats())
+    outcomes = []
+    shaped = rs.shape_request(long_conversation(), small_pool(), outcomes)
+    assert len(shaped.messages) < len(long_conversation().messages)
+    assert rs.context_shaping.outcomes == {}
+    assert rs.context_shaping.dropped_messages == 0
+
+    rs.context_shaping.record_all(outcomes)
+    assert rs.context_shaping.outcomes[("shaping_test", "trimmed")] == 1
+    assert rs.context_shaping.dropped_messages == len(long_conversation().messages) - len(shaped.messages)
+
+
+def test_outcomes_recorded_at_once_without_a_list(monkeypatch):
+    monkeypatch.setattr(rs, "CONTEXT_SHAPING", True)
+    monkeypatch.setattr(rs, "context_shaping", rs.ContextShapingStats())
+    rs.shape_request(long_conversation(), small_pool())
+    assert rs.context_shaping.outcomes[("shaping_test", "trimmed")] == 1
@@ -0,0 +1,40 @@
+"""Semantic response cache bypass rules and streamed-answer assembly. Run with: python3 -m pytest tests"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import router_service as rs  # noqa: E402
+
+
+def chat(**fields) -> rs.ChatRequest:
+    return rs.ChatRequest(messages=[{"role": "user", "content": "What is a GPU?"}], **fields)
+
+
+def test_unset_temperature_counts_as_sampled():
+    cache = rs.SemanticResponseCache(16, 2 ** 20, 60, 0.95)
+    assert cache.bypass_reason(chat(temperature=None)) == "temperature"
+    assert cache.bypass_reason(chat(temperature=0.7)) == "temperature"
+    assert cache.bypass_reason(chat(temperature=0)) is None
+
+
+def test_scope_accepts_list_of_parts_system_content():
+    parts = [{"type": "text", "text": "Answer briefly."}]
+    with_parts = rs.ChatRequest(messages=[{"role": "system", "content": parts},
+                                          {"role": "user", "content": "What is a GPU?"}])
+    scope = rs.SemanticResponseCache.scope(with_parts)
+    assert -2 ** 63 <= scope < 2 ** 63
+    assert scope == rs.SemanticResponseCache.scope(with_parts)
+    assert scope != rs.SemanticResponseCache.scope(chat())
+
+
+def test_stream_text_joins_deltas():
+    base = {"object": "chat.completion.chunk"}
+    events = [
+        rs.sse_event({**base, "choices": [{"index": 0, "delta": {"content": "A GPU "}, "finish_reason": None}]}),
+        rs.sse_event({**base, "choices": [{"index": 0, "delta": {"content": "is a chip."}, "finish_reason": None}]}),
+        rs.sse_event({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}),
+        rs.sse_event({**base, "choices": [], "usage": {"completion_tokens": 5}}),
+    ]
+    assert rs.stream_text(events) == "A GPU is a chip."
@@ -0,0 +1,42 @@
+"""Wasted-work accounting for discarded speculative calls. Run with: python3 -m pytest tests"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import router_service as rs  # noqa: E402
+
+
+def test_finished_speculation_counts_upstream_tokens():
+    async def run():
+        stats = rs.SpeculationStats()
+
+        async def answer():
+            return "four short words here", rs.make_usage(prompt_tokens=10, completion_tokens=37)
+
+        task = asyncio.create_task(answer())
+        await task
+        stats.discard(task, time.perf_counter() - 0.5)
+        assert stats.wasted_completion_tokens == 37
+        assert stats.wasted_finished_s >= 0.5
+        assert stats.wasted_cancelled_s == 0.0
+
+    asyncio.run(run())
+
+
+def test_cancelled_speculation_is_time_only():
+    async def run():
+        stats = rs.SpeculationStats()
+        task = asyncio.create_task(asyncio.sleep(10))
+        await asyncio.sleep(0)
+        stats.discard(task, time.perf_counter() - 0.5)
+        assert task.cancelling() or task.cancelled()
+        assert stats.cancelled_in_flight == 1
+        assert stats.wasted_completion_tokens == 0
+        assert stats.wasted_cancelled_s >= 0.5
+        assert stats.wasted_finished_s == 0.0
+
+    asyncio.run(run())